@@ -0,0 +1,74 @@
+# Emits machine-readable playbook events for the web configuration interface
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: homelab_events
+    type: notification
+    short_description: Machine-readable progress events for the web interface
+    description:
+      - Writes one line per play, task, host task start, host result and recap to stdout,
+        prefixed with a fixed marker and followed by a JSON object.
+      - The web interface backend reads these lines to report progress;
+        the normal stdout callback output is left unchanged.
+    requirements:
+      - enable in configuration (ANSIBLE_CALLBACKS_ENABLED=homelab_events)
+'''
+
+import json
+import sys
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+# Must match EVENT_PREFIX in web-config/backend/ansible_progress.py
+EVENT_PREFIX = '@@HOMELAB_EVENT@@ '
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'notification'
+    CALLBACK_NAME = 'homelab_events'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def _emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        sys.stdout.write(EVENT_PREFIX + json.dumps(fields, default=str) + '\n')
+        sys.stdout.flush()
+
+    @staticmethod
+    def _task_fields(task):
+        role = task._role.get_name() if task._role else None
+        return {'task_id': task._uuid, 'task': task.get_name(), 'role': role, 'action': task.action}
+
+    def _result(self, status, result):
+        self._emit('result', status=status, host=result._host.get_name(),
+                   **self._task_fields(result._task))
+
+    def v2_playbook_on_play_start(self, play):
+        self._emit('play_start', play=play.get_name())
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._emit('task_start', **self._task_fields(task))
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._emit('task_start', handler=True, **self._task_fields(task))
+
+    def v2_runner_on_start(self, host, task):
+        self._emit('host_start', host=host.get_name(), **self._task_fields(task))
+
+    def v2_runner_on_ok(self, result):
+        self._result('changed' if result._result.get('changed', False) else 'ok', result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._result('ignored' if ignore_errors else 'failed', result)
+
+    def v2_runner_on_skipped(self, result):
+        self._result('skipped', result)
+
+    def v2_runner_on_unreachable(self, result):
+        self._result('unreachable', result)
+
+    def v2_playbook_on_stats(self, stats):
+        self._emit('recap', hosts={host: stats.summarize(host) for host in sorted(stats.processed)})
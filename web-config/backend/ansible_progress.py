@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Structured Ansible progress from the homelab_events callback plugin
+"""
+import json
+from typing import Dict, Any, List, Optional
+
+# Marker starting each event line; must match ansible/callback_plugins/homelab_events.py
+EVENT_PREFIX = '@@HOMELAB_EVENT@@ '
+
+CALLBACK_NAME = 'homelab_events'
+
+RESULT_STATUSES = ('ok', 'changed', 'failed', 'skipped', 'unreachable', 'ignored')
+
+# Result statuses that stop a host from running further tasks
+HOST_FAILURES = ('failed', 'unreachable')
+
+# Percent reported until the recap arrives, however far past the estimate a run goes
+MAX_RUNNING_PERCENT = 99
+
+
+def parse_event(line: str) -> Optional[Dict[str, Any]]:
+    """Decode a callback event line, or return None for ordinary output"""
+    if not line.startswith(EVENT_PREFIX):
+        return None
+    try:
+        return json.loads(line[len(EVENT_PREFIX):])
+    except ValueError:
+        return None
+
+
+class AnsibleProgress:
+    """Folds callback events into the progress of one playbook run
+
+    The percent estimate compares the number of tasks started so far with
+    the number a previous run with the same tags started. Without history
+    it falls back to the position of the current role among the planned ones.
+    Each host also gets its own entry with the play, role and task it is
+    on, its result counts and whether it is running, done or failed, since
+    agents in a multi-node cluster are provisioned by a play of their own.
+    """
+
+    def __init__(self, expected_tasks: Optional[int] = None, roles: Optional[List[str]] = None):
+        self.expected_tasks = expected_tasks
+        self.roles = list(roles or [])
+        self.play: Optional[str] = None
+        self.role: Optional[str] = None
+        self.task: Optional[str] = None
+        self.host: Optional[str] = None
+        self.tasks_started = 0
+        self.counts = {status: 0 for status in RESULT_STATUSES}
+        self.recap: Optional[Dict[str, Dict[str, int]]] = None
+        self.hosts: Dict[str, Dict[str, Any]] = {}
+
+    def handle(self, event: Dict[str, Any]) -> bool:
+        """Apply an event; returns True when it moved the run to a new play, task or recap, or a host failed"""
+        kind = event.get('event')
+        if kind == 'play_start':
+            self.play = event.get('play')
+            return True
+        if kind == 'task_start':
+            self.tasks_started += 1
+            self.role = event.get('role')
+            self.task = event.get('task')
+            self.host = None
+            return True
+        if kind == 'host_start':
+            host = self._host(event.get('host'))
+            host.update(role=event.get('role'), task=event.get('task'))
+            return False
+        if kind == 'result':
+            status = event.get('status')
+            if status in self.counts:
+                self.counts[status] += 1
+            self.host = event.get('host')
+            host = self._host(self.host)
+            host.update(role=event.get('role'), task=event.get('task'))
+            if status in host['counts']:
+                host['counts'][status] += 1
+            if status in HOST_FAILURES:
+                host['status'] = status
+                return True
+            return False
+        if kind == 'recap':
+            self.recap = event.get('hosts', {})
+            for name, stats in self.recap.items():
+                host = self._host(name)
+                if host['status'] == 'running':
+                    host['status'] = 'failed' if stats.get('failures') or stats.get('unreachable') else 'completed'
+            return True
+        return False
+
+    def _host(self, name: str) -> Dict[str, Any]:
+        host = self.hosts.get(name)
+        if host is None:
+            host = self.hosts[name] = {'status': 'running', 'play': self.play, 'role': None, 'task': None,
+                                       'counts': {status: 0 for status in RESULT_STATUSES}}
+        elif host['status'] == 'running':
+            host['play'] = self.play
+        return host
+
+    @property
+    def percent(self) -> Optional[int]:
+        if self.recap is not None:
+            return 100
+        if self.expected_tasks:
+            return min(int(self.tasks_started * 100 / self.expected_tasks), MAX_RUNNING_PERCENT)
+        if self.role in self.roles:
+            return int(self.roles.index(self.role) * 100 / len(self.roles))
+        return None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'play': self.play,
+            'role': self.role,
+            'task': self.task,
+            'host': self.host,
+            'tasks_started': self.tasks_started,
+            'expected_tasks': self.expected_tasks,
+            'percent': self.percent,
+            'counts': dict(self.counts),
+            'recap': self.recap,
+            'hosts': {name: {**host, 'counts': dict(host['counts'])} for name, host in self.hosts.items()}
+        }
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Maps configuration changes to the Ansible roles and Terraform resources they affect
+"""
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Set
+
+# Stage 2 role tags, in playbook order; running all of them is a full deployment
+ALL_TAGS = ['system-prep', 'docker', 'registry-mirror', 'k3s', 'storage', 'load-balancer', 'kubelish', 'opentofu']
+
+# Terraform file declaring each service's resources
+SERVICE_TF_FILES = {
+    'portainer': 'portainer.tf',
+    'registry': 'registry.tf',
+    'registry_ui': 'registry-ui.tf',
+    'gitea': 'gitea.tf',
+}
+
+# Configuration fields -> role tags to run and services whose Terraform resources to target
+CONFIG_IMPACT: Dict[str, Dict[str, List[str]]] = {
+    'admin_password': {'tags': ['opentofu'], 'services': ['portainer']},
+    'network.pod_cidr': {'tags': ['k3s']},
+    'network.service_cidr': {'tags': ['k3s', 'load-balancer']},
+    'network.homelab_pool': {'tags': ['load-balancer']},
+    'network.user_pool': {'tags': ['load-balancer']},
+    'services.portainer': {'tags': ['opentofu'], 'services': ['portainer']},
+    'services.registry': {'tags': ['opentofu'], 'services': ['registry']},
+    'services.registry_ui': {'tags': ['opentofu'], 'services': ['registry_ui']},
+    'services.gitea': {'tags': ['opentofu'], 'services': ['gitea']},
+    'services.kubelish': {'tags': ['kubelish']},
+    'storage.portainer_size': {'tags': ['opentofu'], 'services': ['portainer']},
+    'storage.registry_size': {'tags': ['opentofu'], 'services': ['registry']},
+    'storage.gitea_size': {'tags': ['opentofu'], 'services': ['gitea']},
+    # Playbook tuning only changes how the next run executes, not what it deploys
+    'ansible.fact_caching': {'tags': []},
+    'ansible.fact_cache_timeout': {'tags': []},
+    'ansible.pipelining': {'tags': []},
+    'ansible.gathering': {'tags': []},
+    'ansible.gather_subset': {'tags': []},
+    'ansible.forks': {'tags': []},
+    'ansible.strategy': {'tags': []},
+    'opentofu.parallelism': {'tags': []},
+    # New agents need the base roles of the agent play; cluster services already span every node
+    'cluster.nodes': {'tags': ['system-prep', 'k3s']},
+    'cluster.agent_batch_size': {'tags': []},
+    'registry_mirror.enabled': {'tags': ['registry-mirror', 'k3s']},
+    'registry_mirror.upstreams': {'tags': ['registry-mirror', 'k3s']},
+}
+
+# Generated files (relative to the repo root) -> role tags; None means the whole playbook
+GENERATED_FILE_IMPACT: Dict[str, Optional[List[str]]] = {
+    'configs/user-config.yaml': None,
+    'configs/network-defaults.yaml': ['k3s', 'load-balancer'],
+    'ansible/vars/user-overrides.yml': None,
+    'ansible/ansible.cfg': [],
+    'ansible/inventory/hosts.yml': None,
+    'terraform/user.tfvars': ['opentofu'],
+}
+
+# Generated per-host variables; they follow cluster.nodes, which the config digest covers
+GENERATED_DIRS = ['ansible/inventory/host_vars']
+
+# Playbook files the sources digest covers; Ansible's own runtime files (callback
+# bytecode, *.retry files, fact caches) would otherwise look like source changes
+SOURCE_SUFFIXES = {'.yml', '.yaml', '.j2', '.py', '.cfg', '.tf', '.sh', '.conf', '.ini'}
+
+RESOURCE_PATTERN = re.compile(r'^resource\s+"([\w-]+)"\s+"([\w-]+)"', re.MULTILINE)
+
+
+def _digest(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def _flatten(config: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+    """Flatten nested config sections into dotted keys"""
+    flat = {}
+    for key, value in config.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{path}."))
+        else:
+            flat[path] = value
+    return flat
+
+
+class ChangePlanner:
+    """Decides how much of Stage 2 a redeploy has to run
+
+    The fingerprint of the last successfully applied deployment holds a
+    hash of every config field, of every generated file and of the
+    playbook/Terraform sources. A new deployment is compared against it
+    and only the affected role tags and Terraform targets are run.
+    """
+
+    def __init__(self, repo_root: Path):
+        self.repo_root = Path(repo_root)
+        self.ansible_dir = self.repo_root / "ansible"
+        self.terraform_dir = self.repo_root / "terraform"
+
+    def fingerprint(self, config: Dict[str, Any]) -> Dict[str, Any]:
+        """Hash the inputs of a deployment"""
+        return {
+            'config': {key: _digest(value) for key, value in _flatten(config).items()},
+            'files': {name: self._file_digest(self.repo_root / name) for name in GENERATED_FILE_IMPACT},
+            'sources': self._sources_digest()
+        }
+
+    def plan(self, config: Dict[str, Any], last_applied: Optional[Dict[str, Any]],
+             force_full: bool = False) -> Dict[str, Any]:
+        """Compare a deployment's inputs with the last applied ones
+
+        Returns the run ``mode`` ('full', 'incremental' or 'noop'), the Ansible
+        tags and Terraform targets to run, and the reasons behind them.
+        """
+        current = self.fingerprint(config)
+        plan = {'mode': 'full', 'ansible_tags': list(ALL_TAGS), 'terraform_targets': [],
+                'reasons': [], 'fingerprint': current}
+
+        if force_full:
+            plan['reasons'].append("Full deployment requested")
+            return plan
+        if not last_applied:
+            plan['reasons'].append("No previous successful deployment")
+            return plan
+        if current['sources'] != last_applied.get('sources'):
+            plan['reasons'].append("Playbook or Terraform sources changed")
+            return plan
+
+        tags: Set[str] = set()
+        services: Set[str] = set()
+        full_terraform = False
+
+        previous_config = last_applied.get('config', {})
+        for key in sorted(set(current['config']) | set(previous_config)):
+            if current['config'].get(key) == previous_config.get(key):
+                continue
+            impact = CONFIG_IMPACT.get(key)
+            if impact is None:
+                plan['reasons'].append(f"{key} changed and has no narrower mapping")
+                return plan
+            plan['reasons'].append(f"{key} changed")
+            tags.update(impact['tags'])
+            services.update(impact.get('services', []))
+
+        previous_files = last_applied.get('files', {})
+        for name, digest in current['files'].items():
+            if digest == previous_files.get(name):
+                continue
+            file_tags = GENERATED_FILE_IMPACT[name]
+            # Generated files normally change together with a config field handled above
+            if file_tags is None and not plan['reasons']:
+                plan['reasons'].append(f"{name} changed outside the web interface")
+                return plan
+            if file_tags is not None:
+                plan['reasons'].append(f"{name} changed")
+                tags.update(file_tags)
+                if 'opentofu' in file_tags and not services:
+                    full_terraform = True
+
+        if not tags:
+            plan.update(mode='noop', ansible_tags=[])
+            plan['reasons'].append("None of the changes affect deployed roles" if plan['reasons']
+                                   else "Nothing changed since the last successful deployment")
+            return plan
+
+        plan['mode'] = 'incremental'
+        plan['ansible_tags'] = [tag for tag in ALL_TAGS if tag in tags]
+        if 'opentofu' in tags and not full_terraform:
+            plan['terraform_targets'] = self.terraform_targets(services)
+        return plan
+
+    def terraform_targets(self, services: Set[str]) -> List[str]:
+        """Resource addresses declared in the services' Terraform files"""
+        targets = []
+        for service in sorted(services):
+            tf_file = self.terraform_dir / SERVICE_TF_FILES[service]
+            try:
+                source = tf_file.read_text()
+            except OSError:
+                continue
+            targets.extend(f"{kind}.{name}" for kind, name in RESOURCE_PATTERN.findall(source))
+        return targets
+
+    @staticmethod
+    def _file_digest(path: Path) -> Optional[str]:
+        try:
+            return hashlib.sha256(path.read_bytes()).hexdigest()
+        except OSError:
+            return None
+
+    def _sources_digest(self) -> str:
+        """Cheap digest of the playbook and Terraform sources, from file metadata"""
+        entries = []
+        generated = {self.repo_root / name for name in GENERATED_FILE_IMPACT}
+        generated_dirs = [self.repo_root / name for name in GENERATED_DIRS]
+        sources = [path for path in self.ansible_dir.rglob("*")
+                   if path.suffix in SOURCE_SUFFIXES and path.is_file()
+                   and not any(directory in path.parents for directory in generated_dirs)]
+        sources += list(self.terraform_dir.glob("*.tf"))
+        for path in sources:
+            if path in generated:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((str(path.relative_to(self.repo_root)), stat.st_mtime_ns, stat.st_size))
+        return _digest(sorted(entries))
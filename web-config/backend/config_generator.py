@@ -2,109 +2,214 @@
 """
 Configuration generator for Ansible and Terraform files
 """
+import asyncio
+import hashlib
 import os
-import yaml
+import stat
+import tempfile
 import json
 from pathlib import Path
-from typing import Dict, Any, List
-from jinja2 import Template
-import ipaddress
+from typing import Dict, Any, List, Optional, Tuple
+
+from config_validator import ConfigValidator, MIRROR_UPSTREAMS
+from metrics import REGISTRY
+
+CONFIG_GENERATION_DURATION = REGISTRY.histogram(
+    'homelab_config_generation_seconds', 'Time to render and write the generated configuration files')
+CONFIG_FILES_WRITTEN = REGISTRY.counter(
+    'homelab_config_files_written_total', 'Generated files rewritten because their content changed')
+
+# Stage 2 Ansible tuning used when a configuration has no ansible section
+ANSIBLE_DEFAULTS = {
+    'fact_caching': True,
+    'fact_cache_timeout': 86400,
+    'pipelining': True,
+    'gathering': 'smart',
+    'gather_subset': '!hardware',
+    'forks': 0,
+    'strategy': 'linear',
+}
+
+# Concurrent resource operations of OpenTofu plan and apply when not configured
+OPENTOFU_PARALLELISM = 10
+
+# Agents provisioned together per batch of the rolling agent play when not configured
+AGENT_BATCH_SIZE = 2
+
+# Each pull-through cache listens on this port plus its registry's position in MIRROR_UPSTREAMS
+MIRROR_BASE_PORT = 5001
+MIRROR_DEFAULTS = {'enabled': True, 'upstreams': ['docker.io', 'ghcr.io']}
+
+# Port of the in-cluster registry; matches registry_port in ansible/vars/main.yml
+LOCAL_REGISTRY_PORT = 5000
+
+# First line of generated host_vars files; files without it are never removed
+HOST_VARS_HEADER = "# Generated by web configuration interface\n"
+
+
+def _yaml_dump(data: Any, **options) -> str:
+    # Imported on first use; PyYAML is only needed once files are generated, not to start the service
+    import yaml
+
+    return yaml.dump(data, **options)
+
+
+def ansible_settings(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Ansible tuning of a configuration with defaults filled in and automatic forks resolved"""
+    settings = {**ANSIBLE_DEFAULTS, **(config.get('ansible') or {})}
+    if not settings['forks']:
+        # Workers mostly wait on the host; a couple per core keeps a Pi busy without swapping
+        settings['forks'] = min(max(2 * (os.cpu_count() or 1), 5), 20)
+    return settings
+
+
+def opentofu_parallelism(config: Dict[str, Any]) -> int:
+    """Concurrent resource operations of OpenTofu plan and apply"""
+    return (config.get('opentofu') or {}).get('parallelism', OPENTOFU_PARALLELISM)
+
+
+def cluster_nodes(config: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+    """The configured server node (None when this machine is the only node) and the agent nodes"""
+    nodes = (config.get('cluster') or {}).get('nodes') or []
+    server = next((node for node in nodes if node.get('role') == 'server'), None)
+    return server, [node for node in nodes if node.get('role') == 'agent']
+
+
+def agent_batch_size(config: Dict[str, Any]) -> int:
+    """Agents the rolling agent play provisions at the same time"""
+    return (config.get('cluster') or {}).get('agent_batch_size', AGENT_BATCH_SIZE)
+
+
+def registry_mirrors(config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Pull-through caches to run on the server, in MIRROR_UPSTREAMS order"""
+    settings = {**MIRROR_DEFAULTS, **(config.get('registry_mirror') or {})}
+    if not settings['enabled']:
+        return []
+    return [{'upstream': upstream, 'remote_url': remote_url, 'port': MIRROR_BASE_PORT + index}
+            for index, (upstream, remote_url) in enumerate(MIRROR_UPSTREAMS.items())
+            if upstream in settings['upstreams']]
+
+
+def k3s_registries(config: Dict[str, Any], registry_host: str) -> Dict[str, Any]:
+    """Content of a node's /etc/rancher/k3s/registries.yaml
+
+    Public registries go through the server's pull-through caches; k3s
+    falls back to the upstream itself when a cache does not answer.
+    """
+    local = f"localhost:{LOCAL_REGISTRY_PORT}"
+    mirrors = {mirror['upstream']: {'endpoint': [f"http://{registry_host}:{mirror['port']}"]}
+               for mirror in registry_mirrors(config)}
+    mirrors[local] = {'endpoint': [f"http://{registry_host}:{LOCAL_REGISTRY_PORT}"]}
+    return {'mirrors': mirrors, 'configs': {local: {'tls': {'insecure_skip_verify': True}}}}
+
 
 class ConfigGenerator:
     def __init__(self):
         # When running from /opt/homelab, use that as the repo root
-        self.repo_root = Path("/opt/homelab")
+        self.repo_root = Path(os.getenv('HOMELAB_HOME', '/opt/homelab'))
         self.ansible_dir = self.repo_root / "ansible"
+        self.host_vars_dir = self.ansible_dir / "inventory" / "host_vars"
         self.terraform_dir = self.repo_root / "terraform"
         self.configs_dir = self.repo_root / "configs"
+        self.fact_cache_dir = self.repo_root / "state" / "ansible-facts"
+        self.validator = ConfigValidator()
 
     def validate_config(self, config: Dict[str, Any]) -> List[str]:
         """Validate configuration and return list of errors"""
-        errors = []
+        return self.validator.validate(config)
 
-        # Validate password
-        if len(config.get('admin_password', '')) < 8:
-            errors.append("Admin password must be at least 8 characters")
+    async def generate_files(self, config: Dict[str, Any]) -> Dict[str, List[str]]:
+        """Generate configuration files from user input
 
-        # Validate network CIDRs
-        network = config.get('network', {})
+        Returns the paths of all generated files and of the ones whose
+        content actually changed; unchanged files are left untouched.
+        """
         try:
-            pod_cidr = ipaddress.ip_network(network.get('pod_cidr', ''))
-            service_cidr = ipaddress.ip_network(network.get('service_cidr', ''))
-            homelab_pool = ipaddress.ip_network(network.get('homelab_pool', ''))
-            user_pool = ipaddress.ip_network(network.get('user_pool', ''))
-
-            # Check for overlaps
-            if pod_cidr.overlaps(service_cidr):
-                errors.append("Pod CIDR and Service CIDR cannot overlap")
-
-            if not service_cidr.supernet_of(homelab_pool):
-                errors.append("Homelab pool must be within Service CIDR")
-
-            if not service_cidr.supernet_of(user_pool):
-                errors.append("User pool must be within Service CIDR")
+            # Rendering and file I/O are blocking, keep them off the event loop
+            with CONFIG_GENERATION_DURATION.time():
+                result = await asyncio.to_thread(self._write_files, config)
+            CONFIG_FILES_WRITTEN.inc(len(result['changed']))
+            return result
+        except Exception as e:
+            raise Exception(f"Failed to generate configuration files: {str(e)}")
 
-            if homelab_pool.overlaps(user_pool):
-                errors.append("Homelab pool and User pool cannot overlap")
+    def _write_files(self, config: Dict[str, Any]) -> Dict[str, List[str]]:
+        """Render every file and write the ones that differ from what's on disk"""
+        rendered = {
+            self.configs_dir / "user-config.yaml": self._render_user_config(config),
+            self.configs_dir / "network-defaults.yaml": self._render_network_config(config['network']),
+            self.ansible_dir / "vars" / "user-overrides.yml": self._render_ansible_vars(config),
+            self.ansible_dir / "ansible.cfg": self._render_ansible_cfg(config),
+            self.ansible_dir / "inventory" / "hosts.yml": self._render_inventory(config),
+            self.terraform_dir / "user.tfvars": self._render_terraform_vars(config),
+        }
+        for host, host_vars in self._host_vars(config).items():
+            rendered[self.host_vars_dir / f"{host}.yml"] = (
+                "---\n" + HOST_VARS_HEADER + "\n" + _yaml_dump(host_vars, default_flow_style=False))
 
-        except ValueError as e:
-            errors.append(f"Invalid network configuration: {str(e)}")
+        generated_files, changed_files = [], []
+        for path, content in rendered.items():
+            if self._write_if_changed(path, content):
+                changed_files.append(str(path))
+            generated_files.append(str(path))
 
-        # Validate storage sizes
-        storage = config.get('storage', {})
-        for key, value in storage.items():
-            if not self._validate_storage_size(value):
-                errors.append(f"Invalid storage size for {key}: {value}")
+        # Nodes removed from the cluster leave their generated host_vars behind otherwise
+        for path in self._stale_host_vars(set(rendered)):
+            path.unlink()
+            changed_files.append(str(path))
 
-        return errors
+        return {'generated': generated_files, 'changed': changed_files}
 
-    def _validate_storage_size(self, size: str) -> bool:
-        """Validate Kubernetes storage size format"""
-        import re
-        pattern = r'^\d+(\.\d+)?(Ei|Pi|Ti|Gi|Mi|Ki|E|P|T|G|M|K)$'
-        return bool(re.match(pattern, size))
+    def _stale_host_vars(self, rendered: set) -> List[Path]:
+        stale = []
+        for path in self.host_vars_dir.glob("*.yml"):
+            if path in rendered:
+                continue
+            with open(path) as f:
+                f.readline()
+                if f.readline() == HOST_VARS_HEADER:
+                    stale.append(path)
+        return stale
 
-    async def generate_files(self, config: Dict[str, Any]) -> List[str]:
-        """Generate configuration files from user input"""
-        generated_files = []
+    @staticmethod
+    def _write_if_changed(path: Path, content: str) -> bool:
+        """Atomically replace a file unless it already has this content"""
+        data = content.encode()
+        try:
+            if hashlib.sha256(path.read_bytes()).digest() == hashlib.sha256(data).digest():
+                return False
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o644
 
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
         try:
-            # Ensure directories exist
-            self.configs_dir.mkdir(parents=True, exist_ok=True)
-            (self.ansible_dir / "vars").mkdir(parents=True, exist_ok=True)
-
-            # Generate user config file
-            user_config_path = self.configs_dir / "user-config.yaml"
-            with open(user_config_path, 'w') as f:
-                yaml.dump({
-                    'deployment': {
-                        'admin_password': config['admin_password'],
-                        'services': config['services']
-                    },
-                    'network': config['network'],
-                    'storage': config['storage']
-                }, f, default_flow_style=False)
-            generated_files.append(str(user_config_path))
-
-            # Generate network configuration
-            await self._generate_network_config(config['network'])
-            generated_files.append(str(self.configs_dir / "network-defaults.yaml"))
-
-            # Generate Ansible variables override
-            await self._generate_ansible_vars(config)
-            generated_files.append(str(self.ansible_dir / "vars" / "user-overrides.yml"))
-
-            # Generate Terraform variables
-            await self._generate_terraform_vars(config)
-            generated_files.append(str(self.terraform_dir / "user.tfvars"))
-
-            return generated_files
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, mode)
+            # Readers see either the old file or the new one, never a partial write
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return True
 
-        except Exception as e:
-            raise Exception(f"Failed to generate configuration files: {str(e)}")
+    def _render_user_config(self, config: Dict[str, Any]) -> str:
+        """Render the user config file"""
+        return _yaml_dump({
+            'deployment': {
+                'admin_password': config['admin_password'],
+                'services': config['services']
+            },
+            'network': config['network'],
+            'storage': config['storage']
+        }, default_flow_style=False)
 
-    async def _generate_network_config(self, network_config: Dict[str, Any]):
-        """Generate network configuration file"""
+    def _render_network_config(self, network_config: Dict[str, Any]) -> str:
+        """Render the network configuration file"""
         network_config_template = {
             'homelab': {
                 'network': {
@@ -126,16 +231,18 @@ class ConfigGenerator:
             }
         }
 
-        with open(self.configs_dir / "network-defaults.yaml", 'w') as f:
-            yaml.dump(network_config_template, f, default_flow_style=False)
+        return _yaml_dump(network_config_template, default_flow_style=False)
 
-    async def _generate_ansible_vars(self, config: Dict[str, Any]):
-        """Generate Ansible variables override file"""
+    def _render_ansible_vars(self, config: Dict[str, Any]) -> str:
+        """Render the Ansible variables override file"""
         ansible_vars = {
             'portainer_admin_password': config['admin_password'],
             'portainer_storage_size': config['storage']['portainer_size'],
             'registry_storage_size': config['storage']['registry_size'],
-            'gitea_storage_size': config['storage'].get('gitea_size', '10Gi')
+            'gitea_storage_size': config['storage'].get('gitea_size', '10Gi'),
+            'opentofu_parallelism': opentofu_parallelism(config),
+            'agent_batch_size': agent_batch_size(config),
+            'registry_mirrors': registry_mirrors(config)
         }
 
         # Add service-specific variables based on selection
@@ -151,14 +258,90 @@ class ConfigGenerator:
         if not services.get('gitea', False):
             ansible_vars['skip_gitea'] = True
 
-        with open(self.ansible_dir / "vars" / "user-overrides.yml", 'w') as f:
-            f.write("---\n")
-            f.write("# User configuration overrides\n")
-            f.write("# Generated by web configuration interface\n\n")
-            yaml.dump(ansible_vars, f, default_flow_style=False)
+        return (
+            "---\n"
+            "# User configuration overrides\n"
+            "# Generated by web configuration interface\n\n"
+            + _yaml_dump(ansible_vars, default_flow_style=False)
+        )
+
+    def _render_ansible_cfg(self, config: Dict[str, Any]) -> str:
+        """Render the managed ansible.cfg used by the Stage 2 playbook"""
+        settings = ansible_settings(config)
+        lines = [
+            "# Managed by web configuration interface; local changes are overwritten",
+            "",
+            "[defaults]",
+            "inventory = inventory/hosts.yml",
+            f"forks = {settings['forks']}",
+            f"strategy = {settings['strategy']}",
+            f"gathering = {settings['gathering']}",
+            f"gather_subset = {settings['gather_subset']}",
+        ]
+        if settings['fact_caching']:
+            # Kept outside the ansible directory, whose contents are hashed for change detection
+            lines += [
+                "fact_caching = jsonfile",
+                f"fact_caching_connection = {self.fact_cache_dir}",
+                f"fact_caching_timeout = {settings['fact_cache_timeout']}",
+            ]
+        else:
+            lines.append("fact_caching = memory")
+
+        pipelining = str(bool(settings['pipelining']))
+        lines += ["", "[connection]", f"pipelining = {pipelining}",
+                  "", "[ssh_connection]", f"pipelining = {pipelining}"]
+        return "\n".join(lines) + "\n"
+
+    def _render_inventory(self, config: Dict[str, Any]) -> str:
+        """Render the inventory: this machine as the k3s server, configured agents reached over SSH"""
+        _, agents = cluster_nodes(config)
+        server_host = {
+            'ansible_connection': 'local',
+            'ansible_become': True,
+            'admin_user': 'homelab',
+            'homelab_user': 'homelab',
+            'homelab_home': str(self.repo_root),
+        }
+        agent_hosts = {}
+        for node in agents:
+            host = {
+                'ansible_host': node['address'],
+                'ansible_user': node.get('ssh_user', 'homelab'),
+                'ansible_port': node.get('ssh_port', 22),
+                'ansible_become': True,
+            }
+            if node.get('ssh_key_file'):
+                host['ansible_ssh_private_key_file'] = node['ssh_key_file']
+            agent_hosts[node['name']] = host
+
+        inventory = {'homelab': {'children': {
+            'k3s_server': {'hosts': {'localhost': server_host}},
+            'k3s_agents': {'hosts': agent_hosts} if agent_hosts else {},
+        }}}
+        return (
+            "---\n"
+            "# Managed by web configuration interface; local changes are overwritten\n\n"
+            + _yaml_dump(inventory, default_flow_style=False, sort_keys=False)
+        )
+
+    def _host_vars(self, config: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """Per-host variables of every inventory host, keyed by inventory name"""
+        server, agents = cluster_nodes(config)
+        host_vars = {'localhost': {'k3s_role': 'server', 'k3s_registries': k3s_registries(config, 'localhost')}}
+        for node in agents:
+            host_vars[node['name']] = {
+                'k3s_role': 'agent',
+                'k3s_node_name': node['name'],
+                'k3s_server_url': f"https://{server['address']}:6443",
+                # The registry and its mirrors run on the server; agents pull through its address
+                'k3s_registry_host': server['address'],
+                'k3s_registries': k3s_registries(config, server['address']),
+            }
+        return host_vars
 
-    async def _generate_terraform_vars(self, config: Dict[str, Any]):
-        """Generate Terraform variables file"""
+    def _render_terraform_vars(self, config: Dict[str, Any]) -> str:
+        """Render the Terraform variables file"""
         terraform_vars = {
             'portainer_admin_password': config['admin_password'],
             'portainer_storage_size': config['storage']['portainer_size'],
@@ -184,8 +367,9 @@ class ConfigGenerator:
             else:
                 tfvars_content.append(f'{key} = {value}')
 
-        with open(self.terraform_dir / "user.tfvars", 'w') as f:
-            f.write("# User configuration variables\n")
-            f.write("# Generated by web configuration interface\n\n")
-            f.write("\n".join(tfvars_content))
-            f.write("\n")
\ No newline at end of file
+        return (
+            "# User configuration variables\n"
+            "# Generated by web configuration interface\n\n"
+            + "\n".join(tfvars_content)
+            + "\n"
+        )
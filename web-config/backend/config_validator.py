@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Validation rules for home lab configurations
+"""
+import ipaddress
+import re
+from functools import lru_cache
+from typing import Dict, Any, List, Tuple, Union
+
+STORAGE_SIZE_PATTERN = re.compile(r'^\d+(\.\d+)?(Ei|Pi|Ti|Gi|Mi|Ki|E|P|T|G|M|K)$')
+
+MIN_PASSWORD_LENGTH = 8
+
+# Network fields, in the order they appear in error messages
+NETWORK_LABELS = {
+    'pod_cidr': 'Pod CIDR',
+    'service_cidr': 'Service CIDR',
+    'homelab_pool': 'Homelab pool',
+    'user_pool': 'User pool',
+}
+
+# Load balancer pools are carved out of the service CIDR; every other pair of
+# network ranges must not share any address
+CONTAINED_IN = {
+    'homelab_pool': 'service_cidr',
+    'user_pool': 'service_cidr',
+}
+
+# Accepted values of the Stage 2 Ansible tuning options
+ANSIBLE_STRATEGIES = ('linear', 'free', 'host_pinned')
+GATHERING_MODES = ('smart', 'implicit', 'explicit')
+MAX_FORKS = 100
+
+MAX_OPENTOFU_PARALLELISM = 256
+
+# Public registries a pull-through cache can be run for, with the URL the cache pulls from
+MIRROR_UPSTREAMS = {
+    'docker.io': 'https://registry-1.docker.io',
+    'ghcr.io': 'https://ghcr.io',
+    'quay.io': 'https://quay.io',
+    'registry.k8s.io': 'https://registry.k8s.io',
+}
+
+NODE_ROLES = ('server', 'agent')
+
+# Node names become inventory hostnames, host_vars file names and k3s node names
+NODE_NAME_PATTERN = re.compile(r'^[a-z0-9]([a-z0-9.-]{0,61}[a-z0-9])?$')
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+@lru_cache(maxsize=4096)
+def parse_network(cidr: str) -> Network:
+    """Parse a CIDR once; repeated layouts reuse the parsed network"""
+    return ipaddress.ip_network(cidr)
+
+
+def find_overlaps(ranges: Dict[str, Network]) -> List[Tuple[str, str]]:
+    """Return every pair of named ranges that overlap, using a sorted sweep
+
+    Ranges are sorted by start address; each one is only compared with the
+    ranges still open at its start, instead of with every other range.
+    """
+    ordered = sorted(ranges.items(), key=lambda item: (
+        item[1].version, int(item[1].network_address), int(item[1].broadcast_address)
+    ))
+    overlaps, open_ranges = [], []
+    for name, network in ordered:
+        start = int(network.network_address)
+        open_ranges = [(other, end, version) for other, end, version in open_ranges
+                       if version == network.version and end >= start]
+        overlaps.extend((other, name) for other, _, _ in open_ranges)
+        open_ranges.append((name, int(network.broadcast_address), network.version))
+    return overlaps
+
+
+@lru_cache(maxsize=1024)
+def _network_errors(pod_cidr: str, service_cidr: str, homelab_pool: str, user_pool: str) -> Tuple[str, ...]:
+    """Check a network layout; cached since batches tend to repeat layouts"""
+    cidrs = {'pod_cidr': pod_cidr, 'service_cidr': service_cidr,
+             'homelab_pool': homelab_pool, 'user_pool': user_pool}
+    try:
+        networks = {field: parse_network(cidr) for field, cidr in cidrs.items()}
+    except ValueError as e:
+        return (f"Invalid network configuration: {str(e)}",)
+
+    order = list(NETWORK_LABELS).index
+    overlaps = sorted((sorted(pair, key=order) for pair in find_overlaps(networks)),
+                      key=lambda pair: (order(pair[0]), order(pair[1])))
+    errors = [f"{NETWORK_LABELS[first]} and {NETWORK_LABELS[second]} cannot overlap"
+              for first, second in overlaps
+              if CONTAINED_IN.get(first) != second and CONTAINED_IN.get(second) != first]
+
+    for field, parent in CONTAINED_IN.items():
+        child, container = networks[field], networks[parent]
+        if child.version != container.version or not container.supernet_of(child):
+            errors.append(f"{NETWORK_LABELS[field]} must be within {NETWORK_LABELS[parent]}")
+
+    return tuple(errors)
+
+
+class ConfigValidator:
+    """Checks a configuration beyond what the request models enforce"""
+
+    def validate(self, config: Dict[str, Any]) -> List[str]:
+        """Validate configuration and return list of errors"""
+        errors = []
+
+        if len(config.get('admin_password', '')) < MIN_PASSWORD_LENGTH:
+            errors.append(f"Admin password must be at least {MIN_PASSWORD_LENGTH} characters")
+
+        network = config.get('network', {})
+        errors.extend(_network_errors(*(str(network.get(field, '')) for field in NETWORK_LABELS)))
+
+        for key, value in config.get('storage', {}).items():
+            if not isinstance(value, str) or not STORAGE_SIZE_PATTERN.match(value):
+                errors.append(f"Invalid storage size for {key}: {value}")
+
+        errors.extend(self._ansible_errors(config.get('ansible') or {}))
+
+        parallelism = (config.get('opentofu') or {}).get('parallelism', 1)
+        if not isinstance(parallelism, int) or not 1 <= parallelism <= MAX_OPENTOFU_PARALLELISM:
+            errors.append(f"OpenTofu parallelism must be between 1 and {MAX_OPENTOFU_PARALLELISM}")
+
+        errors.extend(self._cluster_errors(config.get('cluster') or {}))
+
+        upstreams = (config.get('registry_mirror') or {}).get('upstreams') or []
+        for upstream in upstreams:
+            if upstream not in MIRROR_UPSTREAMS:
+                errors.append(f"No registry mirror for {upstream}; supported: {', '.join(MIRROR_UPSTREAMS)}")
+
+        return errors
+
+    @staticmethod
+    def _cluster_errors(cluster: Dict[str, Any]) -> List[str]:
+        """Check the node list; no nodes means this machine is a single-node cluster"""
+        errors = []
+        nodes = cluster.get('nodes') or []
+        names = [node.get('name', '') for node in nodes]
+        for name in sorted({name for name in names if names.count(name) > 1}):
+            errors.append(f"Duplicate cluster node name: {name}")
+        for node in nodes:
+            name = node.get('name', '')
+            if not NODE_NAME_PATTERN.match(name) or name == 'localhost':
+                errors.append(f"Invalid cluster node name: {name!r}")
+            if node.get('role') not in NODE_ROLES:
+                errors.append(f"Cluster node {name} must have role {' or '.join(NODE_ROLES)}")
+            if not str(node.get('address', '')).strip():
+                errors.append(f"Cluster node {name} needs an address")
+            port = node.get('ssh_port', 22)
+            if not isinstance(port, int) or not 1 <= port <= 65535:
+                errors.append(f"Cluster node {name} has an invalid SSH port: {port}")
+        if nodes and sum(1 for node in nodes if node.get('role') == 'server') != 1:
+            errors.append("A cluster with nodes needs exactly one server node, the machine running this interface")
+
+        batch_size = cluster.get('agent_batch_size', 1)
+        if not isinstance(batch_size, int) or batch_size < 1:
+            errors.append("Agent batch size must be at least 1")
+        return errors
+
+    @staticmethod
+    def _ansible_errors(ansible: Dict[str, Any]) -> List[str]:
+        """Check the Stage 2 Ansible tuning; missing options fall back to defaults"""
+        errors = []
+        if ansible.get('strategy', 'linear') not in ANSIBLE_STRATEGIES:
+            errors.append(f"Ansible strategy must be one of {', '.join(ANSIBLE_STRATEGIES)}")
+        if ansible.get('gathering', 'smart') not in GATHERING_MODES:
+            errors.append(f"Ansible fact gathering must be one of {', '.join(GATHERING_MODES)}")
+        forks = ansible.get('forks', 0)
+        if not isinstance(forks, int) or not 0 <= forks <= MAX_FORKS:
+            errors.append(f"Ansible forks must be between 0 (automatic) and {MAX_FORKS}")
+        timeout = ansible.get('fact_cache_timeout', 0)
+        if not isinstance(timeout, int) or timeout < 0:
+            errors.append("Ansible fact cache timeout must be a non-negative number of seconds")
+        if not re.fullmatch(r'!?\w+(,!?\w+)*', str(ansible.get('gather_subset', 'all'))):
+            errors.append(f"Invalid Ansible gather subset: {ansible.get('gather_subset')}")
+        return errors
@@ -4,99 +4,635 @@ Deployment manager for handling Ansible/Terraform execution
 """
 import os
 import asyncio
-import subprocess
+import time
 import uuid
 import json
+from collections import deque
+from itertools import islice
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Awaitable, Callable, Dict, Any, Iterator, List, Optional, Set
 from datetime import datetime
 
+from deployment_store import DeploymentStore
+from process_runner import run_process, ProcessResult, SUDO_COMMAND, TERMINATE_GRACE_PERIOD
+from toolchain import ToolchainResolver
+from kube_watcher import ReadinessWatcher, KubeError, RolloutError
+from scheduler import DeploymentScheduler
+from step_graph import Step, StepGraph, graph_summary
+from config_generator import ansible_settings, cluster_nodes, agent_batch_size
+from change_planner import ChangePlanner
+from image_prefetch import ImagePrefetcher, service_images, RUNTIME_POLL_INTERVAL
+from ansible_progress import AnsibleProgress, parse_event, CALLBACK_NAME
+from task_profiler import TaskTimer, read_tofu_timings, build_profile
+from log_spool import line_matcher, DEFAULT_PAGE_LINES
+from metrics import REGISTRY, LONG_BUCKETS
+
+# Messages buffered per log subscriber before the oldest ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+# Log entries returned by a status query that does not pass a cursor
+STATUS_LOG_TAIL = 50
+
+# Most log entries one status query returns after a cursor; the client continues from last_seq
+STATUS_LOG_PAGE = 500
+
+# Newest log lines of a running deployment kept in memory, which status queries and
+# new subscribers are served from; a client further behind reads from the store
+RECENT_LOG_LINES = 2000
+
+# Upper bound for the long-poll wait of a status query, in seconds
+MAX_STATUS_WAIT = 60
+
+# Playbook progress is stored and pushed at most this often, in seconds; bursts of events are coalesced
+PROGRESS_PUBLISH_INTERVAL = 0.25
+
+# Long-polling status requests are woken for new log lines at most this often, in seconds;
+# status changes still wake them immediately
+LOG_NOTIFY_INTERVAL = 0.2
+
+TERMINAL_STATUSES = ('completed', 'failed', 'interrupted', 'cancelled')
+
+# Root of the home lab checkout; overridden to run against a scratch tree (e.g. benchmarks)
+HOMELAB_HOME = os.getenv('HOMELAB_HOME', '/opt/homelab')
+
+# Deployments allowed to run at the same time; the rest wait in a FIFO queue
+MAX_CONCURRENT_DEPLOYMENTS = int(os.getenv('HOMELAB_MAX_CONCURRENT_DEPLOYMENTS', '1'))
+
+# Locks for on-disk state that only one run may use at a time
+ANSIBLE_RESOURCE = 'ansible'
+TERRAFORM_RESOURCE = 'terraform'
+
+# Kubernetes workloads (kind, namespace, name) behind each optional service
+SERVICE_WORKLOADS = {
+    'portainer': ('deployment', 'default', 'portainer'),
+    'registry': ('deployment', 'default', 'registry'),
+    'registry_ui': ('deployment', 'default', 'registry-ui'),
+    'gitea': ('deployment', 'default', 'gitea'),
+}
+
+# Services that run on the host as systemd units rather than in the cluster
+SERVICE_UNITS = {
+    'kubelish': 'kubelish',
+}
+
+# Seconds to wait for a service's rollout during verification
+ROLLOUT_TIMEOUT = 300
+
+# Deployments with recorded task timings considered by the profiler by default
+PROFILE_RUNS = 20
+
+# Default timeout for commands whose output is captured rather than streamed
+COMMAND_TIMEOUT = 300
+
+# Seconds each step may run before it is stopped and the deployment fails; `verify-*` covers
+# the per-service probes. Overridden through the step_time_budgets setting.
+STEP_TIME_BUDGETS = {
+    'prepare': 120,
+    'toolchain': 120,
+    'collections': 900,
+    'plan': 60,
+    'ansible': 5400,
+    'prefetch': 5400,
+    'verify': 600,
+    'verify-*': ROLLOUT_TIMEOUT + 60,
+}
+
+# Longest a cancel request waits for the deployment's commands to be stopped
+CANCEL_WAIT = 2 * TERMINATE_GRACE_PERIOD + 5
+
+DEPLOYMENT_DURATION = REGISTRY.histogram(
+    'homelab_deployment_duration_seconds', 'Deployment run time, excluding queueing', ('status',),
+    buckets=LONG_BUCKETS)
+STEP_DURATION = REGISTRY.histogram(
+    'homelab_deployment_step_duration_seconds', 'Deployment step run time', ('step', 'status'),
+    buckets=(0.1, 0.5) + LONG_BUCKETS)
+LOG_LINES = REGISTRY.counter('homelab_deployment_log_lines_total', 'Log lines ingested by deployments')
+MESSAGES_DROPPED = REGISTRY.counter(
+    'homelab_subscriber_messages_dropped_total', 'Messages discarded because a subscriber fell behind')
+DEPLOYMENTS_QUEUED = REGISTRY.gauge('homelab_deployments_queued', 'Deployments waiting for a slot')
+DEPLOYMENTS_RUNNING = REGISTRY.gauge('homelab_deployments_running', 'Deployments currently running')
+PREFETCH_BYTES = REGISTRY.counter(
+    'homelab_image_prefetch_bytes_total', 'Image bytes pulled ahead of the services being deployed')
+PREFETCH_SAVED = REGISTRY.histogram(
+    'homelab_image_prefetch_saved_seconds', 'Image pull time moved off the critical path per deployment',
+    buckets=(0.1, 0.5) + LONG_BUCKETS)
+SERVICE_READY = REGISTRY.histogram(
+    'homelab_service_ready_seconds', 'Time from verification start until a service\'s workload was ready',
+    ('service',), buckets=(0.1, 0.5) + LONG_BUCKETS)
+
+
+class StepTimeoutError(Exception):
+    """Raised when a deployment step runs past its time budget"""
+
+
+def offer_latest(queue: asyncio.Queue, message: Dict[str, Any]) -> bool:
+    """Put a message on a bounded queue without blocking, dropping the oldest if full.
+
+    The final status message of a deployment is never the one dropped, so a
+    subscriber always learns how it ended; clients refill dropped log lines
+    from the status API. Returns False when an older message had to be
+    discarded to make room.
+    """
+    try:
+        queue.put_nowait(message)
+        return True
+    except asyncio.QueueFull:
+        pending = [queue.get_nowait() for _ in range(queue.qsize())]
+        droppable = next((index for index, queued in enumerate(pending) if not _is_final_status(queued)), 0)
+        del pending[droppable]
+        for queued in pending + [message]:
+            queue.put_nowait(queued)
+        return False
+
+
+def _is_final_status(message: Dict[str, Any]) -> bool:
+    return message.get('type') == 'status' and message['status'].get('status') in TERMINAL_STATUSES
+
+
 class DeploymentManager:
-    def __init__(self):
+    def __init__(self, store: Optional[DeploymentStore] = None,
+                 toolchain: Optional[ToolchainResolver] = None,
+                 scheduler: Optional[DeploymentScheduler] = None,
+                 kube: Optional[ReadinessWatcher] = None,
+                 prefetcher: Optional[ImagePrefetcher] = None):
         # When running from /opt/homelab, use that as the repo root
-        self.repo_root = Path("/opt/homelab")
-        self.ansible_dir = f"{self.repo_root}/ansible"
-        self.terraform_dir = f"{self.repo_root}/terraform"
-        self.deployments = {}  # In-memory storage, could be replaced with database
-
-    async def start_deployment(self, config: Dict[str, Any]) -> str:
-        """Start a new deployment process"""
+        self.repo_root = Path(HOMELAB_HOME)
+        self.ansible_dir = self.repo_root / "ansible"
+        self.terraform_dir = self.repo_root / "terraform"
+        # Written by the opentofu role: one OpenTofu -json UI event per line
+        self.tofu_events_file = self.repo_root / "logs" / "tofu-apply.jsonl"
+
+        # Durable state (deployments, steps, logs) lives in SQLite; override the location for development
+        if store is None:
+            db_path = os.getenv('HOMELAB_STATE_DB', str(self.repo_root / "state" / "deployments.db"))
+            store = DeploymentStore(Path(db_path))
+        self.store = store
+        self.interrupted = self.store.recover_interrupted()
+        self.toolchain = toolchain or ToolchainResolver()
+        self.kube = kube or ReadinessWatcher()
+        self.prefetcher = prefetcher or ImagePrefetcher()
+        self.scheduler = scheduler or DeploymentScheduler(MAX_CONCURRENT_DEPLOYMENTS)
+        self.scheduler.on_queue_change = self._queue_changed
+        DEPLOYMENTS_QUEUED.set_function(lambda: len(self.scheduler.waiting))
+        DEPLOYMENTS_RUNNING.set_function(lambda: len(self.scheduler.running))
+        self.planner = ChangePlanner(self.repo_root)
+
+        # Runtime state of deployments started by this process
+        self.deployments: Dict[str, Dict[str, Any]] = {}
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    async def start_deployment(self, config: Dict[str, Any], force_full: bool = False) -> str:
+        """Start a new deployment process
+
+        Unless ``force_full`` is set, only the parts of Stage 2 affected by
+        changes since the last successful deployment are run.
+        """
         deployment_id = str(uuid.uuid4())
-
-        deployment_info = {
-            'id': deployment_id,
-            'status': 'starting',
-            'config': config,
-            'started_at': datetime.now().isoformat(),
+        started_at = datetime.now().isoformat()
+        self.store.create_deployment(deployment_id, 'queued', config, started_at)
+
+        self.deployments[deployment_id] = {
+            'status': 'queued',
+            # The deployment row and its steps as last written, kept here so status
+            # queries for a running deployment never touch the database
+            'record': {'status': 'queued', 'current_step': None, 'started_at': started_at, 'finished_at': None,
+                       'error': None, 'change_plan': None, 'ansible_progress': None, 'image_prefetch': None},
             'steps': [],
-            'current_step': None,
-            'logs': []
+            # Status summary built from the above, dropped whenever one of them changes
+            'summary': None,
+            'recent_logs': deque(maxlen=RECENT_LOG_LINES),
+            'config': config,
+            'force_full': force_full,
+            'plan': None,
+            'progress': None,
+            # Set once the playbook has exited; image pre-fetching is pointless after that
+            'playbook_done': asyncio.Event(),
+            # Monotonic time the opentofu role started creating the service pods
+            'apply_started': None,
+            'next_seq': 1,
+            'version': 0,
+            'changed': asyncio.Event(),
+            'last_notified': 0.0,
+            # Pending wake-up for log lines that arrived within LOG_NOTIFY_INTERVAL of the last one
+            'notify_handle': None
         }
 
-        self.deployments[deployment_id] = deployment_info
+        # Take a queue position now so the status API reports it right away
+        self.scheduler.enqueue(deployment_id)
 
-        # Start deployment in background
-        asyncio.create_task(self._run_deployment(deployment_id))
+        # Start deployment in background; it runs once the scheduler admits it
+        self.deployments[deployment_id]['task'] = asyncio.create_task(self._run_deployment(deployment_id))
 
         return deployment_id
 
-    async def get_status(self, deployment_id: str) -> Dict[str, Any]:
-        """Get current deployment status"""
-        if deployment_id not in self.deployments:
+    async def cancel_deployment(self, deployment_id: str) -> Dict[str, Any]:
+        """Stop a queued or running deployment and kill the commands it started
+
+        Waits up to CANCEL_WAIT seconds for the deployment to wind down and
+        returns its status.
+        """
+        deployment = self.deployments.get(deployment_id)
+        if deployment is None or deployment['status'] in TERMINAL_STATUSES:
+            if deployment is None and self.store.get_deployment(deployment_id) is None:
+                raise Exception(f"Deployment {deployment_id} not found")
+            raise Exception(f"Deployment {deployment_id} has already finished")
+
+        task = deployment['task']
+        if not deployment.get('cancel_requested'):
+            deployment['cancel_requested'] = True
+            await self._add_log(deployment_id, "🛑 Cancellation requested, stopping running commands...")
+            task.cancel()
+        await asyncio.wait({task}, timeout=CANCEL_WAIT)
+        return self._status_summary(deployment_id)
+
+    def get_step_budgets(self) -> Dict[str, float]:
+        """Time budget of each step in seconds, with saved overrides applied"""
+        return {**STEP_TIME_BUDGETS, **self.store.get_setting('step_time_budgets', {})}
+
+    def set_step_budgets(self, budgets: Dict[str, float]) -> Dict[str, float]:
+        """Override the time budgets of some steps; applies to deployments started afterwards"""
+        for key, seconds in budgets.items():
+            if key not in STEP_TIME_BUDGETS:
+                raise Exception(f"Unknown step {key}; expected one of {', '.join(STEP_TIME_BUDGETS)}")
+            if seconds <= 0:
+                raise Exception(f"Time budget of {key} must be positive")
+        overrides = {**self.store.get_setting('step_time_budgets', {}), **budgets}
+        self.store.set_setting('step_time_budgets', overrides)
+        return self.get_step_budgets()
+
+    async def get_status(self, deployment_id: str, since: Optional[int] = None,
+                         wait: float = 0) -> Dict[str, Any]:
+        """Get current deployment status
+
+        Without ``since`` the last STATUS_LOG_TAIL log lines are returned; with
+        it, only entries whose sequence number is greater than ``since``. When
+        ``wait`` is given and there is nothing newer than ``since``, the call
+        holds for up to ``wait`` seconds until a log line or status change arrives.
+        """
+        deployment = self.deployments.get(deployment_id)
+        if deployment is not None and wait > 0 and deployment['status'] not in TERMINAL_STATUSES:
+            last_seq = deployment['next_seq'] - 1
+            if since is None or since >= last_seq:
+                changed = deployment['changed']
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=min(wait, MAX_STATUS_WAIT))
+                except asyncio.TimeoutError:
+                    pass
+
+        status = self._status_summary(deployment_id)
+        status.update(self._log_window(deployment_id, since))
+        return status
+
+    def get_version(self, deployment_id: str) -> str:
+        """Return a token that changes whenever the deployment's status or logs change"""
+        deployment = self.deployments.get(deployment_id)
+        if deployment is not None:
+            # Log lines count straight away, even while their wake-up is being coalesced
+            return f"{deployment['version']}-{deployment['next_seq'] - 1}"
+
+        # Deployments not running in this process no longer change
+        record = self.store.get_deployment(deployment_id)
+        if record is None:
+            raise Exception(f"Deployment {deployment_id} not found")
+        return f"{record['status']}-{self.store.log_bounds(deployment_id)[1] or 0}"
+
+    def list_deployments(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Return recent deployments, newest first"""
+        # Running deployments come from memory, since their rows may not be committed yet
+        columns = ('started_at', 'status', 'current_step', 'finished_at', 'error')
+        deployments = [{'id': deployment_id, **{column: deployment['record'][column] for column in columns}}
+                       for deployment_id, deployment in self.deployments.items()]
+        deployments += [deployment for deployment in self.store.list_deployments(limit)
+                        if deployment['id'] not in self.deployments]
+        deployments.sort(key=lambda deployment: deployment['started_at'], reverse=True)
+        return deployments[:limit]
+
+    def get_profile(self, top: int = 10, runs: int = PROFILE_RUNS) -> Dict[str, Any]:
+        """Slowest tasks, per-role percentiles and the latest regression across recent deployments
+
+        The regression carries the Ansible tuning of both runs, so a change in
+        timings can be told apart from a change in settings.
+        """
+        profile = build_profile(self.store.get_task_timings(runs), top=top)
+        regression = profile['regression']
+        if regression:
+            for side in ('previous', 'current'):
+                deployment = self.store.get_deployment(regression[f'{side}_deployment'])
+                regression[f'{side}_ansible'] = ansible_settings(deployment['config']) if deployment else None
+        return profile
+
+    async def read_logs(self, deployment_id: str, after: int = 0, limit: int = DEFAULT_PAGE_LINES,
+                        contains: Optional[str] = None, regex: Optional[str] = None,
+                        ignore_case: bool = False) -> Dict[str, Any]:
+        """Page through a deployment's full spooled log, optionally keeping only matching lines
+
+        Returns up to ``limit`` lines with a sequence number greater than
+        ``after``; ``next_after`` is the cursor for the following page.
+        Raises re.error for an invalid ``regex``.
+        """
+        matcher = line_matcher(contains, regex, ignore_case)
+        await self.store.wait_for_writes()
+        if self.store.get_deployment(deployment_id) is None:
             raise Exception(f"Deployment {deployment_id} not found")
+        chunks = self.store.get_log_chunks(deployment_id, after)
+        # Decompressing and scanning a long log is CPU-bound; keep it off the event loop
+        entries, scanned = await asyncio.to_thread(self.store.spool.read, deployment_id, chunks,
+                                                   after, limit, matcher)
+        return {
+            'deployment_id': deployment_id,
+            'lines': [{'seq': seq, 'line': line} for seq, line in entries],
+            'next_after': scanned,
+            'last_seq': chunks[-1][4] if chunks else after,
+            'more': len(entries) >= limit
+        }
 
-        deployment = self.deployments[deployment_id]
+    async def log_download(self, deployment_id: str) -> Iterator[bytes]:
+        """Gzip stream of a deployment's full log, read straight from the spool files"""
+        await self.store.wait_for_writes()
+        if self.store.get_deployment(deployment_id) is None:
+            raise Exception(f"Deployment {deployment_id} not found")
+        return self.store.spool.stream(deployment_id, self.store.get_log_extents(deployment_id))
+
+    def _log_window(self, deployment_id: str, since: Optional[int] = None) -> Dict[str, Any]:
+        """Select up to STATUS_LOG_PAGE log entries newer than ``since``, or the recent tail
+
+        Running deployments are served from their in-memory recent lines;
+        only a cursor older than those reads from the store.
+        """
+        deployment = self.deployments.get(deployment_id)
+        if deployment is None:
+            last_seq = self.store.log_bounds(deployment_id)[1] or 0
+            entries = self.store.get_logs(deployment_id, since=since, tail=STATUS_LOG_TAIL, limit=STATUS_LOG_PAGE)
+        else:
+            recent = deployment['recent_logs']
+            last_seq = deployment['next_seq'] - 1
+            # Sequence numbers in the ring are consecutive, so a cursor maps to an index
+            recent_first = recent[0][0] if recent else last_seq + 1
+            if since is None:
+                entries = list(islice(recent, max(len(recent) - STATUS_LOG_TAIL, 0), None))
+            else:
+                entries = []
+                if since + 1 < recent_first:
+                    entries = self.store.get_logs(deployment_id, since=since, limit=STATUS_LOG_PAGE)
+                start = max(entries[-1][0] if entries else since, recent_first - 1) + 1 - recent_first
+                entries += islice(recent, start, start + STATUS_LOG_PAGE - len(entries))
+
+        more = since is not None and bool(entries) and entries[-1][0] < last_seq and len(entries) >= STATUS_LOG_PAGE
+        return {
+            'logs': [line for _, line in entries],
+            'log_start_seq': entries[0][0] if entries else last_seq + 1,
+            # The cursor for the next query: the newest line, or the last one returned when the page is full
+            'last_seq': entries[-1][0] if more else last_seq,
+            'more': more,
+            # Some entries after the client's cursor were pruned and are missing from this page
+            'logs_truncated': since is not None and any(
+                seq != expected for expected, (seq, _) in enumerate(entries, start=since + 1))
+        }
+
+    def _status_summary(self, deployment_id: str) -> Dict[str, Any]:
+        """Build the status payload shared by the status API and log subscribers"""
+        deployment = self.deployments.get(deployment_id)
+        if deployment is not None:
+            if deployment['summary'] is None:
+                deployment['summary'] = self._build_summary(deployment_id, deployment['record'], deployment['steps'])
+            return dict(deployment['summary'])
+
+        record = self.store.get_deployment(deployment_id)
+        if record is None:
+            raise Exception(f"Deployment {deployment_id} not found")
+        return self._build_summary(deployment_id, record, self.store.get_steps(deployment_id))
+
+    def _build_summary(self, deployment_id: str, record: Dict[str, Any],
+                       steps: List[Dict[str, Any]]) -> Dict[str, Any]:
         return {
             'id': deployment_id,
-            'status': deployment['status'],
-            'current_step': deployment['current_step'],
-            'steps_completed': len([s for s in deployment['steps'] if s['status'] == 'completed']),
-            'total_steps': len(deployment['steps']) if deployment['steps'] else 0,
-            'started_at': deployment['started_at'],
-            'finished_at': deployment.get('finished_at'),
-            'logs': deployment['logs'][-50:],  # Return last 50 log lines
-            'error': deployment.get('error')
+            'status': record['status'],
+            'current_step': record['current_step'],
+            'steps': [dict(step) for step in steps],
+            'steps_completed': len([s for s in steps if s['status'] == 'completed']),
+            'total_steps': len(steps),
+            'graph': graph_summary(steps),
+            'change_plan': record['change_plan'],
+            'ansible_progress': record['ansible_progress'],
+            'image_prefetch': record['image_prefetch'],
+            'queue_position': self.scheduler.position(deployment_id),
+            'started_at': record['started_at'],
+            'finished_at': record['finished_at'],
+            'error': record['error']
         }
 
-    async def _run_deployment(self, deployment_id: str):
-        """Run the actual deployment process (Stage 2)"""
+    def subscribe(self, deployment_id: str, queue: Optional[asyncio.Queue] = None) -> asyncio.Queue:
+        """Subscribe to live log lines and status changes of a deployment
+
+        The queue is primed with the current status and recent log lines so a
+        late subscriber does not miss what happened before it connected.
+        """
+        status = self._status_summary(deployment_id)
+
+        if queue is None:
+            queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+        offer_latest(queue, {'type': 'status', 'deployment_id': deployment_id, 'status': status})
+        window = self._log_window(deployment_id)
+        if window['logs']:
+            offer_latest(queue, {'type': 'logs', 'deployment_id': deployment_id, 'seq': window['log_start_seq'],
+                                 'lines': window['logs']})
+
+        self.subscribers.setdefault(deployment_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, deployment_id: str, queue: asyncio.Queue):
+        """Stop delivering deployment updates to a queue"""
+        queues = self.subscribers.get(deployment_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[deployment_id]
+
+    def _publish(self, deployment_id: str, message: Dict[str, Any]):
+        """Fan a message out to every subscriber of a deployment without blocking"""
+        for queue in self.subscribers.get(deployment_id, ()):
+            if not offer_latest(queue, message):
+                MESSAGES_DROPPED.inc()
+
+    def _notify_change(self, deployment_id: str):
+        """Bump the deployment's version and wake long-polling status requests"""
+        deployment = self.deployments[deployment_id]
+        if deployment['notify_handle'] is not None:
+            deployment['notify_handle'].cancel()
+            deployment['notify_handle'] = None
+        deployment['last_notified'] = time.monotonic()
+        deployment['version'] += 1
+        deployment['changed'].set()
+        deployment['changed'] = asyncio.Event()
+
+    def _notify_logs(self, deployment_id: str):
+        """Wake long-polling status requests for new log lines, at most every LOG_NOTIFY_INTERVAL"""
         deployment = self.deployments[deployment_id]
+        if deployment['notify_handle'] is not None:
+            return
+        delay = deployment['last_notified'] + LOG_NOTIFY_INTERVAL - time.monotonic()
+        if delay <= 0:
+            self._notify_change(deployment_id)
+        else:
+            deployment['notify_handle'] = asyncio.get_running_loop().call_later(
+                delay, self._notify_change, deployment_id)
+
+    def _publish_status(self, deployment_id: str):
+        """Push the current status summary to subscribers"""
+        self.deployments[deployment_id]['summary'] = None
+        self._notify_change(deployment_id)
+        if self.subscribers.get(deployment_id):
+            self._publish(deployment_id, {'type': 'status', 'deployment_id': deployment_id,
+                                          'status': self._status_summary(deployment_id)})
+
+    def _queue_changed(self, waiting: List[str]):
+        """Tell queued deployments' subscribers about their new positions"""
+        for deployment_id in waiting:
+            if deployment_id in self.deployments:
+                self._publish_status(deployment_id)
 
+    async def _run_deployment(self, deployment_id: str):
+        """Wait for a scheduler slot, then run the deployment"""
+        try:
+            async with self.scheduler.slot(deployment_id):
+                await self._execute_deployment(deployment_id)
+        except asyncio.CancelledError:
+            # Anything else cancelling us (service shutdown) leaves the deployment to be marked interrupted
+            if not self.deployments[deployment_id].get('cancel_requested'):
+                raise
+            await self._finish_cancelled(deployment_id)
+        finally:
+            self.store.finish_logs(deployment_id)
+            # Everything about a finished deployment is served from the store from here on,
+            # so every write and line has to be committed first
+            await self.store.wait_for_writes()
+            deployment = self.deployments.pop(deployment_id, None)
+            if deployment is not None and deployment['notify_handle'] is not None:
+                deployment['notify_handle'].cancel()
+
+    async def _finish_cancelled(self, deployment_id: str):
+        """Record a deployment stopped by a cancel request"""
+        for index, step in enumerate(self.deployments[deployment_id]['steps']):
+            if step['status'] == 'pending':
+                self._update_step(deployment_id, index, status='skipped')
+        self._update_record(deployment_id, error="Cancelled by request", finished_at=datetime.now().isoformat())
+        await self._update_current_step(deployment_id, None)
+        await self._update_status(deployment_id, 'cancelled')
+        await self._add_log(deployment_id, "🛑 Deployment cancelled")
+
+    def _build_steps(self, deployment_id: str) -> List[Step]:
+        """Declare the Stage 2 steps and what each one waits for"""
+        steps = [
+            Step('prepare', 'Prepare Stage 2 environment', self._prepare_stage2),
+            Step('toolchain', 'Check toolchain', self._check_toolchain),
+            Step('collections', 'Install Ansible collections', self._install_ansible_collections,
+                 depends_on=['toolchain']),
+            Step('plan', 'Plan changes', self._plan_changes),
+            Step('ansible', 'Run Stage 2 Ansible playbook', self._run_stage2_ansible,
+                 depends_on=['prepare', 'collections', 'plan']),
+            # Runs alongside the playbook, pulling service images once k3s is up
+            Step('prefetch', 'Pre-fetch service images', self._prefetch_images, depends_on=['plan']),
+            Step('verify', 'Verify cluster', self._verify_deployment, depends_on=['ansible']),
+        ]
+
+        # One verification probe per enabled service, all running once the cluster answers
+        services = self.deployments[deployment_id]['config'].get('services', {})
+        for service in list(SERVICE_WORKLOADS) + list(SERVICE_UNITS):
+            if services.get(service):
+                steps.append(Step(f'verify-{service}', f"Verify {service.replace('_', ' ')}",
+                                  self._service_verifier(service), depends_on=['verify']))
+        return steps
+
+    async def _execute_deployment(self, deployment_id: str):
+        """Run the actual deployment process (Stage 2)"""
+        deployment_started = time.monotonic()
         try:
             await self._update_status(deployment_id, 'running')
 
-            # Define Stage 2 deployment steps
-            steps = [
-                {'name': 'Prepare Stage 2 environment', 'function': self._prepare_stage2},
-                {'name': 'Run Stage 2 Ansible playbook', 'function': self._run_stage2_ansible},
-                {'name': 'Verify deployment', 'function': self._verify_deployment}
+            graph = StepGraph(self._build_steps(deployment_id))
+            index = {step.key: i for i, step in enumerate(graph.steps)}
+            steps = [{'key': step.key, 'name': step.name, 'depends_on': step.depends_on} for step in graph.steps]
+            self.store.set_steps(deployment_id, steps)
+            self.deployments[deployment_id]['steps'] = [
+                {**step, 'status': 'pending', 'started_at': None, 'finished_at': None, 'duration': None}
+                for step in steps
             ]
 
-            deployment['steps'] = [{'name': step['name'], 'status': 'pending'} for step in steps]
-
-            # Execute each step
-            for i, step in enumerate(steps):
-                step_name = step['name']
-                await self._update_current_step(deployment_id, step_name)
-                await self._update_step_status(deployment_id, i, 'running')
+            budgets = self.get_step_budgets()
 
+            async def run_step(step: Step):
+                await self._update_step_status(deployment_id, index[step.key], 'running')
+                await self._refresh_current_step(deployment_id)
+                budget = budgets.get(step.key) or budgets.get(step.key.partition('-')[0] + '-*')
+                started = time.monotonic()
                 try:
-                    await step['function'](deployment_id)
-                    await self._update_step_status(deployment_id, i, 'completed')
-                    await self._add_log(deployment_id, f"✅ {step_name} completed successfully")
+                    await self._run_with_budget(step, deployment_id, budget)
+                except StepTimeoutError as e:
+                    STEP_DURATION.labels(step.key, 'timed_out').observe(time.monotonic() - started)
+                    await self._update_step_status(deployment_id, index[step.key], 'timed_out',
+                                                   duration=time.monotonic() - started)
+                    await self._add_log(deployment_id, f"⏱ {str(e)}")
+                    raise
+                except asyncio.CancelledError:
+                    STEP_DURATION.labels(step.key, 'cancelled').observe(time.monotonic() - started)
+                    await self._update_step_status(deployment_id, index[step.key], 'cancelled',
+                                                   duration=time.monotonic() - started)
+                    raise
                 except Exception as e:
-                    await self._update_step_status(deployment_id, i, 'failed')
-                    await self._add_log(deployment_id, f"❌ {step_name} failed: {str(e)}")
-                    raise e
+                    STEP_DURATION.labels(step.key, 'failed').observe(time.monotonic() - started)
+                    await self._update_step_status(deployment_id, index[step.key], 'failed',
+                                                   duration=time.monotonic() - started)
+                    await self._add_log(deployment_id, f"❌ {step.name} failed: {str(e)}")
+                    raise
+                finally:
+                    await self._refresh_current_step(deployment_id)
+                STEP_DURATION.labels(step.key, 'completed').observe(time.monotonic() - started)
+                await self._update_step_status(deployment_id, index[step.key], 'completed',
+                                               duration=time.monotonic() - started)
+                await self._add_log(deployment_id, f"✅ {step.name} completed successfully")
+
+            async def skip_step(step: Step):
+                await self._update_step_status(deployment_id, index[step.key], 'skipped')
+
+            await graph.run(run_step, on_skip=skip_step)
+
+            summary = graph_summary(self.deployments[deployment_id]['steps'])
+            await self._add_log(
+                deployment_id,
+                f"⏱ Finished in {summary['wall_time']:.1f}s; running steps in parallel saved "
+                f"{summary['parallel_savings']:.1f}s (critical path: {' → '.join(summary['critical_path'])})"
+            )
+
+            # Later deployments are planned against what this one applied
+            self.store.set_setting('last_applied', self.deployments[deployment_id]['plan']['fingerprint'])
 
+            self._update_record(deployment_id, finished_at=datetime.now().isoformat())
             await self._update_status(deployment_id, 'completed')
-            deployment['finished_at'] = datetime.now().isoformat()
 
         except Exception as e:
+            self._update_record(deployment_id, error=str(e), finished_at=datetime.now().isoformat())
             await self._update_status(deployment_id, 'failed')
-            deployment['error'] = str(e)
-            deployment['finished_at'] = datetime.now().isoformat()
             await self._add_log(deployment_id, f"❌ Deployment failed: {str(e)}")
+        finally:
+            status = self.deployments[deployment_id]['status']
+            DEPLOYMENT_DURATION.labels(status if status in TERMINAL_STATUSES else 'cancelled').observe(
+                time.monotonic() - deployment_started)
+
+    async def _run_with_budget(self, step: Step, deployment_id: str, budget: float):
+        """Run a step, stopping it (and the commands it runs) once it exceeds its time budget"""
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(step.function(deployment_id), timeout=budget)
+        except asyncio.TimeoutError:
+            if time.monotonic() - started < budget:
+                raise  # Timed out inside the step rather than by the budget
+            raise StepTimeoutError(f"{step.name} exceeded its time budget of {budget:g}s")
+
+    async def _refresh_current_step(self, deployment_id: str):
+        """Show every step that is running right now as the current step"""
+        running = [step['name'] for step in self.deployments[deployment_id]['steps'] if step['status'] == 'running']
+        await self._update_current_step(deployment_id, ", ".join(running) or None)
 
     async def _prepare_stage2(self, deployment_id: str):
         """Prepare Stage 2 environment"""
@@ -107,62 +643,55 @@ class DeploymentManager:
         await self._add_log(deployment_id, f"Running as user: {current_user}")
 
         # Verify we can find ansible-playbook
-        # TODO - Why isnt this find function working?
-                # ansible_playbook_cmd = await self._find_command(['ansible-playbook'], deployment_id)
-
-        ansible_playbook_cmd = "/opt/homelab/venv/bin/ansible-playbook"
+        ansible_playbook_cmd = await self._find_command(['ansible-playbook'], deployment_id)
 
         if not ansible_playbook_cmd:
             raise Exception("ansible-playbook not found. Stage 1 bootstrap may not have completed properly.")
 
         await self._add_log(deployment_id, f"✅ Found ansible-playbook at: {ansible_playbook_cmd}")
 
-    async def _find_command(self, commands: list, deployment_id: str) -> str:
-        """Find a command in the system"""
-        search_paths = [
-            "/opt/homelab/venv/bin/"
-            "/usr/local/bin/",
-            "/usr/bin/",
-            "/home/homelab/.local/bin/",
-            ""  # PATH
-        ]
+    async def _plan_changes(self, deployment_id: str):
+        """Work out which roles and Terraform resources this deployment has to touch"""
+        deployment = self.deployments[deployment_id]
+        # Fingerprinting hashes the rendered files and role trees; keep it off the event loop
+        plan = await asyncio.to_thread(self.planner.plan, deployment['config'], self.store.get_setting('last_applied'),
+                                       force_full=deployment['force_full'])
+        deployment['plan'] = plan
+
+        public_plan = {key: value for key, value in plan.items() if key != 'fingerprint'}
+        self._update_record(deployment_id, change_plan=public_plan)
+        self._publish_status(deployment_id)
+
+        for reason in plan['reasons']:
+            await self._add_log(deployment_id, f"Change plan: {reason}")
+        if plan['mode'] == 'incremental':
+            await self._add_log(deployment_id, f"Running only: {', '.join(plan['ansible_tags'])}")
+            if plan['terraform_targets']:
+                await self._add_log(deployment_id, f"OpenTofu targets: {', '.join(plan['terraform_targets'])}")
+
+    async def _check_toolchain(self, deployment_id: str):
+        """Resolve every deployment tool up front, concurrently"""
+        tools = await self.toolchain.resolve_all()
+        for tool, info in tools.items():
+            if info:
+                await self._add_log(deployment_id, f"Found {tool} at: {info['path']} ({info['version']})")
+            else:
+                await self._add_log(deployment_id, f"⚠️ {tool} not found")
 
+    async def _find_command(self, commands: list, deployment_id: str) -> Optional[str]:
+        """Find the first available command, using the cached toolchain resolver"""
         for cmd in commands:
-            for path in search_paths:
-                full_cmd = path + cmd if path else cmd
-                try:
-                    result = subprocess.run([full_cmd, "--version" if cmd != "tofu" else "version"],
-                                          capture_output=True, timeout=10)
-                    if result.returncode == 0:
-                        return full_cmd
-                except (subprocess.TimeoutExpired, FileNotFoundError):
-                    continue
+            info = await self.toolchain.resolve_info(cmd)
+            if info:
+                await self._add_log(deployment_id, f"Found {cmd} at: {info['path']} ({info['version']})")
+                return info['path']
         return None
 
     async def _install_ansible_collections(self, deployment_id: str):
         """Install required Ansible collections"""
         await self._add_log(deployment_id, "Installing Ansible collections...")
 
-        # Try to find ansible-galaxy in common locations
-        ansible_galaxy_paths = [
-            "/usr/local/bin/ansible-galaxy",
-            "/usr/bin/ansible-galaxy",
-            "/home/homelab/.local/bin/ansible-galaxy",
-            "ansible-galaxy"  # fallback to PATH
-        ]
-
-        ansible_galaxy_cmd = None
-        for path in ansible_galaxy_paths:
-            try:
-                result = subprocess.run([path, "--version"],
-                                      capture_output=True,
-                                      timeout=10)
-                if result.returncode == 0:
-                    ansible_galaxy_cmd = path
-                    await self._add_log(deployment_id, f"Found ansible-galaxy at: {path}")
-                    break
-            except (subprocess.TimeoutExpired, FileNotFoundError):
-                continue
+        ansible_galaxy_cmd = await self._find_command(['ansible-galaxy'], deployment_id)
 
         if not ansible_galaxy_cmd:
             await self._add_log(deployment_id, "ansible-galaxy not found, installing Ansible...")
@@ -172,21 +701,23 @@ class DeploymentManager:
             if result.returncode != 0:
                 raise Exception("Failed to install Ansible")
 
-            ansible_galaxy_cmd = "ansible-galaxy"
+            self.toolchain.invalidate('ansible-galaxy')
+            ansible_galaxy_cmd = await self._find_command(['ansible-galaxy'], deployment_id) or "ansible-galaxy"
 
         requirements_file = self.ansible_dir / "requirements.yml"
         if requirements_file.exists():
             cmd = [
                 ansible_galaxy_cmd, "collection", "install",
-                "-r", str(requirements_file), "--force"
+                "-r", str(requirements_file)
             ]
         else:
             cmd = [
                 ansible_galaxy_cmd, "collection", "install",
-                "kubernetes.core", "community.general", "--force"
+                "kubernetes.core", "community.general"
             ]
 
-        result = await self._run_command(cmd, deployment_id)
+        async with self.scheduler.resources(ANSIBLE_RESOURCE):
+            result = await self._run_command(cmd, deployment_id)
         if result.returncode != 0:
             raise Exception("Failed to install Ansible collections")
 
@@ -195,226 +726,340 @@ class DeploymentManager:
         await self._add_log(deployment_id, "Starting Stage 2 full deployment...")
 
         # Find ansible-playbook command
-        # ansible_playbook_cmd = await self._find_command(['ansible-playbook'], deployment_id)
-        ansible_playbook_cmd = "/opt/homelab/venv/bin/ansible-playbook"
+        ansible_playbook_cmd = await self._find_command(['ansible-playbook'], deployment_id)
 
         if not ansible_playbook_cmd:
             raise Exception("ansible-playbook command not found")
 
-        # Change to ansible directory
-        original_cwd = os.getcwd()
-        await self._add_log(deployment_id, f"Original CWD: {' '.join(original_cwd)}")
-        await self._add_log(deployment_id, f"Ansible dir:  {' '.join(self.ansible_dir)}")
+        plan = self.deployments[deployment_id]['plan']
+        if plan['mode'] == 'noop':
+            await self._add_log(deployment_id, "✅ Nothing changed since the last successful deployment, skipping playbook")
+            return
 
-        os.chdir(self.ansible_dir)
+        # Task counts of earlier runs with the same tags drive the percent estimate
+        task_counts = self.store.get_setting('ansible_task_counts', {})
+        history_key = ",".join(plan['ansible_tags'])
+        progress = AnsibleProgress(task_counts.get(history_key), plan['ansible_tags'])
+        self.deployments[deployment_id]['progress'] = progress
+        timer = TaskTimer()
 
-        try:
-            # Run the Stage 2 deployment playbook - we're already running as homelab user with sudo permissions
-            cmd = [
-                "sudo", ansible_playbook_cmd,
-                "-i", "inventory/hosts.yml",
-                "stage2-deploy.yml"
-            ]
-            await self._add_log(deployment_id, f"Running: {' '.join(cmd)}")
-            await self._add_log(deployment_id, f"Working directory: {self.ansible_dir}")
-            result = await self._run_command(cmd, deployment_id, stream_logs=True)
-            if result.returncode != 0:
-                raise Exception("Stage 2 Ansible playbook execution failed")
+        deployment = self.deployments[deployment_id]
+        last_published = 0.0
+        publish_handle: Optional[asyncio.TimerHandle] = None
+
+        def publish_progress():
+            nonlocal last_published, publish_handle
+            publish_handle = None
+            last_published = time.monotonic()
+            snapshot = progress.snapshot()
+            self._update_record(deployment_id, ansible_progress=snapshot)
+            self._notify_change(deployment_id)
+            self._publish(deployment_id, {'type': 'progress', 'deployment_id': deployment_id, 'progress': snapshot})
+
+        async def on_event(event: Dict[str, Any]):
+            nonlocal publish_handle
+            timer.handle(event)
+            if (event.get('event') == 'task_start' and event.get('role') == 'opentofu'
+                    and deployment['apply_started'] is None):
+                deployment['apply_started'] = time.monotonic()
+            # Per-host results in between ride along with the next visible change
+            if not progress.handle(event) or publish_handle is not None:
+                return
+            delay = last_published + PROGRESS_PUBLISH_INTERVAL - time.monotonic()
+            if delay <= 0:
+                publish_progress()
+            else:
+                publish_handle = asyncio.get_running_loop().call_later(delay, publish_progress)
+
+        # Logged so task timings can be read against the tuning they ran with
+        settings = ansible_settings(self.deployments[deployment_id]['config'])
+        fact_cache = f"{settings['fact_cache_timeout']}s" if settings['fact_caching'] else "off"
+        await self._add_log(
+            deployment_id,
+            f"Ansible: {settings['forks']} forks, {settings['strategy']} strategy, "
+            f"{settings['gathering']} gathering ({settings['gather_subset']}), fact cache {fact_cache}, "
+            f"pipelining {'on' if settings['pipelining'] else 'off'}"
+        )
+        config = self.deployments[deployment_id]['config']
+        _, agents = cluster_nodes(config)
+        if agents:
+            await self._add_log(
+                deployment_id,
+                f"Cluster: {len(agents)} agent node(s), joined {min(agent_batch_size(config), settings['forks'])} at a time"
+            )
 
-        finally:
-            os.chdir(original_cwd)
-
-    async def _run_ansible_playbook(self, deployment_id: str):
-        """Run the main Ansible playbook"""
-        await self._add_log(deployment_id, "Starting Ansible playbook execution...")
-
-        # Try to find ansible-playbook in common locations
-        ansible_playbook_paths = [
-            "/usr/local/bin/ansible-playbook",
-            "/usr/bin/ansible-playbook",
-            "/home/homelab/.local/bin/ansible-playbook",
-            "ansible-playbook"  # fallback to PATH
+        # Run the Stage 2 deployment playbook - we're already running as homelab user with sudo permissions.
+        # Environment assignments go through sudo, which would otherwise reset them.
+        cmd = [
+            SUDO_COMMAND, *(f"{name}={value}" for name, value in self._ansible_env().items()),
+            ansible_playbook_cmd,
+            "-i", "inventory/hosts.yml",
+            "stage2-deploy.yml"
         ]
+        if self.deployments[deployment_id]['force_full']:
+            # A forced full run starts from freshly gathered facts
+            cmd.append("--flush-cache")
+        if plan['mode'] == 'incremental':
+            cmd += ["--tags", ",".join(plan['ansible_tags'])]
+            if plan['terraform_targets']:
+                cmd += ["-e", json.dumps({'opentofu_targets': plan['terraform_targets']})]
+        await self._add_log(deployment_id, f"Working directory: {self.ansible_dir}")
+
+        # The playbook's opentofu role also applies the Terraform state
+        started = time.time()
+        async with self.scheduler.resources(ANSIBLE_RESOURCE, TERRAFORM_RESOURCE):
+            try:
+                result = await self._run_command(cmd, deployment_id, stream_logs=True, cwd=self.ansible_dir,
+                                                 on_event=on_event)
+            finally:
+                deployment['playbook_done'].set()
+                if publish_handle is not None:
+                    publish_handle.cancel()
+                # Timings of a failed or cancelled run are kept too; they show where it got stuck
+                tofu_timings = await asyncio.to_thread(read_tofu_timings, self.tofu_events_file, started)
+                self.store.add_task_timings(deployment_id, timer.finish(time.time()) + tofu_timings)
+        publish_progress()
+        if result.returncode != 0:
+            raise Exception("Stage 2 Ansible playbook execution failed")
+
+        task_counts[history_key] = progress.tasks_started
+        self.store.set_setting('ansible_task_counts', task_counts)
+
+    def _ansible_env(self) -> Dict[str, str]:
+        """Environment selecting the managed ansible.cfg and enabling the homelab_events callback plugin"""
+        env = {}
+        ansible_cfg = self.ansible_dir / "ansible.cfg"
+        if ansible_cfg.exists():
+            # Ansible ignores ansible.cfg in the working directory if that directory is world-writable
+            env['ANSIBLE_CONFIG'] = str(ansible_cfg)
+        return {
+            **env,
+            'ANSIBLE_CALLBACK_PLUGINS': str(self.ansible_dir / "callback_plugins"),
+            'ANSIBLE_CALLBACKS_ENABLED': CALLBACK_NAME,
+        }
 
-        # ansible_playbook_cmd = None
-        ansible_playbook_cmd = "/opt/homelab/venv/bin/ansible-playbook"
-
-        # for path in ansible_playbook_paths:
-        #     try:
-        #         result = subprocess.run([path, "--version"],
-        #                               capture_output=True,
-        #                               timeout=10)
-        #         if result.returncode == 0:
-        #             ansible_playbook_cmd = path
-        #             await self._add_log(deployment_id, f"Found ansible-playbook at: {path}")
-        #             break
-        #     except (subprocess.TimeoutExpired, FileNotFoundError):
-        #         continue
-
-        if not ansible_playbook_cmd:
-            raise Exception("ansible-playbook command not found")
-
-        # Change to ansible directory
-        original_cwd = os.getcwd()
-        os.chdir(self.ansible_dir)
-
-        try:
-            cmd = [
-                ansible_playbook_cmd,
-                "-i", "inventory/hosts.yml",
-                "site.yml"
-            ]
-
-            result = await self._run_command(cmd, deployment_id, stream_logs=True)
-            if result.returncode != 0:
-                raise Exception("Ansible playbook execution failed")
+    async def _prefetch_images(self, deployment_id: str):
+        """Pull the enabled services' images into containerd while the playbook is still running
 
-        finally:
-            os.chdir(original_cwd)
-
-    async def _run_terraform(self, deployment_id: str):
-        """Run OpenTofu/Terraform deployment"""
-        await self._add_log(deployment_id, "Applying OpenTofu configuration...")
-
-        # Try to find tofu/terraform in common locations
-        tofu_paths = [
-            "/usr/local/bin/tofu",
-            "/usr/bin/tofu",
-            "/usr/local/bin/terraform",
-            "/usr/bin/terraform",
-            "tofu",  # fallback to PATH
-            "terraform"  # fallback to PATH
-        ]
-
-        tofu_cmd = None
-        for path in tofu_paths:
+        Without this the pods created by the opentofu role pull their images
+        only then, at the end of the critical path. Pull failures are logged
+        and left to the pods to retry; they never fail the deployment.
+        """
+        deployment = self.deployments[deployment_id]
+        plan = deployment['plan']
+        if plan['mode'] == 'noop' or 'opentofu' not in plan['ansible_tags']:
+            await self._add_log(deployment_id, "Image pre-fetch: no services are deployed by this run")
+            return
+
+        images = await asyncio.to_thread(service_images, deployment['config'], self.terraform_dir)
+        if not images:
+            return
+
+        # k3s may only be installed by this very playbook run
+        done = deployment['playbook_done']
+        while not await self.prefetcher.runtime_ready():
             try:
-                result = subprocess.run([path, "version"],
-                                      capture_output=True,
-                                      timeout=10)
-                if result.returncode == 0:
-                    tofu_cmd = path
-                    await self._add_log(deployment_id, f"Found Terraform/OpenTofu at: {path}")
-                    break
-            except (subprocess.TimeoutExpired, FileNotFoundError):
+                await asyncio.wait_for(done.wait(), timeout=RUNTIME_POLL_INTERVAL)
+            except asyncio.TimeoutError:
                 continue
+            await self._add_log(deployment_id, "Image pre-fetch: the container runtime never came up, skipped")
+            return
 
-        if not tofu_cmd:
-            raise Exception("OpenTofu/Terraform command not found")
+        await self._add_log(deployment_id, f"Pre-fetching {len(images)} image(s): {', '.join(images)}")
 
-        # Change to terraform directory
-        original_cwd = os.getcwd()
-        os.chdir(self.terraform_dir)
+        async def on_result(result: Dict[str, Any]):
+            if result['status'] == 'failed':
+                await self._add_log(deployment_id, f"⚠️ Pre-fetch of {result['image']} failed: {result['error']}")
+            elif result['status'] == 'pulled':
+                await self._add_log(deployment_id, f"Pre-fetched {result['image']} "
+                                                   f"({result['bytes'] / 2**20:.1f} MiB in {result['seconds']:.1f}s)")
 
+        # Pods pull whatever is still missing once the playbook is over, so stop there
+        pulls = asyncio.ensure_future(self.prefetcher.pull_all(images, on_result))
+        stopped = asyncio.ensure_future(done.wait())
         try:
-            # Initialize if needed (backend configuration will handle state location)
-            init_cmd = [tofu_cmd, "init"]
-            result = await self._run_command(init_cmd, deployment_id)
-            if result.returncode != 0:
-                raise Exception("OpenTofu init failed")
-
-            # Apply configuration (backend handles state automatically)
-            user_tfvars = Path("user.tfvars")
-            if user_tfvars.exists():
-                apply_cmd = [tofu_cmd, "apply", "-auto-approve", "-var-file=user.tfvars"]
-            else:
-                apply_cmd = [tofu_cmd, "apply", "-auto-approve"]
-
-            result = await self._run_command(apply_cmd, deployment_id, stream_logs=True)
-            if result.returncode != 0:
-                raise Exception("OpenTofu apply failed")
-
+            await asyncio.wait({pulls, stopped}, return_when=asyncio.FIRST_COMPLETED)
         finally:
-            os.chdir(original_cwd)
+            stopped.cancel()
+            if not pulls.done():
+                pulls.cancel()
+        if pulls.cancelled():
+            await asyncio.gather(pulls, return_exceptions=True)
+            await self._add_log(deployment_id, "Image pre-fetch: playbook finished first, remaining pulls left to the pods")
+            return
+
+        # Pulling that happened before the opentofu role started no longer delays the pods
+        results = pulls.result()
+        apply_started = deployment['apply_started'] or time.monotonic()
+        intervals = sorted((r['finished'] - r['seconds'], min(r['finished'], apply_started))
+                           for r in results if r['status'] == 'pulled')
+        saved, covered_until = 0.0, float('-inf')
+        for start, end in intervals:
+            start = max(start, covered_until)
+            if end > start:
+                saved += end - start
+                covered_until = end
+        pulled = [r for r in results if r['status'] == 'pulled']
+        summary = {
+            'images': len(images),
+            'pulled': len(pulled),
+            'present': sum(1 for r in results if r['status'] == 'present'),
+            'failed': sum(1 for r in results if r['status'] == 'failed'),
+            'bytes': sum(r['bytes'] for r in pulled),
+            'seconds_saved': round(saved, 1),
+        }
+        PREFETCH_BYTES.inc(summary['bytes'])
+        PREFETCH_SAVED.observe(saved)
+        self._update_record(deployment_id, image_prefetch=summary)
+        self._publish_status(deployment_id)
+        await self._add_log(
+            deployment_id,
+            f"Image pre-fetch: {summary['pulled']} pulled ({summary['bytes'] / 2**20:.1f} MiB), "
+            f"{summary['present']} already present, {summary['failed']} failed; "
+            f"{saved:.1f}s of pulling done before the services were deployed"
+        )
 
     async def _verify_deployment(self, deployment_id: str):
-        """Verify that the deployment is working correctly"""
+        """Verify that the cluster answers and its nodes are ready"""
         await self._add_log(deployment_id, "Verifying deployment...")
 
-        # Check if kubectl is available and cluster is responsive
-        cmd = ["kubectl", "get", "nodes"]
-        result = await self._run_command(cmd, deployment_id)
-        if result.returncode != 0:
-            raise Exception("Kubernetes cluster not accessible")
-
-        # Check if pods are running
-        cmd = ["kubectl", "get", "pods", "-A"]
-        result = await self._run_command(cmd, deployment_id)
-        if result.returncode != 0:
-            raise Exception("Failed to get pod status")
+        try:
+            summary = await self.kube.cluster_summary()
+        except KubeError as e:
+            raise Exception(f"Kubernetes cluster not accessible: {e}")
+
+        if not summary['ready_nodes']:
+            raise Exception(f"No Kubernetes node is ready ({', '.join(summary['not_ready_nodes']) or 'no nodes'})")
+        await self._add_log(
+            deployment_id,
+            f"Nodes ready: {', '.join(summary['ready_nodes'])}"
+            + (f"; not ready: {', '.join(summary['not_ready_nodes'])}" if summary['not_ready_nodes'] else "")
+        )
+        phases = ', '.join(f"{count} {phase}" for phase, count in sorted(summary['pod_phases'].items()))
+        await self._add_log(deployment_id, f"Pods: {phases or 'none'}")
 
         await self._add_log(deployment_id, "✅ Deployment verification completed")
 
-    async def _run_command(self, cmd, deployment_id: str, stream_logs: bool = False) -> subprocess.CompletedProcess:
-        """Run a command and capture output"""
-        await self._add_log(deployment_id, f"Running: {' '.join(cmd)}")
-
-        if stream_logs:
-            # Stream output in real-time
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.STDOUT
-            )
-
-            # Read lines and decode from bytes to string
-            while True:
-                line_bytes = await process.stdout.readline()
-                if not line_bytes:
-                    break
-                line = line_bytes.decode('utf-8').rstrip()
-                if line:  # Only log non-empty lines
-                    await self._add_log(deployment_id, line)
+    def _service_verifier(self, service: str):
+        """Build the verification step function for one service"""
+        async def verify(deployment_id: str):
+            if service in SERVICE_UNITS:
+                cmd = ["systemctl", "is-active", SERVICE_UNITS[service]]
+                result = await self._run_command(cmd, deployment_id, timeout=ROLLOUT_TIMEOUT + 30)
+                if result.returncode != 0:
+                    raise Exception(f"{service} is not ready")
+                return
 
-            await process.wait()
-            return_code = process.returncode
+            async def on_progress(message: str):
+                await self._add_log(deployment_id, f"Waiting for {service}: {message}")
 
-            # Create a mock result object
-            class MockResult:
-                def __init__(self, returncode):
-                    self.returncode = returncode
-
-            return MockResult(return_code)
-
-        else:
-            # Run command and capture all output
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                timeout=300  # 5 minute timeout
-            )
+            kind, namespace, name = SERVICE_WORKLOADS[service]
+            try:
+                seconds = await asyncio.wait_for(
+                    self.kube.wait_ready(kind, namespace, name, on_progress=on_progress), timeout=ROLLOUT_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise Exception(f"{service} is not ready after {ROLLOUT_TIMEOUT}s")
+            except RolloutError as e:
+                raise Exception(f"{service} rollout failed: {str(e)}")
+            SERVICE_READY.labels(service).observe(seconds)
+            await self._add_log(deployment_id, f"✅ {service} ready after {seconds:.1f}s")
+        return verify
+
+    async def _run_command(self, cmd, deployment_id: str, stream_logs: bool = False,
+                           timeout: Optional[float] = None, cwd: Optional[Path] = None,
+                           env: Optional[Dict[str, str]] = None,
+                           on_event: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None) -> ProcessResult:
+        """Run a command without blocking the event loop and log its output
+
+        Streamed commands log each line as it is produced and have no timeout
+        unless one is given; captured commands default to COMMAND_TIMEOUT.
+        ``cwd`` and ``env`` apply to this command only, never to the service process.
+        With ``on_event``, homelab_events callback lines of a streamed command
+        are decoded and handed to it instead of being logged.
+        """
+        await self._add_log(deployment_id, f"Running: {' '.join(cmd)}")
 
-            if result.stdout:
-                stdout = result.stdout.decode('utf-8')
-                await self._add_log(deployment_id, stdout)
-            if result.stderr:
-                stderr = result.stderr.decode('utf-8')
-                await self._add_log(deployment_id, f"STDERR: {stderr}")
+        if stream_logs:
+            async def log_lines(lines: List[str]):
+                if on_event is not None:
+                    plain = []
+                    for line in lines:
+                        event = parse_event(line)
+                        if event is None:
+                            plain.append(line)
+                        else:
+                            await on_event(event)
+                    lines = plain
+                await self._add_logs(deployment_id, lines)
+
+            return await run_process(cmd, cwd=cwd, env=env, timeout=timeout, on_lines=log_lines)
+
+        result = await run_process(cmd, cwd=cwd, env=env, timeout=timeout or COMMAND_TIMEOUT)
+        if result.stdout:
+            await self._add_log(deployment_id, result.stdout)
+        if result.stderr:
+            await self._add_log(deployment_id, f"STDERR: {result.stderr}")
+
+        return result
+
+    def _update_record(self, deployment_id: str, **fields):
+        """Change columns of a running deployment, in memory and in the store"""
+        deployment = self.deployments[deployment_id]
+        deployment['record'].update(fields)
+        deployment['summary'] = None
+        self.store.update_deployment(deployment_id, **fields)
 
-            return result
+    def _update_step(self, deployment_id: str, step_index: int, **fields):
+        """Change columns of a running deployment's step, in memory and in the store"""
+        deployment = self.deployments[deployment_id]
+        deployment['steps'][step_index].update(fields)
+        deployment['summary'] = None
+        self.store.update_step(deployment_id, step_index, **fields)
 
     async def _update_status(self, deployment_id: str, status: str):
         """Update deployment status"""
         if deployment_id in self.deployments:
             self.deployments[deployment_id]['status'] = status
+            self._update_record(deployment_id, status=status)
+            self._publish_status(deployment_id)
 
     async def _update_current_step(self, deployment_id: str, step_name: str):
         """Update current step"""
         if deployment_id in self.deployments:
-            self.deployments[deployment_id]['current_step'] = step_name
+            self._update_record(deployment_id, current_step=step_name)
+            self._publish_status(deployment_id)
 
-    async def _update_step_status(self, deployment_id: str, step_index: int, status: str):
+    async def _update_step_status(self, deployment_id: str, step_index: int, status: str,
+                                  duration: Optional[float] = None):
         """Update status of a specific step"""
-        if deployment_id in self.deployments and step_index < len(self.deployments[deployment_id]['steps']):
-            self.deployments[deployment_id]['steps'][step_index]['status'] = status
+        if deployment_id in self.deployments:
+            now = datetime.now().isoformat()
+            if status == 'running':
+                self._update_step(deployment_id, step_index, status=status, started_at=now)
+            elif duration is not None:
+                self._update_step(deployment_id, step_index, status=status, finished_at=now,
+                                  duration=round(duration, 3))
+            else:
+                self._update_step(deployment_id, step_index, status=status)
+            self._publish_status(deployment_id)
 
     async def _add_log(self, deployment_id: str, message: str):
         """Add a log message"""
-        if deployment_id in self.deployments:
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            log_entry = f"[{timestamp}] {message}"
-            self.deployments[deployment_id]['logs'].append(log_entry)
-
-            # Keep only last 1000 log entries to prevent memory issues
-            if len(self.deployments[deployment_id]['logs']) > 1000:
-                self.deployments[deployment_id]['logs'] = self.deployments[deployment_id]['logs'][-1000:]
\ No newline at end of file
+        await self._add_logs(deployment_id, [message])
+
+    async def _add_logs(self, deployment_id: str, messages: List[str]):
+        """Add several log messages at once, with one timestamp, store write and publish"""
+        if deployment_id in self.deployments and messages:
+            deployment = self.deployments[deployment_id]
+            prefix = datetime.now().strftime("[%H:%M:%S] ")
+            entries = [prefix + message for message in messages]
+            seq = deployment['next_seq']
+            deployment['next_seq'] = seq + len(entries)
+
+            # Buffered and written in batches; the store prunes beyond its retention window
+            self.store.append_logs(deployment_id, seq, entries)
+            deployment['recent_logs'].extend(zip(range(seq, seq + len(entries)), entries))
+            LOG_LINES.inc(len(entries))
+            self._notify_logs(deployment_id)
+            self._publish(deployment_id, {'type': 'logs', 'deployment_id': deployment_id, 'seq': seq,
+                                          'lines': entries})
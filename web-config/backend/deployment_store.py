@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""
+SQLite-backed persistence for deployments, step states, logs and saved settings
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+from log_spool import LogSpool, Chunk
+
+# Log lines kept per deployment in the database; older lines are pruned when a batch
+# is flushed. The full log is kept in the spool files.
+LOG_RETENTION = 5000
+
+# Buffered log lines are written after this many seconds or this many lines
+LOG_FLUSH_INTERVAL = 0.5
+LOG_FLUSH_BATCH = 500
+
+logger = logging.getLogger(__name__)
+
+# Deployment columns holding JSON documents; encoded on write and decoded on read
+JSON_COLUMNS = ('change_plan', 'ansible_progress', 'image_prefetch')
+
+# Statuses that mean a deployment was still in flight
+ACTIVE_STATUSES = ('queued', 'starting', 'running')
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version
+MIGRATIONS = [
+    """
+    CREATE TABLE deployments (
+        id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        config TEXT NOT NULL,
+        current_step TEXT,
+        started_at TEXT NOT NULL,
+        finished_at TEXT,
+        error TEXT
+    );
+    CREATE INDEX idx_deployments_status ON deployments (status);
+    CREATE INDEX idx_deployments_started_at ON deployments (started_at);
+
+    CREATE TABLE steps (
+        deployment_id TEXT NOT NULL REFERENCES deployments (id) ON DELETE CASCADE,
+        idx INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        status TEXT NOT NULL,
+        started_at TEXT,
+        finished_at TEXT,
+        PRIMARY KEY (deployment_id, idx)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE logs (
+        deployment_id TEXT NOT NULL REFERENCES deployments (id) ON DELETE CASCADE,
+        seq INTEGER NOT NULL,
+        line TEXT NOT NULL,
+        PRIMARY KEY (deployment_id, seq)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    """,
+    """
+    ALTER TABLE steps ADD COLUMN key TEXT;
+    ALTER TABLE steps ADD COLUMN depends_on TEXT NOT NULL DEFAULT '[]';
+    ALTER TABLE steps ADD COLUMN duration REAL;
+    """,
+    """
+    ALTER TABLE deployments ADD COLUMN change_plan TEXT;
+    """,
+    """
+    ALTER TABLE deployments ADD COLUMN ansible_progress TEXT;
+    """,
+    """
+    CREATE TABLE task_timings (
+        deployment_id TEXT NOT NULL REFERENCES deployments (id) ON DELETE CASCADE,
+        idx INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        role TEXT NOT NULL,
+        name TEXT NOT NULL,
+        action TEXT,
+        status TEXT,
+        started_at REAL NOT NULL,
+        finished_at REAL,
+        duration REAL,
+        PRIMARY KEY (deployment_id, idx)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE log_chunks (
+        deployment_id TEXT NOT NULL REFERENCES deployments (id) ON DELETE CASCADE,
+        first_seq INTEGER NOT NULL,
+        last_seq INTEGER NOT NULL,
+        segment INTEGER NOT NULL,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        PRIMARY KEY (deployment_id, first_seq)
+    ) WITHOUT ROWID;
+    """,
+    """
+    ALTER TABLE deployments ADD COLUMN image_prefetch TEXT;
+    """,
+]
+
+
+class DeploymentStore:
+    """Durable deployment state in a write-ahead-logged SQLite database
+
+    Reads happen on the event loop thread; every write is queued to a
+    writer thread with its own connection and applied in submission order,
+    so the loop never waits for a commit. Reads only see committed writes
+    (await ``wait_for_writes`` for a barrier): the deployment manager keeps
+    the state and recent lines of running deployments in memory, and
+    settings are cached as they are written.
+
+    Log lines are buffered and written in batches so a burst of playbook
+    output costs one transaction rather than one per line. Each batch is also
+    compressed into the deployment's spool files (by default in ``logs/`` next
+    to the database), and the ``log_chunks`` table indexes which sequence
+    numbers live where.
+    """
+
+    def __init__(self, db_path: Path, spool_dir: Optional[Path] = None):
+        self.db_path = Path(db_path)
+        self.spool = LogSpool(spool_dir or self.db_path.parent / "logs")
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.conn = sqlite3.connect(str(self.db_path), isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._configure(self.conn)
+        self._migrate()
+
+        self._pending_logs: List[Tuple[str, int, str]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # Encoded value of every setting read or written so far, None when unset
+        self._settings: Dict[str, Optional[str]] = {}
+        # One thread, so writes, log batches and spool closes are applied in the order they were submitted
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store-writer")
+        self._writer_conn = sqlite3.connect(str(self.db_path), isolation_level=None, check_same_thread=False)
+        self._configure(self._writer_conn)
+
+    @staticmethod
+    def _configure(conn: sqlite3.Connection):
+        # With WAL, NORMAL only syncs at checkpoints, which is durable across process crashes
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+
+    def _migrate(self):
+        """Bring the schema up to date"""
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for index, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            self.conn.executescript(f"BEGIN; {script}; PRAGMA user_version = {index}; COMMIT;")
+
+    def close(self):
+        """Write buffered logs and close the database"""
+        self.flush_logs()
+        self._writer.shutdown(wait=True)
+        self._writer_conn.close()
+        self.conn.close()
+
+    def _submit(self, write: Callable[..., None], *args):
+        """Queue ``write(conn, *args)`` to run on the writer thread"""
+        self._writer.submit(self._run_write, write, args)
+
+    def _run_write(self, write: Callable[..., None], args: Tuple):
+        try:
+            write(self._writer_conn, *args)
+        except Exception:
+            logger.exception("Store write %s failed", write.__name__)
+
+    async def wait_for_writes(self):
+        """Wait until every write and log line submitted so far is committed"""
+        self.flush_logs()
+        await asyncio.wrap_future(self._writer.submit(lambda: None))
+
+    # Deployments
+
+    def create_deployment(self, deployment_id: str, status: str, config: Dict[str, Any], started_at: str):
+        self._submit(_execute, "INSERT INTO deployments (id, status, config, started_at) VALUES (?, ?, ?, ?)",
+                     (deployment_id, status, json.dumps(config), started_at))
+
+    def update_deployment(self, deployment_id: str, **fields):
+        """Update columns of a deployment row (status, current_step, finished_at, error, change_plan,
+        ansible_progress, image_prefetch); JSON columns take the decoded value"""
+        if not fields:
+            return
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        values = [json.dumps(value) if column in JSON_COLUMNS and value is not None else value
+                  for column, value in fields.items()]
+        self._submit(_execute, f"UPDATE deployments SET {assignments} WHERE id = ?", (*values, deployment_id))
+
+    def get_deployment(self, deployment_id: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute("SELECT * FROM deployments WHERE id = ?", (deployment_id,)).fetchone()
+        if row is None:
+            return None
+        deployment = dict(row)
+        deployment['config'] = json.loads(deployment['config'])
+        for column in JSON_COLUMNS:
+            deployment[column] = json.loads(deployment[column]) if deployment[column] else None
+        return deployment
+
+    def list_deployments(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Most recent deployments first, without their config"""
+        rows = self.conn.execute(
+            "SELECT id, status, current_step, started_at, finished_at, error FROM deployments "
+            "ORDER BY started_at DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def recover_interrupted(self) -> List[str]:
+        """Mark deployments left in flight by a previous process as interrupted"""
+        placeholders = ", ".join("?" for _ in ACTIVE_STATUSES)
+        rows = self.conn.execute(
+            f"SELECT id FROM deployments WHERE status IN ({placeholders})", ACTIVE_STATUSES
+        ).fetchall()
+        deployment_ids = [row['id'] for row in rows]
+        if not deployment_ids:
+            return []
+
+        now = datetime.now().isoformat()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for deployment_id in deployment_ids:
+                self.conn.execute(
+                    "UPDATE deployments SET status = 'interrupted', finished_at = ?, "
+                    "error = COALESCE(error, 'Service restarted while the deployment was running') WHERE id = ?",
+                    (now, deployment_id)
+                )
+                self.conn.execute(
+                    "UPDATE steps SET status = 'interrupted', finished_at = ? "
+                    "WHERE deployment_id = ? AND status = 'running'",
+                    (now, deployment_id)
+                )
+        return deployment_ids
+
+    # Steps
+
+    def set_steps(self, deployment_id: str, steps: List[Dict[str, Any]]):
+        """Replace the step list of a deployment with pending steps
+
+        Each step is a dict with ``key``, ``name`` and optional ``depends_on`` keys.
+        """
+        rows = [(deployment_id, index, step['key'], step['name'], json.dumps(step.get('depends_on', [])))
+                for index, step in enumerate(steps)]
+        self._submit(self._write_steps, deployment_id, rows)
+
+    @staticmethod
+    def _write_steps(conn: sqlite3.Connection, deployment_id: str, rows: List[Tuple]):
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM steps WHERE deployment_id = ?", (deployment_id,))
+            conn.executemany(
+                "INSERT INTO steps (deployment_id, idx, key, name, depends_on, status) "
+                "VALUES (?, ?, ?, ?, ?, 'pending')",
+                rows
+            )
+
+    def update_step(self, deployment_id: str, step_index: int, **fields):
+        """Update columns of a step row (status, started_at, finished_at, duration)"""
+        if not fields:
+            return
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        self._submit(_execute, f"UPDATE steps SET {assignments} WHERE deployment_id = ? AND idx = ?",
+                     (*fields.values(), deployment_id, step_index))
+
+    def get_steps(self, deployment_id: str) -> List[Dict[str, Any]]:
+        rows = self.conn.execute(
+            "SELECT key, name, status, depends_on, started_at, finished_at, duration "
+            "FROM steps WHERE deployment_id = ? ORDER BY idx",
+            (deployment_id,)
+        ).fetchall()
+        steps = []
+        for row in rows:
+            step = dict(row)
+            step['depends_on'] = json.loads(step['depends_on'])
+            steps.append(step)
+        return steps
+
+    # Logs
+
+    def append_logs(self, deployment_id: str, first_seq: int, lines: List[str]):
+        """Buffer consecutive log lines starting at ``first_seq``"""
+        self._pending_logs.extend(
+            (deployment_id, seq, line) for seq, line in enumerate(lines, start=first_seq)
+        )
+        if len(self._pending_logs) >= LOG_FLUSH_BATCH:
+            self.flush_logs()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(LOG_FLUSH_INTERVAL, self.flush_logs)
+
+    def flush_logs(self):
+        """Hand buffered log lines to the writer thread"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending_logs:
+            return
+
+        batch, self._pending_logs = self._pending_logs, []
+        self._writer.submit(self._write_batch, batch)
+
+    def finish_logs(self, deployment_id: str):
+        """Flush a finished deployment's lines, then let the spool forget its open segment"""
+        self.flush_logs()
+        self._writer.submit(self.spool.close, deployment_id)
+
+    def _write_batch(self, batch: List[Tuple[str, int, str]]):
+        """Spool a batch and index it in one transaction, pruning old lines; runs on the writer thread"""
+        try:
+            newest: Dict[str, int] = {}
+            # Runs of consecutive lines per deployment, each spooled as one chunk
+            runs: List[Tuple[str, int, List[str]]] = []
+            open_runs: Dict[str, Tuple[str, int, List[str]]] = {}
+            for deployment_id, seq, line in batch:
+                newest[deployment_id] = seq
+                run = open_runs.get(deployment_id)
+                if run is None or run[1] + len(run[2]) != seq:
+                    run = open_runs[deployment_id] = (deployment_id, seq, [])
+                    runs.append(run)
+                run[2].append(line)
+
+            chunks = [(deployment_id, *self.spool.append(deployment_id, first_seq, lines))
+                      for deployment_id, first_seq, lines in runs]
+
+            conn = self._writer_conn
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT OR REPLACE INTO logs (deployment_id, seq, line) VALUES (?, ?, ?)", batch)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO log_chunks (deployment_id, segment, offset, length, first_seq, last_seq) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    chunks
+                )
+                for deployment_id, seq in newest.items():
+                    if seq > LOG_RETENTION:
+                        conn.execute(
+                            "DELETE FROM logs WHERE deployment_id = ? AND seq <= ?",
+                            (deployment_id, seq - LOG_RETENTION)
+                        )
+        except Exception:
+            logger.exception("Writing %d log lines failed", len(batch))
+
+    def get_logs(self, deployment_id: str, since: Optional[int] = None, tail: int = 50,
+                 limit: int = LOG_RETENTION) -> List[Tuple[int, str]]:
+        """Return up to ``limit`` (seq, line) pairs newer than ``since``, or the last ``tail`` lines
+
+        Only committed lines are returned; await ``wait_for_writes`` first to include everything buffered.
+        """
+        if since is None:
+            rows = self.conn.execute(
+                "SELECT seq, line FROM logs WHERE deployment_id = ? ORDER BY seq DESC LIMIT ?",
+                (deployment_id, tail)
+            ).fetchall()
+            rows.reverse()
+        else:
+            rows = self.conn.execute(
+                "SELECT seq, line FROM logs WHERE deployment_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (deployment_id, since, limit)
+            ).fetchall()
+        return [(row['seq'], row['line']) for row in rows]
+
+    def log_bounds(self, deployment_id: str) -> Tuple[Optional[int], Optional[int]]:
+        """Return the oldest and newest retained sequence numbers of committed lines"""
+        row = self.conn.execute(
+            "SELECT MIN(seq), MAX(seq) FROM logs WHERE deployment_id = ?", (deployment_id,)
+        ).fetchone()
+        return row[0], row[1]
+
+    def get_log_chunks(self, deployment_id: str, after: int = 0) -> List[Chunk]:
+        """Index entries of spooled chunks holding lines after ``after``, in order
+
+        Only covers committed batches; await ``wait_for_writes`` first to include everything buffered.
+        """
+        rows = self.conn.execute(
+            "SELECT segment, offset, length, first_seq, last_seq FROM log_chunks "
+            "WHERE deployment_id = ? AND last_seq > ? ORDER BY first_seq",
+            (deployment_id, after)
+        ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def get_log_extents(self, deployment_id: str) -> List[Tuple[int, int]]:
+        """(segment, size) of each spool segment, counting only indexed chunks
+
+        Only covers committed batches; await ``wait_for_writes`` first to include everything buffered.
+        """
+        rows = self.conn.execute(
+            "SELECT segment, MAX(offset + length) FROM log_chunks WHERE deployment_id = ? "
+            "GROUP BY segment ORDER BY segment",
+            (deployment_id,)
+        ).fetchall()
+        return [tuple(row) for row in rows]
+
+    # Task timings
+
+    def add_task_timings(self, deployment_id: str, timings: List[Dict[str, Any]]):
+        """Append Ansible task / OpenTofu resource timing records to a deployment"""
+        if not timings:
+            return
+        self._submit(self._write_task_timings, deployment_id, [
+            (timing['kind'], timing['role'], timing['name'], timing.get('action'), timing.get('status'),
+             timing['started_at'], timing.get('finished_at'), timing.get('duration'))
+            for timing in timings
+        ])
+
+    @staticmethod
+    def _write_task_timings(conn: sqlite3.Connection, deployment_id: str, rows: List[Tuple]):
+        offset = conn.execute(
+            "SELECT COALESCE(MAX(idx) + 1, 0) FROM task_timings WHERE deployment_id = ?", (deployment_id,)
+        ).fetchone()[0]
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO task_timings (deployment_id, idx, kind, role, name, action, status, "
+                "started_at, finished_at, duration) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(deployment_id, offset + index, *row) for index, row in enumerate(rows)]
+            )
+
+    def get_task_timings(self, runs: int = 20) -> List[Dict[str, Any]]:
+        """Timing records of the most recent ``runs`` deployments that have any"""
+        rows = self.conn.execute(
+            "SELECT t.*, d.started_at AS deployment_started_at FROM task_timings t "
+            "JOIN deployments d ON d.id = t.deployment_id "
+            "WHERE t.deployment_id IN ("
+            "  SELECT d2.id FROM deployments d2 "
+            "  WHERE EXISTS (SELECT 1 FROM task_timings t2 WHERE t2.deployment_id = d2.id) "
+            "  ORDER BY d2.started_at DESC LIMIT ?"
+            ") ORDER BY d.started_at, t.idx",
+            (runs,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    # Settings
+
+    def get_setting(self, key: str, default: Any = None) -> Any:
+        if key not in self._settings:
+            row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+            self._settings[key] = row['value'] if row else None
+        encoded = self._settings[key]
+        return json.loads(encoded) if encoded is not None else default
+
+    def set_setting(self, key: str, value: Any):
+        encoded = self._settings[key] = json.dumps(value)
+        self._submit(_execute, "INSERT INTO settings (key, value) VALUES (?, ?) "
+                               "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (key, encoded))
+
+
+def _execute(conn: sqlite3.Connection, sql: str, parameters: Tuple):
+    conn.execute(sql, parameters)
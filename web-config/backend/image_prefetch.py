@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Pre-pulls the container images of the enabled services while the playbook runs
+"""
+import asyncio
+import json
+import os
+import re
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Any, List, Optional
+
+from change_planner import SERVICE_TF_FILES
+from process_runner import run_process, ProcessTimeoutError, SUDO_COMMAND
+
+# k3s binary, whose crictl pulls through the CRI so the registries.yaml mirrors apply
+K3S_COMMAND = os.getenv('HOMELAB_TOOL_K3S', '/usr/local/bin/k3s')
+
+# Images pulled at the same time; more mostly competes for the same uplink
+PREFETCH_CONCURRENCY = 3
+
+# Seconds between checks whether the container runtime is up yet
+RUNTIME_POLL_INTERVAL = 5
+
+# Timeout of a runtime check or image inspection
+PROBE_TIMEOUT = 15
+
+# Longest a single image pull may take
+PULL_TIMEOUT = 900
+
+# `image = "..."` or `image = var.name` in a Terraform container block
+IMAGE_PATTERN = re.compile(r'^\s*image\s*=\s*(?:"([^"$]+)"|var\.(\w+))\s*$', re.MULTILINE)
+VARIABLE_PATTERN = re.compile(r'^variable\s+"(\w+)"\s*\{(.*?)^\}', re.MULTILINE | re.DOTALL)
+DEFAULT_PATTERN = re.compile(r'^\s*default\s*=\s*"([^"]*)"\s*$', re.MULTILINE)
+TFVARS_PATTERN = re.compile(r'^\s*(\w+)\s*=\s*"([^"]*)"\s*$', re.MULTILINE)
+
+
+def terraform_variables(terraform_dir: Path) -> Dict[str, str]:
+    """String variables: declared defaults, overridden by user.tfvars as `-var-file` would"""
+    values = {}
+    for path in sorted(terraform_dir.glob("*.tf")):
+        for name, body in VARIABLE_PATTERN.findall(path.read_text()):
+            default = DEFAULT_PATTERN.search(body)
+            if default:
+                values[name] = default.group(1)
+    tfvars = terraform_dir / "user.tfvars"
+    if tfvars.exists():
+        values.update(TFVARS_PATTERN.findall(tfvars.read_text()))
+    return values
+
+
+def service_images(config: Dict[str, Any], terraform_dir: Path) -> List[str]:
+    """Images the Terraform definitions of the enabled services run, in service order"""
+    services = config.get('services', {})
+    variables = terraform_variables(terraform_dir)
+    images = []
+    for service, tf_file in SERVICE_TF_FILES.items():
+        path = terraform_dir / tf_file
+        if not services.get(service) or not path.exists():
+            continue
+        for literal, variable in IMAGE_PATTERN.findall(path.read_text()):
+            image = literal or variables.get(variable)
+            if image and image not in images:
+                images.append(image)
+    return images
+
+
+class ImagePrefetcher:
+    """Pulls images into the cluster's containerd, a few at a time
+
+    Each result records whether the image was already present, how many
+    bytes it takes up and when its pull finished, so the caller can tell
+    which pulls came off the critical path.
+    """
+
+    def __init__(self, concurrency: int = PREFETCH_CONCURRENCY):
+        self.concurrency = concurrency
+
+    async def _crictl(self, *args: str, timeout: float = PROBE_TIMEOUT):
+        return await run_process([SUDO_COMMAND, K3S_COMMAND, "crictl", *args], timeout=timeout)
+
+    async def runtime_ready(self) -> bool:
+        try:
+            return (await self._crictl("info")).returncode == 0
+        except (OSError, ProcessTimeoutError):
+            return False
+
+    async def image_size(self, image: str) -> Optional[int]:
+        """Bytes the image takes up in containerd, or None when it is not present"""
+        try:
+            result = await self._crictl("inspecti", "-o", "json", image)
+        except (OSError, ProcessTimeoutError):
+            return None
+        if result.returncode != 0:
+            return None
+        try:
+            return int(json.loads(result.stdout)['status']['size'])
+        except (ValueError, KeyError, TypeError):
+            return 0
+
+    async def pull(self, image: str) -> Dict[str, Any]:
+        started = time.monotonic()
+        size = await self.image_size(image)
+        if size is not None:
+            return {'image': image, 'status': 'present', 'bytes': size, 'seconds': 0.0,
+                    'finished': time.monotonic()}
+        try:
+            result = await self._crictl("pull", image, timeout=PULL_TIMEOUT)
+            error = None if result.returncode == 0 else (result.stderr or result.stdout).strip()
+        except (OSError, ProcessTimeoutError) as e:
+            error = str(e)
+        finished = time.monotonic()
+        if error is not None:
+            return {'image': image, 'status': 'failed', 'error': error, 'bytes': 0,
+                    'seconds': finished - started, 'finished': finished}
+        return {'image': image, 'status': 'pulled', 'bytes': await self.image_size(image) or 0,
+                'seconds': finished - started, 'finished': finished}
+
+    async def pull_all(self, images: List[str],
+                       on_result: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+                       ) -> List[Dict[str, Any]]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(image: str) -> Dict[str, Any]:
+            async with semaphore:
+                result = await self.pull(image)
+            if on_result is not None:
+                await on_result(result)
+            return result
+
+        return list(await asyncio.gather(*(fetch(image) for image in images)))
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Readiness checks against the Kubernetes API, using list + watch instead of kubectl
+"""
+import asyncio
+import base64
+import json
+import os
+import ssl
+import tempfile
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Any, AsyncIterator, Optional, Tuple
+
+if TYPE_CHECKING:
+    import httpx
+
+# Kubeconfig locations tried in order when KUBECONFIG is not set; the k3s role copies the
+# cluster's kubeconfig into the homelab user's home
+KUBECONFIG_CANDIDATES = [
+    Path(os.getenv('HOMELAB_HOME', '/opt/homelab')) / ".kube" / "config",
+    Path.home() / ".kube" / "config",
+    Path("/etc/rancher/k3s/k3s.yaml"),
+]
+
+# API collection of each workload kind
+WORKLOAD_RESOURCES = {
+    'deployment': 'deployments',
+    'statefulset': 'statefulsets',
+}
+
+# Connections kept to the API server; each running watch holds one
+MAX_CONNECTIONS = 10
+
+# Timeout of ordinary requests; watches only time out through WATCH_SECONDS
+REQUEST_TIMEOUT = 10
+
+# Server-side lifetime of one watch request before it is re-established
+WATCH_SECONDS = 60
+
+# Pause before retrying after the API server dropped a watch or could not be reached
+RETRY_DELAY = 1
+
+
+class KubeError(Exception):
+    """The API server could not be reached or refused a request"""
+
+
+class RolloutError(Exception):
+    """A workload's rollout failed and will not become ready by waiting"""
+
+
+def find_kubeconfig() -> Optional[Path]:
+    """First kubeconfig named by KUBECONFIG or found at a known location"""
+    if os.getenv('KUBECONFIG'):
+        candidates = [Path(path) for path in os.environ['KUBECONFIG'].split(os.pathsep) if path]
+    else:
+        candidates = KUBECONFIG_CANDIDATES
+    return next((path for path in candidates if path.is_file()), None)
+
+
+def _pem(data: Optional[str], path: Optional[str]) -> Optional[bytes]:
+    """Inline base64 (``*-data``) or file content of a kubeconfig credential"""
+    if data:
+        return base64.b64decode(data)
+    if path:
+        return Path(path).read_bytes()
+    return None
+
+
+def client_settings(kubeconfig: Path) -> Dict[str, Any]:
+    """Server URL, TLS context and headers of the kubeconfig's current context"""
+    import yaml
+
+    config = yaml.safe_load(kubeconfig.read_text()) or {}
+    contexts = {entry['name']: entry['context'] for entry in config.get('contexts') or []}
+    clusters = {entry['name']: entry['cluster'] for entry in config.get('clusters') or []}
+    users = {entry['name']: entry.get('user') or {} for entry in config.get('users') or []}
+
+    context = contexts.get(config.get('current-context')) or next(iter(contexts.values()), None)
+    if context is None:
+        raise KubeError(f"No context in {kubeconfig}")
+    cluster = clusters[context['cluster']]
+    user = users.get(context.get('user'), {})
+
+    verify: Any = True
+    if cluster['server'].startswith('https'):
+        if cluster.get('insecure-skip-tls-verify'):
+            verify = False
+        else:
+            ca = _pem(cluster.get('certificate-authority-data'), cluster.get('certificate-authority'))
+            verify = ssl.create_default_context(cadata=ca.decode() if ca else None)
+            if ca is None:
+                verify.load_default_certs()
+
+        cert = _pem(user.get('client-certificate-data'), user.get('client-certificate'))
+        key = _pem(user.get('client-key-data'), user.get('client-key'))
+        if cert and key:
+            if verify is False:
+                verify = ssl.create_default_context()
+                verify.check_hostname = False
+                verify.verify_mode = ssl.CERT_NONE
+            # ssl only loads client certificates from a file; it is read right away and removed
+            fd, cert_path = tempfile.mkstemp(suffix=".pem")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(cert + b"\n" + key)
+                verify.load_cert_chain(cert_path)
+            finally:
+                os.unlink(cert_path)
+
+    headers = {}
+    token = user.get('token') or (Path(user['tokenFile']).read_text().strip() if user.get('tokenFile') else None)
+    if token:
+        headers['Authorization'] = f"Bearer {token}"
+    return {'base_url': cluster['server'], 'verify': verify, 'headers': headers}
+
+
+def workload_status(kind: str, workload: Dict[str, Any]) -> Tuple[bool, str]:
+    """Whether a Deployment or StatefulSet finished rolling out, following `kubectl rollout status`
+
+    Returns ``(ready, description)``; raises RolloutError once a Deployment
+    has exceeded its progress deadline.
+    """
+    spec, status = workload.get('spec') or {}, workload.get('status') or {}
+    generation = (workload.get('metadata') or {}).get('generation', 0)
+    if status.get('observedGeneration', 0) < generation:
+        return False, "waiting for the new spec to be observed"
+
+    replicas = spec.get('replicas', 1)
+    if kind == 'deployment':
+        for condition in status.get('conditions') or []:
+            if condition.get('type') == 'Progressing' and condition.get('reason') == 'ProgressDeadlineExceeded':
+                raise RolloutError(condition.get('message') or "progress deadline exceeded")
+        updated = status.get('updatedReplicas', 0)
+        if updated < replicas:
+            return False, f"{updated} of {replicas} replicas updated"
+        if status.get('replicas', 0) > updated:
+            return False, f"{status['replicas'] - updated} old replicas pending termination"
+        available = status.get('availableReplicas', 0)
+        if available < updated:
+            return False, f"{available} of {updated} updated replicas available"
+        return True, f"{available} replicas available"
+
+    ready = status.get('readyReplicas', 0)
+    if ready < replicas:
+        return False, f"{ready} of {replicas} pods ready"
+    if ((spec.get('updateStrategy') or {}).get('type', 'RollingUpdate') == 'RollingUpdate'
+            and status.get('updateRevision') != status.get('currentRevision')):
+        return False, "waiting for pods to be updated"
+    return True, f"{ready} pods ready"
+
+
+class ReadinessWatcher:
+    """Waits for cluster workloads to become ready through the Kubernetes API
+
+    One pooled HTTP client is shared by every check. Each wait lists its
+    workload once and then follows a watch stream, so a status change is
+    seen as soon as the API server reports it rather than on the next poll.
+    The kubeconfig is looked up on first use, since the cluster (and its
+    kubeconfig) may only be created by the deployment itself, and the client
+    is rebuilt when the file changes.
+    """
+
+    def __init__(self, kubeconfig: Optional[Path] = None):
+        self.kubeconfig = kubeconfig
+        self._client: Optional['httpx.AsyncClient'] = None
+        self._signature: Optional[Tuple[str, int]] = None
+
+    async def client(self) -> 'httpx.AsyncClient':
+        # Imported on first use; httpx and PyYAML are a sizeable share of the service's start-up time
+        import httpx
+        import yaml
+
+        path = self.kubeconfig or find_kubeconfig()
+        if path is None:
+            raise KubeError("No kubeconfig found; set KUBECONFIG")
+        try:
+            signature = (str(path), os.stat(path).st_mtime_ns)
+        except OSError as e:
+            raise KubeError(f"Cannot read kubeconfig {path}: {e}")
+
+        if self._client is None or signature != self._signature:
+            try:
+                # A small local file; read inline so concurrent callers can't build two clients
+                settings = client_settings(path)
+            except (OSError, ValueError, KeyError, ssl.SSLError, yaml.YAMLError) as e:
+                raise KubeError(f"Invalid kubeconfig {path}: {e}")
+            previous, self._client = self._client, httpx.AsyncClient(
+                **settings,
+                timeout=REQUEST_TIMEOUT,
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+            )
+            self._signature = signature
+            if previous is not None:
+                await previous.aclose()
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+    async def get(self, path: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        import httpx
+
+        client = await self.client()
+        try:
+            response = await client.get(path, params=params)
+        except httpx.HTTPError as e:
+            raise KubeError(f"Kubernetes API not reachable: {e}")
+        if response.status_code != 200:
+            raise KubeError(f"GET {path} returned {response.status_code}: {response.text[:200]}")
+        return response.json()
+
+    async def watch(self, path: str, params: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """Events of one watch request, until the server ends it"""
+        import httpx
+
+        client = await self.client()
+        params = {**params, 'watch': 'true', 'allowWatchBookmarks': 'true', 'timeoutSeconds': WATCH_SECONDS}
+        timeout = httpx.Timeout(REQUEST_TIMEOUT, read=WATCH_SECONDS + REQUEST_TIMEOUT)
+        try:
+            async with client.stream('GET', path, params=params, timeout=timeout) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    raise KubeError(f"Watch {path} returned {response.status_code}: {response.text[:200]}")
+                async for line in response.aiter_lines():
+                    if line.strip():
+                        yield json.loads(line)
+        except (httpx.HTTPError, ValueError) as e:
+            raise KubeError(f"Watch {path} failed: {e}")
+
+    async def cluster_summary(self) -> Dict[str, Any]:
+        """Node readiness and pod phases across the cluster"""
+        nodes, pods = await asyncio.gather(self.get('/api/v1/nodes'), self.get('/api/v1/pods'))
+        ready, not_ready = [], []
+        for node in nodes.get('items', []):
+            conditions = {c.get('type'): c.get('status') for c in (node.get('status') or {}).get('conditions') or []}
+            (ready if conditions.get('Ready') == 'True' else not_ready).append(node['metadata']['name'])
+
+        phases: Dict[str, int] = {}
+        for pod in pods.get('items', []):
+            phase = (pod.get('status') or {}).get('phase', 'Unknown')
+            phases[phase] = phases.get(phase, 0) + 1
+        return {'ready_nodes': ready, 'not_ready_nodes': not_ready, 'pod_phases': phases}
+
+    async def wait_ready(self, kind: str, namespace: str, name: str,
+                         on_progress: Optional[Callable[[str], Awaitable[None]]] = None) -> float:
+        """Block until a workload has rolled out; returns the seconds waited
+
+        ``on_progress`` is awaited with a description whenever the rollout
+        state changes. Wrap the call in a timeout; the wait itself only ends
+        when the workload is ready or its rollout failed.
+        """
+        started = time.monotonic()
+        path = f"/apis/apps/v1/namespaces/{namespace}/{WORKLOAD_RESOURCES[kind]}"
+        params = {'fieldSelector': f"metadata.name={name}"}
+        last_message = None
+
+        async def report(message: str):
+            nonlocal last_message
+            if message != last_message and on_progress is not None:
+                await on_progress(message)
+            last_message = message
+
+        while True:
+            try:
+                listing = await self.get(path, params)
+                items = listing.get('items', [])
+                if items:
+                    ready, message = workload_status(kind, items[0])
+                    if ready:
+                        return time.monotonic() - started
+                    await report(message)
+                else:
+                    await report(f"{kind} {namespace}/{name} does not exist yet")
+
+                # Follow changes from the listed version; a watch that ends or expires is
+                # resumed by listing again
+                resource_version = (listing.get('metadata') or {}).get('resourceVersion')
+                events = self.watch(path, {**params, 'resourceVersion': resource_version})
+                try:
+                    async for event in events:
+                        event_type, workload = event.get('type'), event.get('object') or {}
+                        if event_type == 'ERROR':
+                            # Typically 410 Gone: the listed version is too old to watch from
+                            break
+                        if event_type == 'DELETED':
+                            await report(f"{kind} {namespace}/{name} was deleted")
+                        elif event_type in ('ADDED', 'MODIFIED'):
+                            ready, message = workload_status(kind, workload)
+                            if ready:
+                                return time.monotonic() - started
+                            await report(message)
+                finally:
+                    # Release the streamed connection back to the pool right away
+                    await events.aclose()
+            except KubeError as e:
+                await report(str(e))
+                await asyncio.sleep(RETRY_DELAY)
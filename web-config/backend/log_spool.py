@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Full deployment logs spooled to append-only, gzip-compressed segment files
+"""
+import gzip
+import re
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# A new segment file is started once the current one reaches this size
+SEGMENT_BYTES = 8 * 1024 * 1024
+
+# Each flushed batch becomes one gzip member; level 6 compresses playbook output ~10x cheaply
+COMPRESS_LEVEL = 6
+
+# Lines returned by one paged read
+DEFAULT_PAGE_LINES = 500
+MAX_PAGE_LINES = 5000
+
+# Read size when streaming segment files to a client
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# What a download of a deployment without spooled output consists of
+EMPTY_GZIP = gzip.compress(b'', mtime=0)
+
+# (segment, offset, length, first_seq, last_seq) of one gzip member, as stored in the log_chunks table
+Chunk = Tuple[int, int, int, int, int]
+
+
+def line_matcher(contains: Optional[str] = None, regex: Optional[str] = None,
+                 ignore_case: bool = False) -> Optional[Callable[[str], bool]]:
+    """Build a line filter, or None to match everything; raises re.error for a bad pattern"""
+    if regex:
+        pattern = re.compile(regex, re.IGNORECASE if ignore_case else 0)
+        return lambda line: pattern.search(line) is not None
+    if contains:
+        if ignore_case:
+            needle = contains.casefold()
+            return lambda line: needle in line.casefold()
+        return lambda line: contains in line
+    return None
+
+
+class LogSpool:
+    """Writes and reads the segment files of every deployment under one directory
+
+    ``spool_dir/<deployment_id>/<segment>.log.gz`` holds the log as a series
+    of gzip members, one per flushed batch. Concatenated gzip members are
+    themselves a valid gzip file, so segments can be downloaded as they are.
+    The caller keeps the index of where each member lives and which
+    sequence numbers it covers; reads then decompress only the members they need.
+    """
+
+    def __init__(self, spool_dir: Path):
+        self.spool_dir = Path(spool_dir)
+        # deployment_id -> (segment number, size) of the segment being appended to
+        self._open: Dict[str, Tuple[int, int]] = {}
+
+    def segment_path(self, deployment_id: str, segment: int) -> Path:
+        return self.spool_dir / deployment_id / f"{segment:06d}.log.gz"
+
+    def append(self, deployment_id: str, first_seq: int, lines: List[str]) -> Chunk:
+        """Compress consecutive lines into a new member and return its index entry"""
+        # Keep one line per sequence number; multi-line messages are stored escaped
+        text = '\n'.join(line.replace('\n', '\\n') for line in lines) + '\n'
+        data = gzip.compress(text.encode('utf-8', errors='replace'), COMPRESS_LEVEL, mtime=0)
+
+        segment, size = self._current_segment(deployment_id)
+        if size and size + len(data) > SEGMENT_BYTES:
+            segment, size = segment + 1, 0
+        with open(self.segment_path(deployment_id, segment), 'ab') as f:
+            f.write(data)
+        self._open[deployment_id] = (segment, size + len(data))
+        return segment, size, len(data), first_seq, first_seq + len(lines) - 1
+
+    def close(self, deployment_id: str):
+        """Forget the open segment of a finished deployment"""
+        self._open.pop(deployment_id, None)
+
+    def _current_segment(self, deployment_id: str) -> Tuple[int, int]:
+        if deployment_id not in self._open:
+            directory = self.spool_dir / deployment_id
+            directory.mkdir(parents=True, exist_ok=True)
+            segments = sorted(directory.glob('*.log.gz'))
+            # Never append to a segment written by an earlier process: a crash mid-flush may
+            # have left unindexed bytes at its end, which reads and downloads then skip
+            last = int(segments[-1].name.split('.')[0]) if segments else 0
+            self._open[deployment_id] = (last + 1, 0)
+        return self._open[deployment_id]
+
+    def iter_lines(self, deployment_id: str, chunks: List[Chunk]) -> Iterator[Tuple[int, str]]:
+        """Yield (seq, line) from the given members, one member in memory at a time"""
+        handle, handle_segment = None, None
+        try:
+            for segment, offset, length, first_seq, _ in chunks:
+                if segment != handle_segment:
+                    if handle is not None:
+                        handle.close()
+                    handle = open(self.segment_path(deployment_id, segment), 'rb')
+                    handle_segment = segment
+                handle.seek(offset)
+                text = gzip.decompress(handle.read(length)).decode('utf-8', errors='replace')
+                # split('\n') rather than splitlines(): lines may contain \r and other breaks
+                yield from enumerate(text[:-1].split('\n'), start=first_seq)
+        finally:
+            if handle is not None:
+                handle.close()
+
+    def read(self, deployment_id: str, chunks: List[Chunk], after: int = 0, limit: int = DEFAULT_PAGE_LINES,
+             matcher: Optional[Callable[[str], bool]] = None) -> Tuple[List[Tuple[int, str]], int]:
+        """Return up to ``limit`` matching (seq, line) pairs after ``after``
+
+        Also returns the last sequence number examined, the cursor for the
+        next page. Blocking; run it in a worker thread.
+        """
+        entries: List[Tuple[int, str]] = []
+        scanned = after
+        for seq, line in self.iter_lines(deployment_id, chunks):
+            if seq <= after:
+                continue
+            scanned = seq
+            if matcher is None or matcher(line):
+                entries.append((seq, line))
+                if len(entries) >= limit:
+                    break
+        return entries, scanned
+
+    def stream(self, deployment_id: str, extents: List[Tuple[int, int]]) -> Iterator[bytes]:
+        """Yield the raw gzip bytes of the given (segment, size) extents"""
+        if not extents:
+            yield EMPTY_GZIP
+        for segment, size in extents:
+            with open(self.segment_path(deployment_id, segment), 'rb') as f:
+                remaining = size
+                while remaining > 0:
+                    data = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield data
@@ -2,23 +2,36 @@
 """
 FastAPI backend for Home Lab configuration interface
 """
-import os
+import time
+
+# Start of module import, for the start-up time logged once the app is ready
+IMPORT_STARTED = time.perf_counter()
+
+import re
 import asyncio
-import subprocess
+import logging
 from pathlib import Path
-from typing import Dict, Any, List
-import yaml
+from typing import TYPE_CHECKING, Dict, Any, List, Optional
 import json
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
-from pydantic import BaseModel, field_validator
-import uvicorn
+from fastapi import FastAPI, HTTPException, WebSocket, Request, Response
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError, field_validator
 
 from config_generator import ConfigGenerator
-from deployment import DeploymentManager
+from log_spool import DEFAULT_PAGE_LINES, MAX_PAGE_LINES
+from static_cache import StaticAssetCache
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE, RequestMetricsMiddleware
+
+if TYPE_CHECKING:
+    from deployment import DeploymentManager
 
 app = FastAPI(title="Home Lab Configuration API", version="1.0.0")
+app.add_middleware(RequestMetricsMiddleware)
+
+WEBSOCKET_CONNECTIONS = REGISTRY.gauge('homelab_websocket_connections', 'Open WebSocket connections')
+
+# Largest number of candidate configurations accepted by one batch validation request
+MAX_BATCH_VALIDATE = 1000
 
 # Configuration models
 class NetworkConfig(BaseModel):
@@ -47,11 +60,46 @@ class StorageConfig(BaseModel):
     registry_size: str = "10Gi"
     gitea_size: str = "10Gi"
 
+class AnsibleConfig(BaseModel):
+    """Stage 2 playbook tuning, written to the managed ansible.cfg"""
+    fact_caching: bool = True
+    fact_cache_timeout: int = 86400
+    pipelining: bool = True
+    gathering: str = "smart"
+    gather_subset: str = "!hardware"
+    forks: int = 0  # 0 picks a fork count from the CPU count
+    strategy: str = "linear"
+
+class OpenTofuConfig(BaseModel):
+    parallelism: int = 10
+
+class RegistryMirrorConfig(BaseModel):
+    """Pull-through caches on the server that k3s pulls public images through"""
+    enabled: bool = True
+    upstreams: List[str] = ["docker.io", "ghcr.io"]
+
+class NodeConfig(BaseModel):
+    """A cluster machine; the server is the one running this interface, agents are reached over SSH"""
+    name: str
+    address: str
+    role: str = "agent"
+    ssh_user: str = "homelab"
+    ssh_port: int = 22
+    ssh_key_file: Optional[str] = None
+
+class ClusterConfig(BaseModel):
+    nodes: List[NodeConfig] = []  # empty: this machine is a single-node cluster
+    agent_batch_size: int = 2
+
 class HomeLabConfig(BaseModel):
     admin_password: str
     services: ServicesConfig
     network: NetworkConfig
     storage: StorageConfig
+    ansible: AnsibleConfig = AnsibleConfig()
+    opentofu: OpenTofuConfig = OpenTofuConfig()
+    cluster: ClusterConfig = ClusterConfig()
+    registry_mirror: RegistryMirrorConfig = RegistryMirrorConfig()
 
     @field_validator('admin_password')
     @classmethod
@@ -62,27 +110,67 @@ class HomeLabConfig(BaseModel):
 
 # Global state
 config_generator = ConfigGenerator()
-deployment_manager = DeploymentManager()
-current_config: HomeLabConfig = None
+
+# Importing the deployment modules, opening the database, recovering interrupted runs and
+# loading the saved configuration happen on a worker thread started at start-up, so neither
+# the event loop nor the health check waits for them
+_deployment_manager: Optional["DeploymentManager"] = None
+_deployment_manager_ready: Optional[asyncio.Future] = None
+current_config: Optional[HomeLabConfig] = None
+
+def _open_deployment_manager() -> "DeploymentManager":
+    global _deployment_manager, current_config
+    from deployment import DeploymentManager
+
+    deployment_manager = DeploymentManager()
+    # The last saved configuration survives service restarts via the deployment store
+    saved_config = deployment_manager.store.get_setting('current_config')
+    current_config = HomeLabConfig(**saved_config) if saved_config else None
+    _deployment_manager = deployment_manager
+    return deployment_manager
+
+def _start_deployment_manager() -> asyncio.Future:
+    global _deployment_manager_ready
+    ready = _deployment_manager_ready
+    # A failed attempt is retried by the next request that needs the manager
+    if ready is None or (ready.done() and ready.exception() is not None):
+        ready = _deployment_manager_ready = asyncio.ensure_future(asyncio.to_thread(_open_deployment_manager))
+    return ready
+
+async def get_deployment_manager() -> "DeploymentManager":
+    # Shielded, so a request cancelled while it waits doesn't cancel the start-up for everyone
+    return await asyncio.shield(_start_deployment_manager())
 
 # WebSocket connections for real-time updates
 class ConnectionManager:
+    """Tracks WebSocket clients, each with its own bounded outgoing queue
+
+    Messages are queued rather than sent inline, so a slow browser only
+    backs up (and eventually drops the oldest entries of) its own queue.
+    """
+
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Dict[WebSocket, asyncio.Queue] = {}
+
+    async def connect(self, websocket: WebSocket) -> asyncio.Queue:
+        from deployment import SUBSCRIBER_QUEUE_SIZE
 
-    async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.active_connections[websocket] = queue
+        WEBSOCKET_CONNECTIONS.inc()
+        return queue
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        if self.active_connections.pop(websocket, None) is not None:
+            WEBSOCKET_CONNECTIONS.dec()
 
-    async def send_message(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                await self.disconnect(connection)
+    async def pump(self, websocket: WebSocket):
+        """Drain a client's queue onto its socket until the socket fails"""
+        queue = self.active_connections[websocket]
+        while True:
+            message = await queue.get()
+            await websocket.send_text(json.dumps(message))
 
 manager = ConnectionManager()
 
@@ -92,6 +180,11 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "message": "Home Lab Configuration API"}
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    return PlainTextResponse(REGISTRY.render(), media_type=METRICS_CONTENT_TYPE)
+
 @app.get("/api/config/defaults")
 async def get_default_config():
     """Get default configuration values"""
@@ -99,7 +192,11 @@ async def get_default_config():
         "admin_password": "",
         "services": ServicesConfig().dict(),
         "network": NetworkConfig().dict(),
-        "storage": StorageConfig().dict()
+        "storage": StorageConfig().dict(),
+        "ansible": AnsibleConfig().dict(),
+        "opentofu": OpenTofuConfig().dict(),
+        "cluster": ClusterConfig().dict(),
+        "registry_mirror": RegistryMirrorConfig().dict()
     }
 
 @app.post("/api/config/validate")
@@ -115,27 +212,55 @@ async def validate_config(config: HomeLabConfig):
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.post("/api/config/validate/batch")
+async def validate_config_batch(configs: List[Dict[str, Any]]):
+    """Validate many candidate configurations in one request
+
+    Returns one result per configuration, in request order, each with its
+    own list of errors. Nothing is saved.
+    """
+    if len(configs) > MAX_BATCH_VALIDATE:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_VALIDATE} configurations per request")
+
+    results = []
+    for candidate in configs:
+        try:
+            errors = config_generator.validate_config(HomeLabConfig(**candidate).dict())
+        except ValidationError as e:
+            errors = [f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()]
+        results.append({"valid": not errors, "errors": errors})
+
+    return {
+        "results": results,
+        "valid_count": sum(1 for result in results if result["valid"])
+    }
+
 @app.post("/api/config/save")
 async def save_config(config: HomeLabConfig):
     """Save configuration and generate Ansible/Terraform files"""
     global current_config
 
     try:
+        config_data = config.dict()
+
         # Validate configuration
-        validation_errors = config_generator.validate_config(config.dict())
+        validation_errors = config_generator.validate_config(config_data)
         if validation_errors:
             raise HTTPException(status_code=400, detail=validation_errors)
 
-        # Generate configuration files
-        generated_files = await config_generator.generate_files(config.dict())
+        # Generate configuration files; unchanged ones are left as they are
+        generated = await config_generator.generate_files(config_data)
 
-        # Store current config
+        # Store current config; the manager is created first since creating it loads the saved one
+        store = (await get_deployment_manager()).store
         current_config = config
+        store.set_setting('current_config', config_data)
 
         return {
             "success": True,
             "message": "Configuration saved successfully",
-            "generated_files": generated_files
+            "generated_files": generated['generated'],
+            "changed_files": generated['changed']
         }
     except Exception as e:
         import traceback
@@ -144,16 +269,19 @@ async def save_config(config: HomeLabConfig):
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 @app.post("/api/deployment/start")
-async def start_deployment():
-    """Start the deployment process"""
-    global current_config
+async def start_deployment(force_full: bool = False):
+    """Start the deployment process
 
+    Only the roles and resources affected by changes since the last
+    successful deployment are run, unless ``force_full`` is set.
+    """
+    deployment_manager = await get_deployment_manager()
     if not current_config:
         raise HTTPException(status_code=400, detail="No configuration saved")
 
     try:
         # Start deployment in background
-        deployment_id = await deployment_manager.start_deployment(current_config.dict())
+        deployment_id = await deployment_manager.start_deployment(current_config.dict(), force_full=force_full)
 
         return {
             "success": True,
@@ -163,42 +291,182 @@ async def start_deployment():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/deployment/cancel/{deployment_id}")
+async def cancel_deployment(deployment_id: str):
+    """Cancel a queued or running deployment, killing the commands it started"""
+    deployment_manager = await get_deployment_manager()
+    try:
+        status = await deployment_manager.cancel_deployment(deployment_id)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "success": status['status'] == 'cancelled',
+        "deployment": status,
+        "message": "Deployment cancelled" if status['status'] == 'cancelled' else "Cancellation in progress"
+    }
+
+@app.get("/api/deployment/step-budgets")
+async def get_step_budgets():
+    """Time budget of each deployment step, in seconds"""
+    return (await get_deployment_manager()).get_step_budgets()
+
+@app.put("/api/deployment/step-budgets")
+async def update_step_budgets(budgets: Dict[str, float]):
+    """Override step time budgets for deployments started from now on"""
+    try:
+        return (await get_deployment_manager()).set_step_budgets(budgets)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/toolchain")
+async def get_toolchain(refresh: bool = False):
+    """Report the resolved deployment tools and their versions"""
+    toolchain = (await get_deployment_manager()).toolchain
+    if refresh:
+        toolchain.invalidate()
+    return {"tools": await toolchain.resolve_all()}
+
+@app.get("/api/deployments")
+async def list_deployments(limit: int = 20):
+    """List recent deployments, including ones from before the last restart"""
+    deployment_manager = await get_deployment_manager()
+    return {
+        "deployments": deployment_manager.list_deployments(limit),
+        "scheduler": deployment_manager.scheduler.snapshot()
+    }
+
+@app.get("/api/deployments/profile")
+async def get_deployment_profile(top: int = 10, runs: int = 20):
+    """Where deployments spend their time, across the last ``runs`` deployments
+
+    Returns the ``top`` slowest Ansible tasks and OpenTofu resource operations,
+    p50/p95 of each role's and resource type's time per run, and the tasks
+    that got slower or faster between the last two runs.
+    """
+    if top < 1 or runs < 1:
+        raise HTTPException(status_code=400, detail="top and runs must be at least 1")
+    return (await get_deployment_manager()).get_profile(top=top, runs=runs)
+
 @app.get("/api/deployment/status/{deployment_id}")
-async def get_deployment_status(deployment_id: str):
-    """Get deployment status"""
+async def get_deployment_status(deployment_id: str, request: Request,
+                                since: Optional[int] = None, wait: float = 0):
+    """Get deployment status
+
+    ``since`` returns only log entries with a greater sequence number and
+    ``wait`` long-polls for up to that many seconds until something changes.
+    Responses carry an ETag; an unchanged status answers 304.
+    """
+    deployment_manager = await get_deployment_manager()
+    try:
+        status = await deployment_manager.get_status(deployment_id, since=since, wait=wait)
+        etag = f'W/"{deployment_id}-{deployment_manager.get_version(deployment_id)}-{since}"'
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    return JSONResponse(content=status, headers={'ETag': etag})
+
+@app.get("/api/deployment/logs/{deployment_id}")
+async def get_deployment_logs(deployment_id: str, after: int = 0, limit: int = DEFAULT_PAGE_LINES,
+                              contains: Optional[str] = None, regex: Optional[str] = None,
+                              ignore_case: bool = False):
+    """Page through the full log of a deployment
+
+    ``contains`` keeps lines with that substring and ``regex`` lines matching
+    that pattern; the search runs on the server, one compressed chunk at a time.
+    """
+    if not 1 <= limit <= MAX_PAGE_LINES:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_LINES}")
+    deployment_manager = await get_deployment_manager()
+    try:
+        return await deployment_manager.read_logs(deployment_id, after=after, limit=limit, contains=contains,
+                                                  regex=regex, ignore_case=ignore_case)
+    except re.error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid regex: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/deployment/logs/{deployment_id}/download")
+async def download_deployment_logs(deployment_id: str):
+    """Download the full log of a deployment as a gzip file"""
+    deployment_manager = await get_deployment_manager()
     try:
-        status = await deployment_manager.get_status(deployment_id)
-        return status
+        chunks = await deployment_manager.log_download(deployment_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return StreamingResponse(chunks, media_type="application/gzip", headers={
+        'Content-Disposition': f'attachment; filename="deployment-{deployment_id}.log.gz"'
+    })
 
 @app.websocket("/ws/deployment")
 async def websocket_deployment_logs(websocket: WebSocket):
-    """WebSocket endpoint for real-time deployment logs"""
-    await manager.connect(websocket)
-    try:
+    """WebSocket endpoint for real-time deployment logs
+
+    Clients subscribe with ``?deployment_id=<id>`` or by sending
+    ``{"action": "subscribe", "deployment_id": "<id>"}``; log lines and
+    status changes are then pushed as JSON messages as they happen.
+    """
+    from deployment import offer_latest
+
+    deployment_manager = await get_deployment_manager()
+    queue = await manager.connect(websocket)
+    subscriptions = set()
+
+    def subscribe(deployment_id: str):
+        try:
+            deployment_manager.subscribe(deployment_id, queue)
+            subscriptions.add(deployment_id)
+        except Exception as e:
+            offer_latest(queue, {'type': 'error', 'deployment_id': deployment_id, 'message': str(e)})
+
+    async def receive():
         while True:
             data = await websocket.receive_text()
-            # Echo back for now - in real implementation, this would handle log streaming
-            await websocket.send_text(f"Echo: {data}")
-    except WebSocketDisconnect:
+            try:
+                request = json.loads(data)
+            except ValueError:
+                offer_latest(queue, {'type': 'error', 'message': 'Invalid JSON message'})
+                continue
+            deployment_id = request.get('deployment_id')
+            if request.get('action') == 'subscribe' and deployment_id:
+                subscribe(deployment_id)
+            elif request.get('action') == 'unsubscribe' and deployment_id:
+                deployment_manager.unsubscribe(deployment_id, queue)
+                subscriptions.discard(deployment_id)
+
+    if websocket.query_params.get('deployment_id'):
+        subscribe(websocket.query_params['deployment_id'])
+
+    tasks = [asyncio.create_task(receive()), asyncio.create_task(manager.pump(websocket))]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            # Disconnects surface here as WebSocketDisconnect; nothing to report
+            task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        for deployment_id in subscriptions:
+            deployment_manager.unsubscribe(deployment_id, queue)
         manager.disconnect(websocket)
 
-# Mount static files first (for JS, CSS, etc.)
-build_dir = Path(__file__).parent.parent / "build"
-if build_dir.exists() and (build_dir / "assets").exists():
-    app.mount("/assets", StaticFiles(directory=build_dir / "assets"), name="assets")
+@app.on_event("startup")
+async def open_deployment_manager():
+    """Start opening the deployment manager in the background; requests that need it wait for it"""
+    _start_deployment_manager()
 
-# Serve static files (built React app)
-@app.get("/")
-async def serve_frontend():
-    """Serve the main frontend application"""
-    frontend_path = Path(__file__).parent.parent / "build" / "index.html"
-    if frontend_path.exists():
-        with open(frontend_path) as f:
-            return HTMLResponse(content=f.read())
-    else:
-        return HTMLResponse(content="""
+@app.on_event("shutdown")
+async def shutdown():
+    """Flush buffered deployment logs and close the Kubernetes API connections before the process exits"""
+    if _deployment_manager is not None:
+        _deployment_manager.store.close()
+        await _deployment_manager.kube.close()
+
+# Built React app, served from memory
+static_cache = StaticAssetCache(Path(__file__).parent.parent / "build")
+
+FRONTEND_NOT_BUILT = """
         <html>
             <body>
                 <h1>Home Lab Configuration</h1>
@@ -206,32 +474,46 @@ async def serve_frontend():
                 <pre>cd web-config/frontend && npm run build</pre>
             </body>
         </html>
-        """)
+        """
+
+@app.get("/")
+async def serve_frontend(request: Request):
+    """Serve the main frontend application"""
+    await static_cache.refresh()
+    if static_cache.index is None:
+        return HTMLResponse(content=FRONTEND_NOT_BUILT)
+    return static_cache.response(static_cache.index, request.headers)
 
 # Catch-all route for client-side routing and static files
 @app.get("/{file_path:path}")
-async def serve_static_files(file_path: str):
+async def serve_static_files(file_path: str, request: Request):
     """Serve static files or fall back to index.html for client-side routing"""
-    build_dir = Path(__file__).parent.parent / "build"
-    file_full_path = build_dir / file_path
-
-    # If it's a file that exists, serve it
-    if file_full_path.is_file():
-        return FileResponse(file_full_path)
-
-    # For client-side routing, serve index.html
-    index_path = build_dir / "index.html"
-    if index_path.exists():
-        return FileResponse(index_path)
-
-    # If nothing found, return 404
-    raise HTTPException(status_code=404, detail="File not found")
+    await static_cache.refresh()
+    asset = static_cache.lookup(file_path)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return static_cache.response(asset, request.headers)
+
+@app.on_event("startup")
+async def report_startup():
+    """Log how long importing and setting up the app took"""
+    logging.getLogger("uvicorn.error").info(
+        "Backend ready %.2fs after importing main started", time.perf_counter() - IMPORT_STARTED
+    )
 
 if __name__ == "__main__":
-    uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=8080,
-        reload=True,
-        log_level="info"
-    )
\ No newline at end of file
+    import argparse
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Home Lab configuration backend")
+    parser.add_argument("--production", action="store_true",
+                        help="serve without the auto-reloader and its file watcher process (the systemd service uses this)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    if args.production:
+        # The app object rather than "main:app", which would import this module a second time
+        uvicorn.run(app, host=args.host, port=args.port, log_level="info")
+    else:
+        uvicorn.run("main:app", host=args.host, port=args.port, reload=True, log_level="info")
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Non-blocking subprocess execution for deployment commands
+"""
+import asyncio
+import os
+import signal
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from metrics import REGISTRY, LONG_BUCKETS
+
+# Seconds a process group gets to exit after SIGTERM before it is killed
+TERMINATE_GRACE_PERIOD = 5
+
+# Privilege wrapper for commands that need root; anything that takes VAR=value assignments works (e.g. `env`)
+SUDO_COMMAND = os.getenv('HOMELAB_SUDO', 'sudo')
+
+# Program names command_label looks past, so privileged commands are labelled by what they run
+PRIVILEGE_WRAPPERS = {'sudo', os.path.basename(SUDO_COMMAND)}
+
+# Bytes read from a streamed command's output at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+# Longest line kept from a streamed command, in bytes; the rest of a longer line is dropped
+MAX_LINE_BYTES = 16 * 1024
+
+SUBPROCESS_SPAWNS = REGISTRY.counter(
+    'homelab_subprocess_spawns_total', 'Commands started', ('command',))
+SUBPROCESS_DURATION = REGISTRY.histogram(
+    'homelab_subprocess_duration_seconds', 'Command run time', ('command',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0) + LONG_BUCKETS)
+SUBPROCESS_OUTCOMES = REGISTRY.counter(
+    'homelab_subprocess_outcomes_total', 'Finished commands by outcome', ('command', 'outcome'))
+
+
+class ProcessTimeoutError(Exception):
+    """Raised when a command exceeds its timeout; its process group has been killed"""
+
+    def __init__(self, cmd: List[str], timeout: float):
+        super().__init__(f"Command timed out after {timeout}s: {' '.join(cmd)}")
+        self.cmd = cmd
+        self.timeout = timeout
+
+
+class ProcessResult:
+    """Outcome of a finished command"""
+
+    def __init__(self, cmd: List[str], returncode: int, stdout: str = "", stderr: str = "",
+                 duration: float = 0.0):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+
+
+def process_tree(pid: int) -> List[int]:
+    """A process and all its descendants, from /proc; just the pid where /proc is unavailable"""
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return [pid]
+
+    children: Dict[int, List[int]] = {}
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as f:
+                stat = f.read()
+            # The command name may contain spaces and parentheses; the fields after it are "state ppid ..."
+            ppid = int(stat[stat.rindex(b')') + 2:].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, ()))
+    return tree
+
+
+async def _signal_as_root(pids: List[int], sig: signal.Signals):
+    """Signal processes owned by root through non-interactive sudo; best effort"""
+    try:
+        killer = await asyncio.create_subprocess_exec(
+            SUDO_COMMAND, '-n', 'kill', f'-{sig.name[3:]}', '--', *(str(pid) for pid in pids),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        await killer.wait()
+    except OSError:
+        pass
+
+
+async def terminate_process_group(process: asyncio.subprocess.Process,
+                                  grace_period: float = TERMINATE_GRACE_PERIOD):
+    """Terminate a process and everything it spawned, escalating to SIGKILL
+
+    Commands run under sudo belong to root and can't be signalled by the
+    service user, so those are signalled through sudo instead. Descendants
+    are found through /proc as well as the process group, since sudo may
+    run the command in a session of its own.
+    """
+    if process.returncode is not None:
+        return
+
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        denied = []
+        for pid in process_tree(process.pid):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                denied.append(pid)
+        try:
+            # Processes are started in their own session, so the pid is also the group id
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+        if denied:
+            await _signal_as_root(denied, sig)
+
+        try:
+            await asyncio.wait_for(process.wait(), timeout=grace_period)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+
+class LineSplitter:
+    """Splits a byte stream into decoded lines, a whole chunk at a time
+
+    Invalid UTF-8 is replaced rather than raising. Lines longer than
+    ``max_line_bytes`` are cut, with a note of how much was dropped, and
+    the dropped bytes are never buffered, so memory stays bounded however
+    long a line gets. Empty lines are skipped.
+    """
+
+    def __init__(self, max_line_bytes: int = MAX_LINE_BYTES):
+        self.max_line_bytes = max_line_bytes
+        self.partial = b''
+        self.dropped = 0
+
+    def feed(self, data: bytes) -> List[str]:
+        """Return the lines completed by ``data``"""
+        parts = data.split(b'\n')
+        lines = []
+        for part in parts[:-1]:
+            if self.partial or self.dropped:
+                self._extend(part)
+                line = self._take()
+            elif len(part) > self.max_line_bytes:
+                line = self._decode(part[:self.max_line_bytes], len(part) - self.max_line_bytes)
+            else:
+                line = part.decode('utf-8', errors='replace').rstrip()
+            if line:
+                lines.append(line)
+        self._extend(parts[-1])
+        return lines
+
+    def close(self) -> List[str]:
+        """Return the unterminated last line, if any"""
+        line = self._take()
+        return [line] if line else []
+
+    def _extend(self, part: bytes):
+        room = max(self.max_line_bytes - len(self.partial), 0)
+        if room:
+            self.partial += part[:room]
+        self.dropped += max(len(part) - room, 0)
+
+    def _take(self) -> str:
+        line = self._decode(self.partial, self.dropped)
+        self.partial, self.dropped = b'', 0
+        return line
+
+    @staticmethod
+    def _decode(data: bytes, dropped: int) -> str:
+        line = data.decode('utf-8', errors='replace').rstrip()
+        if dropped:
+            line += f" … [{dropped} more bytes truncated]"
+        return line
+
+
+def command_label(cmd: List[str]) -> str:
+    """Program name for metrics, looking past the privilege wrapper and its VAR=value assignments"""
+    for arg in cmd:
+        name = os.path.basename(arg)
+        if name not in PRIVILEGE_WRAPPERS and '=' not in arg:
+            return name
+    return 'unknown'
+
+
+async def run_process(cmd: List[str], *, cwd: Optional[str] = None, env: Optional[Dict[str, str]] = None,
+                      timeout: Optional[float] = None,
+                      on_lines: Optional[Callable[[List[str]], Awaitable[None]]] = None) -> ProcessResult:
+    """Run a command without blocking the event loop
+
+    With ``on_lines`` the combined stdout/stderr is streamed to the callback
+    in batches of lines (everything that arrived in one read); otherwise
+    both streams are captured into the result. The command is not read
+    further while the callback runs, so a slow consumer slows the command
+    down instead of losing output.
+    ``env`` entries are added on top of the service's own environment.
+    On timeout or cancellation the whole process group is terminated.
+    """
+    started = time.monotonic()
+    label = command_label(cmd)
+    SUBPROCESS_SPAWNS.labels(label).inc()
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=cwd,
+        env={**os.environ, **env} if env else None,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT if on_lines else asyncio.subprocess.PIPE,
+        start_new_session=True
+    )
+
+    async def stream() -> ProcessResult:
+        splitter = LineSplitter()
+        while True:
+            chunk = await process.stdout.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = splitter.feed(chunk)
+            if lines:
+                await on_lines(lines)
+        lines = splitter.close()
+        if lines:
+            await on_lines(lines)
+        await process.wait()
+        return ProcessResult(cmd, process.returncode, duration=time.monotonic() - started)
+
+    async def capture() -> ProcessResult:
+        stdout, stderr = await process.communicate()
+        return ProcessResult(
+            cmd, process.returncode,
+            stdout=stdout.decode('utf-8', errors='replace'),
+            stderr=stderr.decode('utf-8', errors='replace'),
+            duration=time.monotonic() - started
+        )
+
+    outcome = 'cancelled'
+    try:
+        result = await asyncio.wait_for(stream() if on_lines else capture(), timeout=timeout)
+        outcome = 'success' if result.returncode == 0 else 'failure'
+        return result
+    except asyncio.TimeoutError:
+        outcome = 'timeout'
+        await terminate_process_group(process)
+        raise ProcessTimeoutError(cmd, timeout)
+    except BaseException:
+        # Cancelled (or the line callback failed): don't leave the command running
+        await asyncio.shield(terminate_process_group(process))
+        raise
+    finally:
+        SUBPROCESS_DURATION.labels(label).observe(time.monotonic() - started)
+        SUBPROCESS_OUTCOMES.labels(label, outcome).inc()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Admission control for concurrent deployments
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional
+
+
+class DeploymentScheduler:
+    """Runs deployments in FIFO order under a concurrency limit
+
+    Deployments wait in a queue until a slot frees up. Shared on-disk
+    resources (the Ansible tree, the Terraform state) are guarded by
+    named locks, so two admitted deployments never use the same one at once.
+    """
+
+    def __init__(self, max_concurrent: int = 1,
+                 on_queue_change: Optional[Callable[[List[str]], None]] = None):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        self.max_concurrent = max_concurrent
+        self.on_queue_change = on_queue_change
+        self.waiting: List[str] = []
+        self.running: List[str] = []
+        self._condition = asyncio.Condition()
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def position(self, deployment_id: str) -> Optional[int]:
+        """1-based queue position of a waiting deployment, None once admitted"""
+        try:
+            return self.waiting.index(deployment_id) + 1
+        except ValueError:
+            return None
+
+    def enqueue(self, deployment_id: str):
+        """Reserve a queue position immediately, before the deployment task runs"""
+        if deployment_id not in self.waiting:
+            self.waiting.append(deployment_id)
+
+    @asynccontextmanager
+    async def slot(self, deployment_id: str):
+        """Wait for this deployment's turn, then hold a concurrency slot"""
+        self.enqueue(deployment_id)
+        try:
+            async with self._condition:
+                await self._condition.wait_for(
+                    lambda: self.waiting[0] == deployment_id and len(self.running) < self.max_concurrent
+                )
+                self.waiting.pop(0)
+                self.running.append(deployment_id)
+                # The next deployment in line may also fit if the limit allows
+                self._condition.notify_all()
+        except BaseException:
+            if deployment_id in self.waiting:
+                self.waiting.remove(deployment_id)
+                await self._wake()
+            raise
+        self._queue_changed()
+
+        try:
+            yield
+        finally:
+            self.running.remove(deployment_id)
+            await self._wake()
+
+    @asynccontextmanager
+    async def resources(self, *names: str):
+        """Hold the named resource locks for the duration of the block
+
+        Locks are always taken in sorted order so overlapping requests can't deadlock.
+        """
+        locks = [self._locks.setdefault(name, asyncio.Lock()) for name in sorted(set(names))]
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            'max_concurrent': self.max_concurrent,
+            'running': list(self.running),
+            'queued': list(self.waiting),
+            'locked_resources': sorted(name for name, lock in self._locks.items() if lock.locked())
+        }
+
+    async def _wake(self):
+        async with self._condition:
+            self._condition.notify_all()
+        self._queue_changed()
+
+    def _queue_changed(self):
+        if self.on_queue_change:
+            self.on_queue_change(list(self.waiting))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+In-memory cache of the built frontend, with precompressed variants
+"""
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from fastapi import Response
+
+try:
+    import brotli
+except ImportError:  # Optional; gzip is always available
+    brotli = None
+
+# Build output directories holding content-hashed file names (vite's assetsDir)
+HASHED_ASSET_DIRS = ('static', 'assets')
+
+# Files smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 512
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Minimum seconds between checks of the build directory for a new build
+RELOAD_CHECK_INTERVAL = 2.0
+
+
+class StaticAsset:
+    """A build file held in memory with its compressed variants"""
+
+    def __init__(self, path: str, content: bytes, immutable: bool):
+        self.path = path
+        self.media_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.cache_control = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+        self.etag = hashlib.sha256(content).hexdigest()[:32]
+        # Content-Encoding -> body; identity is always present
+        self.variants: Dict[str, bytes] = {'identity': content}
+
+        if len(content) >= MIN_COMPRESS_SIZE and self.media_type.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(compressed) < len(content):
+                self.variants['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(content, quality=11)
+                if len(compressed) < len(content):
+                    self.variants['br'] = compressed
+
+    def tag(self, encoding: str) -> str:
+        """Strong ETag of one encoded representation"""
+        return f'"{self.etag}"' if encoding == 'identity' else f'"{self.etag}-{encoding}"'
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        tags = {self.tag(encoding) for encoding in self.variants}
+        return any(candidate.strip().removeprefix('W/') in tags for candidate in if_none_match.split(','))
+
+    def choose_encoding(self, accept_encoding: Optional[str]) -> str:
+        """Pick the smallest variant the client accepts"""
+        accepted = set()
+        for part in (accept_encoding or '').split(','):
+            name, _, params = part.strip().partition(';')
+            if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                accepted.add(name.strip().lower())
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and encoding in accepted:
+                return encoding
+        return 'identity'
+
+
+class StaticAssetCache:
+    """Serves the frontend build from memory
+
+    The build directory is read once; a new build is picked up when
+    index.html is replaced. Requests are resolved with a dict lookup
+    instead of touching the filesystem.
+    """
+
+    def __init__(self, build_dir: Path):
+        self.build_dir = Path(build_dir)
+        self.assets: Dict[str, StaticAsset] = {}
+        self._signature: Optional[Tuple[int, int]] = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+        self.load()
+
+    @property
+    def index(self) -> Optional[StaticAsset]:
+        return self.assets.get('index.html')
+
+    def load(self):
+        """(Re)read every file of the build directory into memory"""
+        signature = self._build_signature()
+        assets = {}
+        if signature is not None:
+            for root, _, files in os.walk(self.build_dir):
+                for name in files:
+                    full_path = Path(root) / name
+                    relative = full_path.relative_to(self.build_dir).as_posix()
+                    immutable = relative.split('/', 1)[0] in HASHED_ASSET_DIRS
+                    assets[relative] = StaticAsset(relative, full_path.read_bytes(), immutable)
+        self.assets = assets
+        self._signature = signature
+
+    async def refresh(self):
+        """Reload in a worker thread if a new build has been written"""
+        now = time.monotonic()
+        if now - self._checked_at < RELOAD_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        if self._build_signature() == self._signature:
+            return
+        async with self._lock:
+            if self._build_signature() != self._signature:
+                await asyncio.to_thread(self.load)
+
+    def lookup(self, path: str) -> Optional[StaticAsset]:
+        """Resolve a request path, falling back to index.html for client-side routes"""
+        path = path.lstrip('/')
+        asset = self.assets.get(path or 'index.html')
+        if asset is not None:
+            return asset
+        # A missing hashed file is a stale reference, not a client-side route
+        if path.split('/', 1)[0] in HASHED_ASSET_DIRS:
+            return None
+        return self.index
+
+    def response(self, asset: StaticAsset, headers) -> Response:
+        """Build the response for an asset, honouring If-None-Match and Accept-Encoding"""
+        encoding = asset.choose_encoding(headers.get('accept-encoding'))
+        response_headers = {
+            'ETag': asset.tag(encoding),
+            'Cache-Control': asset.cache_control,
+            'Vary': 'Accept-Encoding',
+        }
+        if asset.matches(headers.get('if-none-match')):
+            return Response(status_code=304, headers=response_headers)
+        if encoding != 'identity':
+            response_headers['Content-Encoding'] = encoding
+        return Response(content=asset.variants[encoding], media_type=asset.media_type, headers=response_headers)
+
+    def _build_signature(self) -> Optional[Tuple[int, int]]:
+        """Identity of the current build; vite rewrites index.html on every build"""
+        try:
+            stat = os.stat(self.build_dir / 'index.html')
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
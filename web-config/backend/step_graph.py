@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Dependency-graph execution of deployment steps
+"""
+import asyncio
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Any, Iterable, List, Optional
+
+
+class Step:
+    """A unit of deployment work and the steps it has to wait for"""
+
+    def __init__(self, key: str, name: str, function: Callable[[str], Awaitable[None]],
+                 depends_on: Iterable[str] = ()):
+        self.key = key
+        self.name = name
+        self.function = function
+        self.depends_on = list(depends_on)
+
+
+class StepGraph:
+    """Runs steps as soon as their dependencies complete, independent ones concurrently
+
+    If a step fails, no new steps are started, steps still running are
+    cancelled, and steps that never ran are marked skipped. The first
+    failure is re-raised once everything has settled.
+    """
+
+    def __init__(self, steps: List[Step]):
+        self.steps = steps
+        self.by_key = {step.key: step for step in steps}
+        if len(self.by_key) != len(steps):
+            raise ValueError("Step keys must be unique")
+        for step in steps:
+            for dependency in step.depends_on:
+                if dependency not in self.by_key:
+                    raise ValueError(f"Step {step.key} depends on unknown step {dependency}")
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> List[str]:
+        """Return step keys in dependency order, rejecting cycles"""
+        order, state = [], {}
+
+        def visit(key: str, path: List[str]):
+            if state.get(key) == 'done':
+                return
+            if state.get(key) == 'visiting':
+                raise ValueError(f"Step dependency cycle: {' -> '.join(path + [key])}")
+            state[key] = 'visiting'
+            for dependency in self.by_key[key].depends_on:
+                visit(dependency, path + [key])
+            state[key] = 'done'
+            order.append(key)
+
+        for step in self.steps:
+            visit(step.key, [])
+        return order
+
+    async def run(self, run_step: Callable[[Step], Awaitable[None]],
+                  on_skip: Optional[Callable[[Step], Awaitable[None]]] = None):
+        """Execute the graph; ``run_step`` performs (and records) a single step"""
+        done, started, running = set(), set(), {}
+        failure: Optional[BaseException] = None
+
+        def ready() -> List[Step]:
+            return [step for step in self.steps
+                    if step.key not in done and step.key not in running
+                    and all(dependency in done for dependency in step.depends_on)]
+
+        try:
+            while True:
+                if failure is None:
+                    for step in ready():
+                        started.add(step.key)
+                        running[step.key] = asyncio.create_task(run_step(step))
+                if not running:
+                    break
+
+                finished, _ = await asyncio.wait(running.values(), return_when=asyncio.FIRST_COMPLETED)
+                for key, task in list(running.items()):
+                    if task not in finished:
+                        continue
+                    del running[key]
+                    if task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        if failure is None:
+                            failure = task.exception()
+                            for other in running.values():
+                                other.cancel()
+                    else:
+                        done.add(key)
+        finally:
+            # Only reached with tasks left if we ourselves were cancelled
+            for task in running.values():
+                task.cancel()
+            if running:
+                await asyncio.gather(*running.values(), return_exceptions=True)
+
+        if on_skip is not None:
+            for step in self.steps:
+                if step.key not in started:
+                    await on_skip(step)
+
+        if failure is not None:
+            raise failure
+
+
+def _parse_time(value: Optional[str]) -> Optional[float]:
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+
+def graph_summary(steps: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Summarise recorded step timings: critical path and time saved by parallelism
+
+    ``steps`` are stored step records with ``key``, ``depends_on`` and
+    ``duration`` (seconds). Steps that have not finished count as zero.
+    """
+    # Rows recorded before steps had keys fall back to their names
+    durations = {step.get('key') or step['name']: step.get('duration') or 0.0 for step in steps}
+    dependencies = {step.get('key') or step['name']: step.get('depends_on') or [] for step in steps}
+
+    # Longest (by duration) chain ending at each step
+    finish: Dict[str, float] = {}
+    previous: Dict[str, Optional[str]] = {}
+    remaining = list(durations)
+    while remaining:
+        progressed = False
+        for key in list(remaining):
+            if all(dependency in finish for dependency in dependencies[key] if dependency in durations):
+                before = [dependency for dependency in dependencies[key] if dependency in finish]
+                slowest = max(before, key=lambda dependency: finish[dependency], default=None)
+                finish[key] = (finish[slowest] if slowest else 0.0) + durations[key]
+                previous[key] = slowest
+                remaining.remove(key)
+                progressed = True
+        if not progressed:  # Cycle in stored data; stop rather than loop forever
+            break
+
+    critical_path: List[str] = []
+    key = max(finish, key=finish.get, default=None)
+    while key is not None:
+        critical_path.append(key)
+        key = previous.get(key)
+    critical_path.reverse()
+
+    starts = [_parse_time(step.get('started_at')) for step in steps if step.get('started_at')]
+    ends = [_parse_time(step.get('finished_at')) for step in steps if step.get('finished_at')]
+    wall_time = (max(ends) - min(starts)) if starts and ends else 0.0
+    step_time = sum(durations.values())
+
+    return {
+        'critical_path': critical_path,
+        'critical_path_duration': round(finish[critical_path[-1]], 3) if critical_path else 0.0,
+        'wall_time': round(wall_time, 3),
+        'step_time_total': round(step_time, 3),
+        # Time the same steps would have added if run one after another
+        'parallel_savings': round(max(step_time - wall_time, 0.0), 3)
+    }
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Timing of individual Ansible tasks and OpenTofu resource operations across deployments
+"""
+import json
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+# Role reported for tasks outside any role (pre_tasks, post_tasks)
+PLAYBOOK_ROLE = '(playbook)'
+
+# Severity order when a task has results with different statuses on several hosts
+STATUS_PRIORITY = ('failed', 'unreachable', 'changed', 'ok', 'ignored', 'skipped')
+
+# OpenTofu -json UI message types that close a resource operation
+TOFU_COMPLETE_EVENTS = {'apply_complete': 'completed', 'apply_errored': 'failed'}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Linearly interpolated percentile of a non-empty list"""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def _parse_timestamp(value: str) -> float:
+    """Parse OpenTofu's RFC 3339 timestamps, which may carry more than microsecond precision"""
+    value = value.replace('Z', '+00:00')
+    if '.' in value:
+        head, _, rest = value.partition('.')
+        digits = len(rest) - len(rest.lstrip('0123456789'))
+        value = f"{head}.{rest[:min(digits, 6)]}{rest[digits:]}"
+    return datetime.fromisoformat(value).timestamp()
+
+
+class TaskTimer:
+    """Turns homelab_events callback events into one timing record per task
+
+    With the linear strategy a task ends when its last host reports, or
+    when the next task starts if no host did.
+    """
+
+    def __init__(self):
+        self.records: List[Dict[str, Any]] = []
+        self._open: Optional[Dict[str, Any]] = None
+
+    def handle(self, event: Dict[str, Any]):
+        kind = event.get('event')
+        if kind == 'task_start':
+            self._close(event['time'])
+            self._open = {
+                'kind': 'ansible',
+                'role': event.get('role') or PLAYBOOK_ROLE,
+                'name': event.get('task') or '',
+                'action': event.get('action'),
+                'statuses': set(),
+                'started_at': event['time'],
+                'last_result_at': None
+            }
+        elif kind == 'result' and self._open is not None:
+            self._open['statuses'].add(event.get('status'))
+            self._open['last_result_at'] = event['time']
+        elif kind == 'recap':
+            self._close(event['time'])
+
+    def finish(self, now: float) -> List[Dict[str, Any]]:
+        """Close a task left open by an interrupted run and return all records"""
+        self._close(now)
+        return self.records
+
+    def _close(self, now: float):
+        task, self._open = self._open, None
+        if task is None:
+            return
+        finished_at = task.pop('last_result_at') or now
+        statuses = task.pop('statuses')
+        task['status'] = next((status for status in STATUS_PRIORITY if status in statuses), None)
+        task['finished_at'] = finished_at
+        task['duration'] = round(max(finished_at - task['started_at'], 0.0), 3)
+        self.records.append(task)
+
+
+def read_tofu_timings(events_file: Path, since: float) -> List[Dict[str, Any]]:
+    """Resource operation timings from an OpenTofu ``apply -json`` event log
+
+    Returns nothing if the file predates ``since``, i.e. it was not written
+    by the run being profiled.
+    """
+    try:
+        if events_file.stat().st_mtime < since:
+            return []
+        lines = events_file.read_text(errors='replace').splitlines()
+    except OSError:
+        return []
+
+    started: Dict[Tuple[str, str], float] = {}
+    records = []
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        hook = event.get('hook') or {}
+        resource = hook.get('resource') or {}
+        address = resource.get('addr')
+        if not address or '@timestamp' not in event:
+            continue
+
+        key = (address, hook.get('action'))
+        timestamp = _parse_timestamp(event['@timestamp'])
+        if event.get('type') == 'apply_start':
+            started[key] = timestamp
+        elif event.get('type') in TOFU_COMPLETE_EVENTS:
+            started_at = started.pop(key, timestamp - (hook.get('elapsed_seconds') or 0))
+            records.append({
+                'kind': 'tofu',
+                'role': resource.get('resource_type') or address.split('.')[0],
+                'name': address,
+                'action': hook.get('action'),
+                'status': TOFU_COMPLETE_EVENTS[event['type']],
+                'started_at': started_at,
+                'finished_at': timestamp,
+                'duration': round(timestamp - started_at, 3)
+            })
+    return records
+
+
+def build_profile(timings: Iterable[Dict[str, Any]], top: int = 10) -> Dict[str, Any]:
+    """Summarise timing records from several deployments
+
+    ``timings`` are stored records carrying ``deployment_id`` and
+    ``deployment_started_at``. Returns the slowest tasks by median duration,
+    p50/p95 of each role's (or resource type's) total time per run, and the
+    per-task change between the two most recent runs.
+    """
+    runs: Dict[str, Dict[str, Any]] = {}
+    for record in timings:
+        run = runs.setdefault(record['deployment_id'], {
+            'started_at': record['deployment_started_at'],
+            'tasks': defaultdict(float),
+            'groups': defaultdict(float)
+        })
+        task_key = (record['kind'], record['role'], record['name'])
+        run['tasks'][task_key] += record['duration'] or 0.0
+        run['groups'][(record['kind'], record['role'])] += record['duration'] or 0.0
+
+    ordered = sorted(runs, key=lambda deployment_id: runs[deployment_id]['started_at'])
+
+    task_durations: Dict[Tuple[str, str, str], List[float]] = defaultdict(list)
+    group_durations: Dict[Tuple[str, str], List[float]] = defaultdict(list)
+    for deployment_id in ordered:
+        for key, duration in runs[deployment_id]['tasks'].items():
+            task_durations[key].append(duration)
+        for key, duration in runs[deployment_id]['groups'].items():
+            group_durations[key].append(duration)
+
+    slowest = sorted(
+        ({'kind': kind, 'role': role, 'name': name, 'runs': len(durations),
+          'p50': round(percentile(durations, 50), 3), 'max': round(max(durations), 3),
+          'last': round(durations[-1], 3)}
+         for (kind, role, name), durations in task_durations.items()),
+        key=lambda task: task['p50'], reverse=True
+    )[:top]
+
+    groups = {'ansible': {}, 'tofu': {}}
+    for (kind, role), durations in sorted(group_durations.items()):
+        groups[kind][role] = {
+            'runs': len(durations),
+            'p50': round(percentile(durations, 50), 3),
+            'p95': round(percentile(durations, 95), 3),
+            'last': round(durations[-1], 3)
+        }
+
+    return {
+        'deployments': ordered,
+        'slowest_tasks': slowest,
+        'roles': groups['ansible'],
+        'resource_types': groups['tofu'],
+        'regression': _regression(runs, ordered, top)
+    }
+
+
+def _regression(runs: Dict[str, Dict[str, Any]], ordered: List[str], top: int) -> Optional[Dict[str, Any]]:
+    """Per-task duration change between the last two runs, largest slowdowns first
+
+    Only tasks both runs executed are compared; an incremental or no-op run
+    skips whole roles, so tasks that ran in just one of them are listed as
+    added or removed instead of counting as their full duration.
+    """
+    if len(ordered) < 2:
+        return None
+    previous, current = runs[ordered[-2]]['tasks'], runs[ordered[-1]]['tasks']
+    common = set(previous) & set(current)
+    changes = []
+    for key in common:
+        kind, role, name = key
+        changes.append({
+            'kind': kind, 'role': role, 'name': name,
+            'previous': round(previous[key], 3),
+            'current': round(current[key], 3),
+            'delta': round(current[key] - previous[key], 3)
+        })
+    changes.sort(key=lambda change: change['delta'], reverse=True)
+
+    def only_in(tasks: Dict[Tuple[str, str, str], float], other: Dict[Tuple[str, str, str], float]):
+        return sorted(({'kind': kind, 'role': role, 'name': name, 'duration': round(duration, 3)}
+                       for (kind, role, name), duration in tasks.items() if (kind, role, name) not in other),
+                      key=lambda task: task['duration'], reverse=True)[:top]
+
+    return {
+        'previous_deployment': ordered[-2],
+        'current_deployment': ordered[-1],
+        'compared_tasks': len(common),
+        'total_delta': round(sum(current[key] - previous[key] for key in common), 3),
+        'slower': [change for change in changes if change['delta'] > 0][:top],
+        'faster': [change for change in reversed(changes) if change['delta'] < 0][:top],
+        'added': only_in(current, previous),
+        'removed': only_in(previous, current)
+    }
@@ -0,0 +1,47 @@
+import importlib.util
+import py_compile
+import shutil
+from pathlib import Path
+
+from change_planner import ChangePlanner
+
+REPO_ROOT = Path(__file__).resolve().parents[3]
+CALLBACK_PLUGIN = REPO_ROOT / "ansible" / "callback_plugins" / "homelab_events.py"
+
+CONFIG = {'services': {'portainer': True, 'gitea': False}, 'network': {'pod_cidr': '10.42.0.0/16'}}
+
+
+def make_tree(root: Path):
+    plugin = root / "ansible" / "callback_plugins" / "homelab_events.py"
+    plugin.parent.mkdir(parents=True)
+    shutil.copy(CALLBACK_PLUGIN, plugin)
+    (root / "ansible" / "stage2-deploy.yml").write_text("- hosts: k3s_server\n  roles: []\n")
+    (root / "terraform").mkdir()
+    (root / "terraform" / "main.tf").write_text('terraform {}\n')
+    return plugin
+
+
+def test_runtime_files_do_not_change_the_plan(tmp_path):
+    plugin = make_tree(tmp_path)
+    planner = ChangePlanner(tmp_path)
+    applied = planner.fingerprint(CONFIG)
+
+    # What a playbook run leaves behind: the callback's bytecode, as loading it
+    # writes it, and a retry file for failed hosts
+    py_compile.compile(str(plugin), cfile=importlib.util.cache_from_source(str(plugin)), doraise=True)
+    (tmp_path / "ansible" / "stage2-deploy.retry").write_text("localhost\n")
+
+    plan = planner.plan(CONFIG, applied)
+    assert plan['mode'] == 'noop', plan['reasons']
+
+
+def test_source_change_forces_full_deploy(tmp_path):
+    make_tree(tmp_path)
+    planner = ChangePlanner(tmp_path)
+    applied = planner.fingerprint(CONFIG)
+
+    (tmp_path / "ansible" / "stage2-deploy.yml").write_text("- hosts: k3s_server\n  roles: [k3s]\n")
+
+    plan = planner.plan(CONFIG, applied)
+    assert plan['mode'] == 'full'
+    assert "Playbook or Terraform sources changed" in plan['reasons']
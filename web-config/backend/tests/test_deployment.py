@@ -0,0 +1,17 @@
+import asyncio
+
+from deployment import offer_latest
+
+
+def test_a_full_queue_keeps_the_final_status_and_drops_the_oldest_logs():
+    queue = asyncio.Queue(maxsize=3)
+    final = {'type': 'status', 'deployment_id': 'd1', 'status': {'status': 'completed'}}
+    assert offer_latest(queue, final)
+    for seq in range(1, 5):
+        offer_latest(queue, {'type': 'logs', 'deployment_id': 'd1', 'seq': seq, 'lines': ['line']})
+
+    assert [queue.get_nowait() for _ in range(queue.qsize())] == [
+        final,
+        {'type': 'logs', 'deployment_id': 'd1', 'seq': 3, 'lines': ['line']},
+        {'type': 'logs', 'deployment_id': 'd1', 'seq': 4, 'lines': ['line']},
+    ]
@@ -0,0 +1,52 @@
+import asyncio
+from datetime import datetime
+
+from deployment_store import DeploymentStore
+
+
+def test_lines_are_readable_once_the_writer_commits(tmp_path):
+    async def scenario():
+        store = DeploymentStore(tmp_path / "deployments.db")
+        store.create_deployment('d1', 'running', {}, datetime.now().isoformat())
+        store.append_logs('d1', 1, ['one', 'two'])
+
+        # Still buffered: the deployment manager serves these from its own recent lines
+        assert store.get_logs('d1') == []
+
+        store.append_logs('d1', 3, ['three'])
+        await store.wait_for_writes()
+        assert store.log_bounds('d1') == (1, 3)
+        assert store.get_logs('d1', since=1) == [(2, 'two'), (3, 'three')]
+        assert store.get_logs('d1', since=0, limit=2) == [(1, 'one'), (2, 'two')]
+        assert store.get_log_chunks('d1')[-1][4] == 3
+        assert [line for _, line in store.spool.iter_lines('d1', store.get_log_chunks('d1'))] == \
+            ['one', 'two', 'three']
+        store.close()
+
+    asyncio.run(scenario())
+
+
+def test_writes_are_committed_off_the_loop_in_order(tmp_path):
+    async def scenario():
+        store = DeploymentStore(tmp_path / "deployments.db")
+        store.create_deployment('d1', 'queued', {}, datetime.now().isoformat())
+        store.set_steps('d1', [{'key': 'a', 'name': 'A'}])
+        store.update_step('d1', 0, status='running')
+        store.update_deployment('d1', status='running', change_plan={'mode': 'full'})
+        store.set_setting('last_applied', 'abc')
+
+        # Settings are answered from memory straight away
+        assert store.get_setting('last_applied') == 'abc'
+
+        await store.wait_for_writes()
+        deployment = store.get_deployment('d1')
+        assert deployment['status'] == 'running'
+        assert deployment['change_plan'] == {'mode': 'full'}
+        assert store.get_steps('d1')[0]['status'] == 'running'
+        store.close()
+
+        reopened = DeploymentStore(tmp_path / "deployments.db")
+        assert reopened.get_setting('last_applied') == 'abc'
+        reopened.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,10 @@
+import process_runner
+from process_runner import command_label
+
+
+def test_command_label_looks_past_the_configured_wrapper(monkeypatch):
+    monkeypatch.setattr(process_runner, 'PRIVILEGE_WRAPPERS', {'sudo', 'doas'})
+    assert command_label(['/usr/bin/doas', 'ANSIBLE_CONFIG=/x', '/usr/bin/ansible-playbook', 'site.yml']) == \
+        'ansible-playbook'
+    assert command_label(['sudo', 'k3s', 'crictl', 'info']) == 'k3s'
+    assert command_label(['tofu', 'plan']) == 'tofu'
@@ -0,0 +1,16 @@
+from task_profiler import _regression
+
+
+def test_regression_compares_only_tasks_both_runs_executed():
+    runs = {
+        'full': {'tasks': {('ansible', 'k3s', 'Install k3s'): 10.0, ('ansible', 'docker', 'Install docker'): 30.0}},
+        'incremental': {'tasks': {('ansible', 'k3s', 'Install k3s'): 12.0}},
+    }
+    regression = _regression(runs, ['full', 'incremental'], top=10)
+
+    assert regression['total_delta'] == 2.0
+    assert [change['name'] for change in regression['slower']] == ['Install k3s']
+    assert regression['faster'] == []
+    assert regression['removed'] == [{'kind': 'ansible', 'role': 'docker', 'name': 'Install docker',
+                                      'duration': 30.0}]
+    assert regression['added'] == []
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Cached, concurrent discovery of the command-line tools used by deployments
+"""
+import asyncio
+import os
+import shutil
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+from process_runner import run_process, ProcessTimeoutError
+
+# Timeout for a single `<tool> --version` probe
+PROBE_TIMEOUT = 10
+
+# Candidate locations per tool, in order of preference; bare names are looked up on PATH
+TOOL_CANDIDATES: Dict[str, List[str]] = {
+    'ansible-playbook': [
+        "/opt/homelab/venv/bin/ansible-playbook",
+        "/usr/local/bin/ansible-playbook",
+        "/usr/bin/ansible-playbook",
+        "/home/homelab/.local/bin/ansible-playbook",
+        "ansible-playbook",
+    ],
+    'ansible-galaxy': [
+        "/opt/homelab/venv/bin/ansible-galaxy",
+        "/usr/local/bin/ansible-galaxy",
+        "/usr/bin/ansible-galaxy",
+        "/home/homelab/.local/bin/ansible-galaxy",
+        "ansible-galaxy",
+    ],
+    'tofu': [
+        "/usr/local/bin/tofu",
+        "/usr/bin/tofu",
+        "/usr/local/bin/terraform",
+        "/usr/bin/terraform",
+        "tofu",
+        "terraform",
+    ],
+    'kubectl': [
+        "/usr/local/bin/kubectl",
+        "/usr/bin/kubectl",
+        "kubectl",
+    ],
+}
+
+# Environment variable naming an explicit binary for a tool, tried before any candidate,
+# e.g. HOMELAB_TOOL_ANSIBLE_PLAYBOOK=/path/to/ansible-playbook
+TOOL_ENV_PREFIX = 'HOMELAB_TOOL_'
+
+# Arguments that print a version and exit successfully
+VERSION_ARGS: Dict[str, List[str]] = {
+    'tofu': ["version"],
+    'kubectl': ["version", "--client"],
+}
+
+# (mtime_ns, size) of a binary; a change means the probe result is stale
+Signature = Tuple[int, int]
+
+
+class ToolchainResolver:
+    """Locates deployment tools once and remembers where they are
+
+    All candidates of a tool are probed concurrently. Results are cached per
+    binary and re-probed only when the file's mtime or size changes, so
+    repeated deployments pay the discovery cost once.
+    """
+
+    def __init__(self, candidates: Optional[Dict[str, List[str]]] = None):
+        self.candidates = candidates or TOOL_CANDIDATES
+        self._probes: Dict[str, Tuple[Signature, Optional[str]]] = {}  # path -> (signature, version)
+        self._resolved: Dict[str, Dict[str, Any]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def resolve(self, tool: str) -> Optional[str]:
+        """Return the path of the preferred working candidate for a tool, or None"""
+        info = await self.resolve_info(tool)
+        return info['path'] if info else None
+
+    async def resolve_info(self, tool: str) -> Optional[Dict[str, Any]]:
+        """Return path, version and discovery time for a tool, or None if not found"""
+        if tool not in self.candidates:
+            raise Exception(f"Unknown tool: {tool}")
+
+        lock = self._locks.setdefault(tool, asyncio.Lock())
+        async with lock:
+            cached = self._resolved.get(tool)
+            if cached and self._signature(cached['path']) == cached['signature']:
+                return self._public(cached)
+
+            paths = self._candidate_paths(tool)
+            versions = await asyncio.gather(*(self._probe(tool, path) for path in paths))
+
+            self._resolved.pop(tool, None)
+            for path, version in zip(paths, versions):
+                if version is not None:
+                    self._resolved[tool] = {
+                        'path': path,
+                        'version': version,
+                        'signature': self._signature(path),
+                        'resolved_at': datetime.now().isoformat()
+                    }
+                    return self._public(self._resolved[tool])
+            return None
+
+    async def resolve_all(self) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Resolve every known tool concurrently"""
+        tools = list(self.candidates)
+        results = await asyncio.gather(*(self.resolve_info(tool) for tool in tools))
+        return dict(zip(tools, results))
+
+    def invalidate(self, tool: Optional[str] = None):
+        """Forget cached results for one tool, or for all of them"""
+        if tool is None:
+            self._resolved.clear()
+            self._probes.clear()
+        else:
+            self._resolved.pop(tool, None)
+            for path in self._candidate_paths(tool):
+                self._probes.pop(path, None)
+
+    def _candidate_paths(self, tool: str) -> List[str]:
+        """Expand candidates to unique absolute paths that exist on disk"""
+        paths = []
+        override = os.getenv(TOOL_ENV_PREFIX + tool.upper().replace('-', '_'))
+        for candidate in ([override] if override else []) + self.candidates[tool]:
+            path = candidate if os.path.isabs(candidate) else shutil.which(candidate)
+            if path and os.path.isfile(path) and path not in paths:
+                paths.append(path)
+        return paths
+
+    async def _probe(self, tool: str, path: str) -> Optional[str]:
+        """Run the tool's version command, reusing the result while the binary is unchanged"""
+        signature = self._signature(path)
+        cached = self._probes.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        version = None
+        try:
+            result = await run_process([path, *VERSION_ARGS.get(tool, ["--version"])], timeout=PROBE_TIMEOUT)
+            if result.returncode == 0:
+                lines = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+                version = lines[0] if lines else "unknown"
+        except (ProcessTimeoutError, OSError):
+            pass
+
+        self._probes[path] = (signature, version)
+        return version
+
+    @staticmethod
+    def _signature(path: str) -> Optional[Signature]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @staticmethod
+    def _public(entry: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: entry[key] for key in ('path', 'version', 'resolved_at')}
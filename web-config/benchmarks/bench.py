@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the configuration backend
+
+Starts the backend against a scratch home lab tree with fake
+ansible/tofu/kubectl stand-ins and a fake Kubernetes API server, runs
+a deployment per scenario while many status pollers and WebSocket
+clients follow it, and reports
+throughput, latency percentiles and memory. With a stored baseline,
+exits non-zero when a result is worse than the baseline by more than
+the tolerance.
+
+    python bench.py                      # run all scenarios
+    python bench.py --scenario burst     # run one
+    python bench.py --save-baseline      # store results as the new baseline
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Any, List
+
+import httpx
+import websockets
+
+BENCH_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = BENCH_DIR.parent / "backend"
+REPO_ROOT = BENCH_DIR.parent.parent
+DEFAULT_BASELINE = BENCH_DIR / "baseline.json"
+
+FAKE_TOOLS = ['ansible-playbook', 'ansible-galaxy', 'tofu', 'kubectl', 'systemctl', 'k3s']
+
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    'steady': {
+        'description': "Typical playbook output at a steady rate",
+        'env': {'FAKE_LINES': 20000, 'FAKE_RATE': 2000},
+        'pollers': 20, 'websockets': 20,
+    },
+    'burst': {
+        'description': "Bursts of 10k lines per second",
+        'env': {'FAKE_LINES': 50000, 'FAKE_RATE': 10000},
+        'pollers': 50, 'websockets': 50,
+    },
+    'long_lines': {
+        'description': "Unthrottled output with a 256 KiB line every 100 lines",
+        'env': {'FAKE_LINES': 5000, 'FAKE_RATE': 0, 'FAKE_LONG_LINE_EVERY': 100, 'FAKE_LONG_LINE_LENGTH': 262144},
+        'pollers': 5, 'websockets': 5,
+    },
+}
+
+# Whether a larger value of a result is better; used for baseline comparison
+HIGHER_IS_BETTER = {
+    'deployment_seconds': False,
+    'log_lines_per_second': True,
+    'poll_requests_per_second': True,
+    'poll_latency_p50_ms': False,
+    'poll_latency_p95_ms': False,
+    'poll_latency_p99_ms': False,
+    'ws_messages_per_second': True,
+    'ws_log_coverage': True,
+    'peak_rss_mb': False,
+    'error_rate': False,
+}
+
+# Results compared by absolute rather than relative change, since their baseline is usually 0
+ABSOLUTE_TOLERANCE = {
+    'error_rate': 0.01,
+}
+
+# Interval between status polls of one poller, in seconds
+POLL_INTERVAL = 0.05
+
+# Pause after a failed request or dropped connection before a client tries again, in seconds
+ERROR_BACKOFF = 0.5
+
+CONFIG = {
+    'admin_password': 'benchmark-password',
+    'services': {'portainer': True, 'registry': True, 'registry_ui': True, 'kubelish': True, 'gitea': False},
+    'network': {'pod_cidr': '10.42.0.0/16', 'service_cidr': '10.43.0.0/16',
+                'homelab_pool': '10.43.0.0/20', 'user_pool': '10.43.16.0/20'},
+    'storage': {'portainer_size': '2Gi', 'registry_size': '10Gi', 'gitea_size': '10Gi'},
+}
+
+# Seconds the fake API server reports the service rollouts as unfinished
+KUBE_ROLLOUT_SECONDS = 0.5
+
+TERMINAL_STATUSES = ('completed', 'failed', 'interrupted', 'cancelled')
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def prepare_home(workdir: Path) -> Dict[str, str]:
+    """Build a scratch home lab tree and fake tool directory; returns the server environment"""
+    home = workdir / "homelab"
+    shutil.copytree(REPO_ROOT / "ansible", home / "ansible")
+    shutil.copytree(REPO_ROOT / "terraform", home / "terraform",
+                    ignore=shutil.ignore_patterns('.terraform', '*.tfstate*'))
+
+    bin_dir = workdir / "bin"
+    bin_dir.mkdir()
+    for tool in FAKE_TOOLS:
+        (bin_dir / tool).symlink_to(BENCH_DIR / "fake_tool.py")
+
+    env = dict(os.environ)
+    env.update({
+        'HOMELAB_HOME': str(home),
+        'HOMELAB_STATE_DB': str(workdir / "deployments.db"),
+        # `env` takes the same VAR=value prefix as sudo
+        'HOMELAB_SUDO': 'env',
+        'PATH': f"{bin_dir}{os.pathsep}{env.get('PATH', '')}",
+        'PYTHONUNBUFFERED': '1',
+        'FAKE_IMAGE_DIR': str(workdir / "images"),
+    })
+    for tool in FAKE_TOOLS:
+        env['HOMELAB_TOOL_' + tool.upper().replace('-', '_')] = str(bin_dir / tool)
+    return env
+
+
+def peak_rss_mb(pid: int) -> float:
+    """High-water mark of the server's resident memory"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def metric_value(metrics_text: str, name: str) -> float:
+    for line in metrics_text.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split()[1])
+    return 0.0
+
+
+class FakeKube:
+    """The fake Kubernetes API server in a child process, with a kubeconfig pointing at it"""
+
+    def __init__(self, workdir: Path, rollout_seconds: float = KUBE_ROLLOUT_SECONDS):
+        self.port = free_port()
+        self.kubeconfig = workdir / "kubeconfig.yaml"
+        self.process = subprocess.Popen(
+            [sys.executable, str(BENCH_DIR / "fake_kube_api.py"), "--port", str(self.port),
+             "--rollout-seconds", str(rollout_seconds), "--kubeconfig", str(self.kubeconfig)]
+        )
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class Server:
+    """The backend running under uvicorn in a child process"""
+
+    def __init__(self, env: Dict[str, str]):
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+             "--port", str(self.port), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=env
+        )
+
+    async def wait_ready(self, client: httpx.AsyncClient, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("Backend exited during startup")
+            try:
+                if (await client.get(f"{self.base_url}/api/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+        raise RuntimeError("Backend did not become ready")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+async def poller(client: httpx.AsyncClient, url: str, done: asyncio.Event, latencies: List[float],
+                 errors: Dict[str, int]):
+    """Follow a deployment the way the frontend's polling fallback does
+
+    Failed requests and server errors are counted and retried after a
+    pause, as a browser would, rather than ending the run.
+    """
+    since = None
+    while not done.is_set():
+        params = {} if since is None else {'since': since}
+        started = time.perf_counter()
+        try:
+            response = await client.get(url, params=params)
+        except httpx.TransportError:
+            errors['count'] += 1
+            await asyncio.sleep(ERROR_BACKOFF)
+            continue
+        latencies.append(time.perf_counter() - started)
+        if response.status_code >= 500:
+            errors['count'] += 1
+            await asyncio.sleep(ERROR_BACKOFF)
+            continue
+        if response.status_code == 200:
+            since = response.json()['last_seq']
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def ws_client(url: str, done: asyncio.Event, received: Dict[str, Any], errors: Dict[str, int]):
+    """Follow a deployment over the WebSocket stream until it finishes, reconnecting when dropped"""
+    while not done.is_set():
+        try:
+            async with websockets.connect(url, max_size=None) as socket_:
+                while True:
+                    try:
+                        raw = await asyncio.wait_for(socket_.recv(), timeout=1)
+                    except asyncio.TimeoutError:
+                        if done.is_set():
+                            return
+                        continue
+                    message = json.loads(raw)
+                    received['messages'] += 1
+                    if message['type'] == 'logs':
+                        received['seqs'].update(range(message['seq'], message['seq'] + len(message['lines'])))
+                    elif message['type'] == 'status' and message['status']['status'] in TERMINAL_STATUSES:
+                        return
+        except (OSError, websockets.WebSocketException):
+            errors['count'] += 1
+            await asyncio.sleep(ERROR_BACKOFF)
+
+
+async def run_scenario(name: str, scenario: Dict[str, Any]) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="homelab-bench-") as tmp:
+        env = prepare_home(Path(tmp))
+        env.update({key: str(value) for key, value in scenario['env'].items()})
+        kube = FakeKube(Path(tmp))
+        env['KUBECONFIG'] = str(kube.kubeconfig)
+        server = Server(env)
+        limits = httpx.Limits(max_connections=scenario['pollers'] + 10)
+        try:
+            async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+                await server.wait_ready(client)
+                response = await client.post(f"{server.base_url}/api/config/save", json=CONFIG)
+                response.raise_for_status()
+
+                lines_before = metric_value((await client.get(f"{server.base_url}/metrics")).text,
+                                            'homelab_deployment_log_lines_total')
+                started = time.perf_counter()
+                response = await client.post(f"{server.base_url}/api/deployment/start",
+                                             params={'force_full': 'true'})
+                response.raise_for_status()
+                deployment_id = response.json()['deployment_id']
+
+                status_url = f"{server.base_url}/api/deployment/status/{deployment_id}"
+                ws_url = f"ws://127.0.0.1:{server.port}/ws/deployment?deployment_id={deployment_id}"
+                done = asyncio.Event()
+                latencies: List[float] = []
+                errors = {'count': 0}
+                streams = [{'messages': 0, 'seqs': set()} for _ in range(scenario['websockets'])]
+                tasks = [asyncio.create_task(poller(client, status_url, done, latencies, errors))
+                         for _ in range(scenario['pollers'])]
+                tasks += [asyncio.create_task(ws_client(ws_url, done, stream, errors)) for stream in streams]
+
+                while True:
+                    try:
+                        response = await client.get(status_url, params={'wait': 5, 'since': 2 ** 62})
+                    except httpx.TransportError:
+                        await asyncio.sleep(ERROR_BACKOFF)
+                        continue
+                    if response.status_code != 200:
+                        await asyncio.sleep(ERROR_BACKOFF)
+                        continue
+                    status = response.json()
+                    if status['status'] in TERMINAL_STATUSES:
+                        break
+                elapsed = time.perf_counter() - started
+                done.set()
+                await asyncio.gather(*tasks)
+
+                metrics_text = (await client.get(f"{server.base_url}/metrics")).text
+                log_lines = metric_value(metrics_text, 'homelab_deployment_log_lines_total') - lines_before
+                last_seq = status['last_seq'] or 1
+                ws_messages = sum(stream['messages'] for stream in streams)
+                attempts = len(latencies) + errors['count'] + len(streams)
+
+                return {
+                    'deployment_status': status['status'],
+                    'deployment_error': status['error'],
+                    'log_lines': int(log_lines),
+                    'results': {
+                        'deployment_seconds': round(elapsed, 3),
+                        'log_lines_per_second': round(log_lines / elapsed, 1),
+                        'poll_requests_per_second': round(len(latencies) / elapsed, 1),
+                        'poll_latency_p50_ms': round(percentile(latencies, 50) * 1000, 2),
+                        'poll_latency_p95_ms': round(percentile(latencies, 95) * 1000, 2),
+                        'poll_latency_p99_ms': round(percentile(latencies, 99) * 1000, 2),
+                        'ws_messages_per_second': round(ws_messages / elapsed, 1),
+                        'ws_log_coverage': round(
+                            sum(len(stream['seqs']) for stream in streams) / (last_seq * len(streams)), 4
+                        ) if streams else 1.0,
+                        'peak_rss_mb': round(peak_rss_mb(server.process.pid), 1),
+                        # Failed polls and dropped or refused WebSocket connections per request made
+                        'error_rate': round(errors['count'] / attempts, 4) if attempts else 0.0,
+                    }
+                }
+        finally:
+            server.stop()
+            kube.stop()
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Describe every result worse than its baseline by more than ``tolerance``"""
+    regressions = []
+    for name, result in results.items():
+        for metric, value in result['results'].items():
+            expected = baseline.get(name, {}).get('results', {}).get(metric)
+            if metric in ABSOLUTE_TOLERANCE and expected is not None:
+                if value - expected > ABSOLUTE_TOLERANCE[metric]:
+                    regressions.append(f"{name}.{metric}: {value} vs baseline {expected}")
+                continue
+            if expected is None or expected == 0:
+                continue
+            change = (value - expected) / abs(expected)
+            worse = -change if HIGHER_IS_BETTER[metric] else change
+            if worse > tolerance:
+                regressions.append(f"{name}.{metric}: {value} vs baseline {expected} ({worse:+.0%} worse)")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="scenario to run (repeatable; default all)")
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed relative regression before failing (default 0.25)")
+    parser.add_argument('--output', type=Path, help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        print(f"▶ {name}: {SCENARIOS[name]['description']}", flush=True)
+        results[name] = asyncio.run(run_scenario(name, SCENARIOS[name]))
+        print(json.dumps(results[name], indent=2), flush=True)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+
+    failed = [name for name, result in results.items() if result['deployment_status'] != 'completed']
+    for name in failed:
+        print(f"❌ {name}: deployment {results[name]['deployment_status']}: {results[name]['deployment_error']}")
+
+    if args.save_baseline:
+        if failed:
+            print("Not saving a baseline from failed scenarios")
+            return 1
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        baseline.update(results)
+        args.baseline.write_text(json.dumps(baseline, indent=2) + "\n")
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if args.baseline.exists():
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"❌ Regression: {regression}")
+        if regressions:
+            return 1
+        print("✅ No regressions against the baseline")
+    else:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the k3s API server, enough for the backend's readiness checks
+
+Serves one Ready node, a pod per service and the service Deployments
+over plain HTTP. Every Deployment reports an unfinished rollout until
+``--rollout-seconds`` after the first Deployment request; watchers receive
+a MODIFIED event at that moment, so a deployment run exercises both list
+and watch.
+
+    python fake_kube_api.py --port 8001 --rollout-seconds 2
+    python fake_kube_api.py --kubeconfig kubeconfig.yaml   # also writes a kubeconfig pointing at it
+"""
+import argparse
+import asyncio
+import json
+from typing import Dict, Any, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+# Deployments served, as (namespace, name); matches SERVICE_WORKLOADS in the backend
+DEPLOYMENTS = [
+    ('default', 'portainer'),
+    ('default', 'registry'),
+    ('default', 'registry-ui'),
+    ('default', 'gitea'),
+]
+
+KUBECONFIG_TEMPLATE = """\
+apiVersion: v1
+kind: Config
+clusters:
+- name: fake
+  cluster:
+    server: http://127.0.0.1:{port}
+contexts:
+- name: fake
+  context:
+    cluster: fake
+    user: fake
+current-context: fake
+users:
+- name: fake
+  user:
+    token: fake-token
+"""
+
+
+class FakeKubeAPI:
+    def __init__(self, rollout_seconds: float):
+        self.rollout_seconds = rollout_seconds
+        self.rollout_started = False
+        self.ready_event = asyncio.Event()
+
+    def start_rollout(self):
+        if not self.rollout_started:
+            self.rollout_started = True
+            asyncio.get_running_loop().call_later(self.rollout_seconds, self.ready_event.set)
+
+    @property
+    def resource_version(self) -> str:
+        return "2" if self.ready_event.is_set() else "1"
+
+    def deployment(self, namespace: str, name: str) -> Dict[str, Any]:
+        ready = self.ready_event.is_set()
+        return {
+            'metadata': {'name': name, 'namespace': namespace, 'generation': 1,
+                         'resourceVersion': self.resource_version},
+            'spec': {'replicas': 1},
+            'status': {
+                'observedGeneration': 1,
+                'replicas': 1,
+                'updatedReplicas': 1 if ready else 0,
+                'availableReplicas': 1 if ready else 0,
+                'readyReplicas': 1 if ready else 0,
+            },
+        }
+
+    def listing(self, path: str, query: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        if path == '/api/v1/nodes':
+            items = [{'metadata': {'name': 'pi'},
+                      'status': {'conditions': [{'type': 'Ready', 'status': 'True'}]}}]
+        elif path == '/api/v1/pods':
+            items = [{'metadata': {'name': name, 'namespace': namespace},
+                      'status': {'phase': 'Running' if self.ready_event.is_set() else 'Pending'}}
+                     for namespace, name in DEPLOYMENTS]
+        elif path.startswith('/apis/apps/v1/namespaces/') and path.endswith('/deployments'):
+            self.start_rollout()
+            namespace = path.split('/')[5]
+            wanted = query.get('fieldSelector', '').partition('metadata.name=')[2]
+            items = [self.deployment(ns, name) for ns, name in DEPLOYMENTS
+                     if ns == namespace and (not wanted or name == wanted)]
+        else:
+            return None
+        return {'metadata': {'resourceVersion': self.resource_version}, 'items': items}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                path, query = request
+                listing = self.listing(path, query)
+                if listing is None:
+                    await respond(writer, 404, {'kind': 'Status', 'code': 404, 'message': f"{path} not found"})
+                elif query.get('watch') == 'true':
+                    await self.watch(writer, listing, query)
+                else:
+                    await respond(writer, 200, listing)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def watch(self, writer: asyncio.StreamWriter, listing: Dict[str, Any], query: Dict[str, str]):
+        """Stream a MODIFIED event per item once the rollout finishes, then end the watch"""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n")
+        await writer.drain()
+        timeout = float(query.get('timeoutSeconds', 60))
+        if query.get('resourceVersion') != "2":
+            try:
+                await asyncio.wait_for(self.ready_event.wait(), timeout=timeout)
+                for item in listing['items']:
+                    namespace, name = item['metadata'].get('namespace'), item['metadata']['name']
+                    event = {'type': 'MODIFIED', 'object': self.deployment(namespace, name)}
+                    await write_chunk(writer, json.dumps(event).encode() + b"\n")
+            except asyncio.TimeoutError:
+                pass
+        else:
+            await asyncio.sleep(timeout)
+        await write_chunk(writer, b"")
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, Dict[str, str]]]:
+    """Path and query of the next request on a kept-alive connection; None once it closes"""
+    line = await reader.readline()
+    if not line:
+        return None
+    _, target, _ = line.decode().split(' ', 2)
+    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+        pass
+    parts = urlsplit(target)
+    return parts.path, {key: values[0] for key, values in parse_qs(parts.query).items()}
+
+
+async def respond(writer: asyncio.StreamWriter, status: int, body: Dict[str, Any]):
+    data = json.dumps(body).encode()
+    writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Not Found'}\r\n"
+                 f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+    await writer.drain()
+
+
+async def write_chunk(writer: asyncio.StreamWriter, data: bytes):
+    writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+    await writer.drain()
+
+
+async def serve(port: int, rollout_seconds: float):
+    api = FakeKubeAPI(rollout_seconds)
+    server = await asyncio.start_server(api.handle, '127.0.0.1', port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--rollout-seconds', type=float, default=2)
+    parser.add_argument('--kubeconfig', help="write a kubeconfig for this server to the given path")
+    args = parser.parse_args()
+    if args.kubeconfig:
+        with open(args.kubeconfig, 'w') as f:
+            f.write(KUBECONFIG_TEMPLATE.format(port=args.port))
+    asyncio.run(serve(args.port, args.rollout_seconds))
+
+
+if __name__ == '__main__':
+    main()
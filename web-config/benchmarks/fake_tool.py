@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Stand-in for ansible-playbook, ansible-galaxy, tofu, kubectl, systemctl and k3s
+
+The tool to imitate is taken from the name the script is invoked as
+(the benchmark harness creates symlinks). Output volume and shape are
+controlled through environment variables:
+
+  FAKE_LINES              lines the playbook prints (default 1000)
+  FAKE_RATE               lines per second, 0 for as fast as possible (default 0)
+  FAKE_LINE_LENGTH        length of an ordinary line (default 120)
+  FAKE_LONG_LINE_EVERY    every Nth line is a long one, 0 for none (default 0)
+  FAKE_LONG_LINE_LENGTH   length of a long line (default 65536)
+  FAKE_TASK_LINES         lines per playbook task (default 20)
+  FAKE_FAIL               exit non-zero from the playbook when set to 1
+  FAKE_PULL_SECONDS       time `k3s crictl pull` takes per image (default 1)
+  FAKE_IMAGE_DIR          where pulled images are remembered (default a temp directory)
+"""
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Must match EVENT_PREFIX in web-config/backend/ansible_progress.py
+EVENT_PREFIX = '@@HOMELAB_EVENT@@ '
+
+ROLES = ['system-prep', 'docker', 'registry-mirror', 'k3s', 'storage', 'load-balancer', 'kubelish', 'opentofu']
+
+# Output is released in ticks of this many seconds to hold the requested rate
+TICK = 0.05
+
+
+def setting(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+def write(line: str):
+    sys.stdout.write(line + '\n')
+
+
+def emit_event(event: str, **fields):
+    fields.update(event=event, time=time.time())
+    write(EVENT_PREFIX + json.dumps(fields))
+
+
+def ansible_playbook(args):
+    if '--version' in args:
+        write("ansible-playbook [core 2.16.0] (fake)")
+        return 0
+
+    lines = setting('FAKE_LINES', 1000)
+    rate = setting('FAKE_RATE', 0)
+    line_length = setting('FAKE_LINE_LENGTH', 120)
+    long_every = setting('FAKE_LONG_LINE_EVERY', 0)
+    long_length = setting('FAKE_LONG_LINE_LENGTH', 65536)
+    task_lines = max(setting('FAKE_TASK_LINES', 20), 1)
+    events = 'homelab_events' in os.getenv('ANSIBLE_CALLBACKS_ENABLED', '')
+
+    if events:
+        emit_event('play_start', play='Stage 2 - Full Home Lab Deployment (fake)')
+    write("PLAY [Stage 2 - Full Home Lab Deployment (fake)] " + "*" * 40)
+
+    per_tick = max(int(rate * TICK), 1) if rate else None
+    tick_started = time.monotonic()
+    tasks = 0
+    for number in range(1, lines + 1):
+        if (number - 1) % task_lines == 0:
+            role = ROLES[min(tasks * len(ROLES) * task_lines // max(lines, 1), len(ROLES) - 1)]
+            tasks += 1
+            if events:
+                if tasks > 1:
+                    emit_event('result', status='changed', host='localhost', task_id=str(tasks - 1))
+                emit_event('task_start', task=f"Fake task {tasks}", role=role, task_id=str(tasks), action='command')
+            write(f"TASK [{role} : Fake task {tasks}] " + "*" * 40)
+
+        length = long_length if long_every and number % long_every == 0 else line_length
+        prefix = f"ok: [localhost] line {number} "
+        write(prefix + "x" * max(length - len(prefix), 0))
+
+        if per_tick and number % per_tick == 0:
+            sys.stdout.flush()
+            tick_started += TICK
+            delay = tick_started - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    failed = os.getenv('FAKE_FAIL') == '1'
+    if events:
+        emit_event('result', status='failed' if failed else 'changed', host='localhost', task_id=str(tasks))
+        emit_event('recap', hosts={'localhost': {'ok': tasks, 'changed': tasks, 'failures': int(failed)}})
+    write(f"PLAY RECAP " + "*" * 40)
+    write(f"localhost : ok={tasks} changed={tasks} unreachable=0 failed={int(failed)}")
+    return 2 if failed else 0
+
+
+def ansible_galaxy(args):
+    if '--version' in args:
+        write("ansible-galaxy [core 2.16.0] (fake)")
+        return 0
+    write("Starting galaxy collection install process")
+    write("Nothing to do. All requested collections are already installed.")
+    return 0
+
+
+def tofu(args):
+    if args[:1] == ['version']:
+        write("OpenTofu v1.6.0 (fake)")
+        return 0
+    write(f"tofu {' '.join(args)}: nothing to do (fake)")
+    return 0
+
+
+def kubectl(args):
+    if args[:1] == ['version']:
+        write("Client Version: v1.28.0 (fake)")
+    elif args[:2] == ['get', 'nodes']:
+        write("NAME   STATUS   ROLES                  AGE   VERSION")
+        write("pi     Ready    control-plane,master   1d    v1.28.0+k3s1")
+    elif args[:2] == ['get', 'pods']:
+        write("NAMESPACE   NAME        READY   STATUS    RESTARTS   AGE")
+        write("default     portainer   1/1     Running   0          1d")
+    elif args[:2] == ['rollout', 'status']:
+        write(f'{args[2]} successfully rolled out')
+    return 0
+
+
+def systemctl(args):
+    write("active")
+    return 0
+
+
+def k3s(args):
+    """Only `k3s crictl info|inspecti|pull`; a pulled image is remembered as a file"""
+    if args[:1] != ['crictl']:
+        return 1
+    command, image = args[1:2], args[-1]
+    images = os.getenv('FAKE_IMAGE_DIR', os.path.join(tempfile.gettempdir(), 'fake-images'))
+    marker = os.path.join(images, hashlib.sha256(image.encode()).hexdigest())
+    if command == ['info']:
+        write(json.dumps({'status': {'conditions': [{'type': 'RuntimeReady', 'status': True}]}}))
+    elif command == ['inspecti']:
+        if not os.path.exists(marker):
+            sys.stderr.write(f"no such image \"{image}\" present\n")
+            return 1
+        write(json.dumps({'status': {'size': str(os.path.getsize(marker))}}))
+    elif command == ['pull']:
+        time.sleep(float(os.getenv('FAKE_PULL_SECONDS', '1')))
+        os.makedirs(images, exist_ok=True)
+        with open(marker, 'wb') as f:
+            f.truncate(50 * 2**20)  # sparse; its size stands in for the image's
+        write(f"Image is up to date for sha256:{hashlib.sha256(image.encode()).hexdigest()}")
+    return 0
+
+
+TOOLS = {
+    'ansible-playbook': ansible_playbook,
+    'ansible-galaxy': ansible_galaxy,
+    'tofu': tofu,
+    'kubectl': kubectl,
+    'systemctl': systemctl,
+    'k3s': k3s,
+}
+
+
+if __name__ == '__main__':
+    tool = os.path.basename(sys.argv[0])
+    if tool not in TOOLS:
+        sys.stderr.write(f"fake_tool: unknown tool {tool}\n")
+        sys.exit(127)
+    code = TOOLS[tool](sys.argv[1:])
+    sys.stdout.flush()
+    sys.exit(code)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Cold-start profile of the configuration backend
+
+Starts the backend the way the systemd service does (``main.py
+--production``) against a scratch state directory, several times, and
+measures the time from launching the interpreter until the first
+``/api/health`` response. It also reports the modules that take the
+longest to import, from ``python -X importtime``.
+
+    python startup_profile.py                 # 5 cold starts, report only
+    python startup_profile.py --target 4      # also fail if the median exceeds 4s
+
+The start-up target is set for Pi-class hardware (a Raspberry Pi 4 or 5);
+the same run on a desktop finishes several times faster.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+from typing import Dict, Any, List, Tuple
+
+BENCH_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = BENCH_DIR.parent / "backend"
+
+# Median cold start to first /api/health response allowed on a Raspberry Pi 4
+PI_TARGET_SECONDS = 4.0
+
+# Longest a single start may take before the run is abandoned
+START_TIMEOUT = 60
+
+# Interval between health probes while the backend starts
+PROBE_INTERVAL = 0.02
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def cold_start(env: Dict[str, str]) -> float:
+    """Seconds from spawning the backend until /api/health answers"""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/api/health"
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "main.py", "--production", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < START_TIMEOUT:
+            if process.poll() is not None:
+                raise RuntimeError(f"backend exited with code {process.returncode}")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(PROBE_INTERVAL)
+        raise RuntimeError(f"backend did not answer within {START_TIMEOUT}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def import_profile(env: Dict[str, str], top: int) -> Tuple[float, List[Dict[str, Any]]]:
+    """Total import time of main and its slowest imports, cumulative, in seconds"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True)
+    # Lines read "import time: <self us> | <cumulative us> | <module>", indented two spaces per level
+    modules = {}
+    for line in result.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        modules[name.strip()] = (int(fields[1]) / 1e6, (len(name) - len(name.lstrip()) - 1) // 2)
+    total = modules.get('main', (0.0, 0))[0]
+    # Only what main imports directly, so a package and its submodules aren't counted twice
+    slowest = sorted(((seconds, name) for name, (seconds, depth) in modules.items() if depth == 1), reverse=True)
+    return total, [{'module': name, 'seconds': round(seconds, 3)} for seconds, name in slowest[:top]]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help="slowest imports to list")
+    parser.add_argument('--target', type=float, help=f"fail if the median start exceeds this "
+                                                     f"(Pi-class target: {PI_TARGET_SECONDS}s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ)
+        env.update({
+            'HOMELAB_HOME': str(Path(workdir) / "homelab"),
+            'HOMELAB_STATE_DB': str(Path(workdir) / "deployments.db"),
+        })
+        # The first start also compiles bytecode; like a service restart, the measured ones don't
+        cold_start(env)
+        starts = [cold_start(env) for _ in range(args.runs)]
+        import_total, slowest = import_profile(env, args.top)
+
+    median = statistics.median(starts)
+    report = {
+        'runs': args.runs,
+        'health_after_seconds': {'median': round(median, 3), 'min': round(min(starts), 3),
+                                 'max': round(max(starts), 3)},
+        'import_main_seconds': round(import_total, 3),
+        'slowest_imports': slowest,
+        'target_seconds': args.target,
+    }
+    print(json.dumps(report, indent=2))
+    if args.target is not None and median > args.target:
+        print(f"Median start {median:.2f}s exceeds the target of {args.target:g}s", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,30 @@
-import React, { useState, useEffect } from 'react'
+import React, { useState, useEffect, useRef } from 'react'
 import { CheckCircle, Clock, AlertCircle, Play, Terminal } from 'lucide-react'
 import { Navigate } from 'react-router-dom'
 import api from '../utils/api'
 
+// Keep the in-browser log view bounded during long deployments
+const MAX_LOG_LINES = 1000
+
+// Long-poll window for the status fallback; must stay below the API client timeout
+const STATUS_WAIT_SECONDS = 25
+
+// Deployment statuses that are still expected to change
+const ACTIVE_STATUSES = ['queued', 'starting', 'running']
+
+const appendLogs = (previous, lines) => {
+  const next = previous.concat(lines)
+  return next.length > MAX_LOG_LINES ? next.slice(-MAX_LOG_LINES) : next
+}
+
 const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
   const [deploymentStatus, setDeploymentStatus] = useState(null)
   const [logs, setLogs] = useState([])
   const [showLogs, setShowLogs] = useState(false)
+  const [cancelling, setCancelling] = useState(false)
   const [error, setError] = useState(null)
+  const socketRef = useRef(null)
+  const lastSeqRef = useRef(null)
 
   useEffect(() => {
     if (!configuration) {
@@ -15,6 +32,12 @@ const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
     }
 
     startDeployment()
+
+    return () => {
+      if (socketRef.current) {
+        socketRef.current.close()
+      }
+    }
   }, [configuration])
 
   const startDeployment = async () => {
@@ -22,30 +45,125 @@ const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
       const response = await api.post('/deployment/start')
       const deploymentId = response.data.deployment_id
 
-      // Start polling for status
-      pollDeploymentStatus(deploymentId)
+      // Stream logs and status over the WebSocket, polling only as a fallback
+      streamDeployment(deploymentId)
     } catch (error) {
       console.error('Failed to start deployment:', error)
       setError('Failed to start deployment')
     }
   }
 
+  const handleStatus = (deploymentId, status) => {
+    setDeploymentStatus(status)
+
+    if (status.status === 'completed') {
+      onDeploymentComplete(deploymentId)
+    } else if (['failed', 'interrupted', 'cancelled'].includes(status.status)) {
+      setError(status.error || 'Deployment failed')
+    }
+
+    return !ACTIVE_STATUSES.includes(status.status)
+  }
+
+  const streamDeployment = (deploymentId) => {
+    if (!('WebSocket' in window)) {
+      pollDeploymentStatus(deploymentId)
+      return
+    }
+
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:'
+    const socket = new WebSocket(
+      `${protocol}//${window.location.host}/ws/deployment?deployment_id=${encodeURIComponent(deploymentId)}`
+    )
+    socketRef.current = socket
+    let finished = false
+    // Log messages that arrive while a gap is being refilled, applied once it is
+    let buffered = null
+    let refillDone = null
+
+    // A batch of consecutive lines starting at seq, minus any already shown
+    const applyLogs = (seq, lines) => {
+      const skip = lastSeqRef.current === null ? 0 : Math.max(lastSeqRef.current + 1 - seq, 0)
+      if (skip >= lines.length) return
+      lastSeqRef.current = seq + lines.length - 1
+      setLogs(previous => appendLogs(previous, lines.slice(skip)))
+    }
+
+    // The server drops the oldest messages of a subscriber that falls behind;
+    // fetch the missing lines from the status API, a page at a time
+    const refill = async () => {
+      try {
+        let more = true
+        while (more) {
+          const response = await api.get(`/deployment/status/${deploymentId}`, {
+            params: { since: lastSeqRef.current }
+          })
+          const status = response.data
+          setLogs(previous => appendLogs(previous, status.logs || []))
+          lastSeqRef.current = status.last_seq
+          more = status.more
+        }
+      } catch (error) {
+        console.error('Failed to fetch missed log lines:', error)
+      }
+      const pending = buffered
+      buffered = null
+      pending.forEach(message => applyLogs(message.seq, message.lines))
+    }
+
+    socket.onmessage = (event) => {
+      const message = JSON.parse(event.data)
+
+      if (message.type === 'logs') {
+        if (buffered) {
+          buffered.push(message)
+        } else if (lastSeqRef.current !== null && message.seq > lastSeqRef.current + 1) {
+          buffered = [message]
+          refillDone = refill()
+        } else {
+          applyLogs(message.seq, message.lines)
+        }
+      } else if (message.type === 'progress') {
+        setDeploymentStatus(previous => previous && { ...previous, ansible_progress: message.progress })
+      } else if (message.type === 'status') {
+        finished = handleStatus(deploymentId, message.status)
+        if (finished) {
+          socket.close()
+        }
+      } else if (message.type === 'error') {
+        console.error('Deployment stream error:', message.message)
+      }
+    }
+
+    socket.onclose = () => {
+      socketRef.current = null
+      if (!finished) {
+        // Connection lost mid-deployment - fall back to polling, after any refill in flight
+        Promise.resolve(refillDone).then(() => pollDeploymentStatus(deploymentId))
+      }
+    }
+  }
+
   const pollDeploymentStatus = async (deploymentId) => {
     const poll = async () => {
       try {
-        const response = await api.get(`/deployment/status/${deploymentId}`)
+        // Fetch only entries newer than the last one seen, holding until something changes
+        const params = { wait: STATUS_WAIT_SECONDS }
+        if (lastSeqRef.current !== null) {
+          params.since = lastSeqRef.current
+        }
+        const response = await api.get(`/deployment/status/${deploymentId}`, { params })
         const status = response.data
 
-        setDeploymentStatus(status)
-        setLogs(status.logs || [])
+        setLogs(previous => lastSeqRef.current === null ? (status.logs || []) : appendLogs(previous, status.logs || []))
+        lastSeqRef.current = status.last_seq
 
-        if (status.status === 'completed') {
-          onDeploymentComplete(deploymentId)
-        } else if (status.status === 'failed') {
-          setError(status.error || 'Deployment failed')
-        } else if (status.status === 'running' || status.status === 'starting') {
+        if (status.more) {
+          // One page of a longer backlog - fetch the rest before acting on the status
+          setTimeout(poll, 0)
+        } else if (!handleStatus(deploymentId, status)) {
           // Continue polling
-          setTimeout(poll, 2000)
+          setTimeout(poll, 0)
         }
       } catch (error) {
         console.error('Failed to get deployment status:', error)
@@ -56,6 +174,17 @@ const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
     poll()
   }
 
+  const cancelDeployment = async () => {
+    setCancelling(true)
+    try {
+      // The final status arrives over the WebSocket (or the next poll)
+      await api.post(`/deployment/cancel/${deploymentStatus.id}`)
+    } catch (error) {
+      console.error('Failed to cancel deployment:', error)
+      setCancelling(false)
+    }
+  }
+
   const getStepStatus = (stepName, currentStep, steps) => {
     if (!steps || steps.length === 0) return 'pending'
 
@@ -72,6 +201,7 @@ const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
       case 'running':
         return <Play size={20} style={{ color: '#3498db' }} />
       case 'failed':
+      case 'timed_out':
         return <AlertCircle size={20} style={{ color: '#e74c3c' }} />
       default:
         return <Clock size={20} style={{ color: '#95a5a6' }} />
@@ -85,6 +215,7 @@ const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
       case 'running':
         return 'progress-step running'
       case 'failed':
+      case 'timed_out':
         return 'progress-step failed'
       default:
         return 'progress-step'
@@ -100,7 +231,9 @@ const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
       <div className="progress-container">
         <div className="progress-header">
           <AlertCircle size={48} style={{ color: '#e74c3c', marginBottom: '20px' }} />
-          <h2 className="progress-title">Deployment Failed</h2>
+          <h2 className="progress-title">
+            {deploymentStatus?.status === 'cancelled' ? 'Deployment Cancelled' : 'Deployment Failed'}
+          </h2>
           <div className="progress-status" style={{ color: '#e74c3c' }}>
             {error}
           </div>
@@ -108,7 +241,14 @@ const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
 
         {logs.length > 0 && (
           <div style={{ marginTop: '30px' }}>
-            <h4 style={{ marginBottom: '15px' }}>Deployment Logs</h4>
+            <div style={{ display: 'flex', justifyContent: 'space-between', alignItems: 'center', marginBottom: '15px' }}>
+              <h4>Deployment Logs</h4>
+              {deploymentStatus && (
+                <a className="btn btn-secondary" href={`/api/deployment/logs/${deploymentStatus.id}/download`}>
+                  Download Full Log
+                </a>
+              )}
+            </div>
             <div className="logs-container">
               {logs.map((log, index) => (
                 <div key={index} className="log-line">{log}</div>
@@ -129,20 +269,38 @@ const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
     )
   }
 
-  const steps = [
-    'Install Ansible collections',
-    'Run Ansible playbook',
-    'Apply Terraform/OpenTofu',
-    'Verify deployment'
-  ]
+  // The backend reports the step graph once the deployment starts running
+  const steps = deploymentStatus?.steps?.length ?
+    deploymentStatus.steps.map(step => step.name) :
+    ['Prepare Stage 2 environment', 'Run Stage 2 Ansible playbook', 'Verify cluster']
+  const stepDurations = Object.fromEntries(
+    (deploymentStatus?.steps || []).map(step => [step.name, step.duration])
+  )
+  const stepKeys = Object.fromEntries(
+    (deploymentStatus?.steps || []).map(step => [step.name, step.key])
+  )
+  const ansibleProgress = deploymentStatus?.ansible_progress
+  const hostProgress = Object.entries(ansibleProgress?.hosts || {})
 
   return (
     <div className="progress-container">
       <div className="progress-header">
         <h2 className="progress-title">Deploying Your Home Lab</h2>
         <div className="progress-status">
-          {deploymentStatus?.current_step || 'Initializing...'}
+          {deploymentStatus?.status === 'queued'
+            ? `Waiting for another deployment to finish (queue position ${deploymentStatus.queue_position || 1})`
+            : deploymentStatus?.current_step || 'Initializing...'}
         </div>
+        {deploymentStatus && ACTIVE_STATUSES.includes(deploymentStatus.status) && (
+          <button
+            className="btn btn-secondary"
+            onClick={cancelDeployment}
+            disabled={cancelling}
+            style={{ marginTop: '15px' }}
+          >
+            {cancelling ? 'Cancelling...' : 'Cancel Deployment'}
+          </button>
+        )}
       </div>
 
       <div className="progress-steps">
@@ -158,9 +316,13 @@ const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
               </div>
               <div className="step-name">{stepName}</div>
               <div className="step-status">
-                {status === 'running' ? 'In Progress...' :
-                 status === 'completed' ? 'Complete' :
-                 status === 'failed' ? 'Failed' : 'Pending'}
+                {status === 'running' && stepKeys[stepName] === 'ansible' && ansibleProgress?.percent != null ?
+                  `In Progress (${ansibleProgress.percent}%)` :
+                 status === 'running' ? 'In Progress...' :
+                 status === 'completed' ? `Complete${stepDurations[stepName] ? ` (${stepDurations[stepName].toFixed(0)}s)` : ''}` :
+                 status === 'failed' ? 'Failed' :
+                 status === 'timed_out' ? 'Timed Out' :
+                 status === 'skipped' || status === 'cancelled' ? 'Skipped' : 'Pending'}
               </div>
             </div>
           )
@@ -190,6 +352,33 @@ const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
               </div>
             </div>
 
+            {deploymentStatus.status === 'running' && ansibleProgress?.task && (
+              <div>
+                <div style={{ fontWeight: '600', color: '#555' }}>Current Task</div>
+                <div style={{ fontSize: '1rem', color: '#667eea' }}>
+                  {ansibleProgress.role ? `${ansibleProgress.role}: ` : ''}{ansibleProgress.task}
+                </div>
+              </div>
+            )}
+
+            {deploymentStatus.graph?.parallel_savings > 0 && (
+              <div>
+                <div style={{ fontWeight: '600', color: '#555' }}>Saved by Parallel Steps</div>
+                <div style={{ fontSize: '1.2rem', color: '#667eea' }}>
+                  {deploymentStatus.graph.parallel_savings.toFixed(0)}s
+                </div>
+              </div>
+            )}
+
+            {deploymentStatus.image_prefetch?.pulled > 0 && (
+              <div>
+                <div style={{ fontWeight: '600', color: '#555' }}>Images Pre-fetched</div>
+                <div style={{ fontSize: '1.2rem', color: '#667eea' }}>
+                  {(deploymentStatus.image_prefetch.bytes / 2 ** 20).toFixed(0)} MiB, {deploymentStatus.image_prefetch.seconds_saved.toFixed(0)}s saved
+                </div>
+              </div>
+            )}
+
             {deploymentStatus.started_at && (
               <div>
                 <div style={{ fontWeight: '600', color: '#555' }}>Started</div>
@@ -199,6 +388,24 @@ const DeploymentProgress = ({ configuration, onDeploymentComplete }) => {
               </div>
             )}
           </div>
+
+          {hostProgress.length > 1 && (
+            <div style={{ marginTop: '20px' }}>
+              <div style={{ fontWeight: '600', color: '#555', marginBottom: '8px' }}>Nodes</div>
+              {hostProgress.map(([name, host]) => (
+                <div key={name} style={{ display: 'flex', gap: '12px', fontSize: '0.95rem', padding: '4px 0' }}>
+                  <span style={{ fontWeight: '600', minWidth: '120px' }}>{name}</span>
+                  <span style={{ color: host.status === 'running' ? '#667eea' : host.status === 'completed' ? '#27ae60' : '#e74c3c', minWidth: '90px', textTransform: 'capitalize' }}>
+                    {host.status}
+                  </span>
+                  <span style={{ color: '#666' }}>
+                    {host.status === 'running' && host.task ? `${host.role ? `${host.role}: ` : ''}${host.task}` :
+                      `${host.counts.ok + host.counts.changed} ok, ${host.counts.changed} changed, ${host.counts.failed + host.counts.unreachable} failed`}
+                  </span>
+                </div>
+              ))}
+            </div>
+          )}
         </div>
       )}
 